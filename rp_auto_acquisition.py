@@ -0,0 +1,57 @@
+import atexit
+import time
+import datetime
+import logging
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# one consistent set of device readings, taken in a single acquisition pass
+Snapshot = namedtuple('Snapshot', ['timestamp', 'pump_state', 'pump_level', 'scale', 'mmeter', 'duration', 'time'])
+PUMP_FIELDS = ("state", "level")   # pump registers read every pass, the sensor temperatures are not used
+
+class Acquisition:
+    """Queries the independent serial devices in parallel.
+
+    Pump, scale and multimeter each sit on their own serial line, so they can be
+    polled at the same time. The latency of one pass is then set by the slowest
+    device instead of by the sum of all of them.
+    """
+
+    def __init__( self, pump, scale, mmeter, pool = None, loggername = ""):
+        self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
+        self.pump = pump
+        self.scale = scale
+        self.mmeter = mmeter
+        self._pool = pool   # may be shared by several acquisitions that are never run at the same time
+        if pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=3)   # one worker per serial line
+            atexit.register(self._on_exit)
+
+    def _read_pump( self ):
+        # state and level are fetched with one batched register read, two round trips
+        status = self.pump.GetPumpStatus(PUMP_FIELDS)
+        return status.running, status.level
+
+    def Acquire( self ):
+        """Reads all devices concurrently.
+
+        Returns:
+            A Snapshot with the readings of all devices, the time the pass was started and its duration in seconds.
+            The start is given as local datetime, for display, and as time.time() value, for anything that is
+            ordered or subtracted -- local time repeats an hour when daylight saving time ends.
+
+        Raises:
+            Exception: If the pump state could not be determined.
+        """
+        start = time.time()
+        timestamp = datetime.datetime.fromtimestamp(start)
+        jobs = [self._pool.submit(self._read_pump), self._pool.submit(self.mmeter.GetValue), self._pool.submit(self.scale.GetValue)]
+        wait(jobs)      # wait for every device, so no worker is still busy on its port when the next pass starts
+        pump_state, pump_level = jobs[0].result()    # re-raises if the pump could not be contacted
+        duration = time.time() - start
+        self.logger.debug('Acquisition pass took %.3f s', duration)
+        return Snapshot(timestamp, pump_state, pump_level, jobs[2].result(), jobs[1].result(), duration, start)
+
+    def _on_exit( self ):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import platform
+
+from rp_auto_sim import Simulator
+from rp_auto_acquisition import PUMP_FIELDS
+
+# Benchmarks of the controller against simulated devices, see rp_auto_sim. Results are written as
+# JSON, and can be compared against those of an earlier run to catch latency regressions.
+
+FORMAT_VERSION = 1
+
+def Percentiles( samples ):
+    """Returns count, mean, median, 90th and 99th percentile and maximum of samples (nearest rank)."""
+    ordered = sorted(samples)
+    if not ordered: return {"count": 0}
+    pick = lambda q: ordered[min(int(q*len(ordered)), len(ordered) - 1)]
+    return {"count": len(ordered), "mean": sum(ordered)/len(ordered),
+            "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": ordered[-1]}
+
+def _timed( f, repeat ):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - start)
+    return Percentiles(samples)
+
+def BenchStartup( setup ):
+    """Builds the controller from the setup file and returns it, with the seconds it took until it was ready to poll."""
+    from rp_auto_ctrl import _runtime
+    start = time.perf_counter()
+    runtime = _runtime(setup)
+    return runtime, time.perf_counter() - start
+
+def BenchDrivers( runtime, repeat ):
+    """Measures the round trip of a single request to every device of the first station, and of an AT command to the modem."""
+    station = runtime.stations[0]
+    return {"pump": _timed(lambda: station.pump.GetPumpStatus(PUMP_FIELDS), repeat),
+            "scale": _timed(station.scale.GetValue, repeat),
+            "mmeter": _timed(station.mmeter.GetValue, repeat),
+            "modem": _timed(lambda: runtime.modem._send_cmd(''), repeat)}
+
+def BenchPasses( runtime, passes ):
+    """Measures the duration of complete control passes, including acquisition, checks and publishing."""
+    return {station.name: _timed(station.Poll, passes) for station in runtime.stations}
+
+def BenchFill( runtime, sim, timeout ):
+    """Runs one fill of the first station and measures how far the dewar was filled past maxweight.
+
+    Between passes the controller sleeps its poll interval in simulated time, so the overshoot is
+    what the real dewar would see, except that the time spent inside a pass is stretched by the
+    simulation speed as well.
+    """
+    station = runtime.stations[0]
+    model = sim.stations[station.name]["model"]
+    minweight, maxweight = float(station.runparams["minweight"]), float(station.runparams["maxweight"])
+    model.SetPump(False)
+    model.content = minweight - 0.01
+    station.value_pump = False
+    started = stopped = None
+    deadline = time.time() + timeout
+    while stopped is None and time.time() < deadline:
+        polltime = station.Poll()
+        if station.value_pump and started is None: started = time.time()
+        if not station.value_pump and started is not None: stopped = time.time()
+        if stopped is None: time.sleep(polltime/model.speed)
+    if stopped is None: return {"completed": False}
+    peak = model.Weight()
+    return {"completed": True, "duration": (stopped - started)*model.speed, "peak": peak, "overshoot": peak - maxweight}
+
+def BenchServer( port, requests ):
+    """Measures request/reply round trips and pipelined throughput of SVR:DATA on one connection."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    f = sock.makefile('rb')
+    def request():
+        sock.sendall(b'SVR:DATA\r\n')
+        f.readline()
+    roundtrip = _timed(request, requests)
+    start = time.perf_counter()
+    sock.sendall(b'SVR:DATA\r\n'*requests)
+    for _ in range(requests): f.readline()
+    throughput = requests/(time.perf_counter() - start)
+    sock.close()
+    return {"roundtrip": roundtrip, "throughput": throughput}
+
+def Run( speed = 60.0, stations = 1, repeat = 50, passes = 50, requests = 1000, latency = 0.0, serverport = 11911, filltimeout = 120.0 ):
+    """Runs all benchmarks against a fresh simulator and returns the results as a dictionary."""
+    names = ['det' + str(n + 1) for n in range(stations)] if stations > 1 else ['']
+    sim = Simulator(names, speed, latency = latency)
+    directory = tempfile.mkdtemp(prefix='rp_auto_bench_')
+    setup = os.path.join(directory, 'rp_auto_setup')
+    sim.WriteSetup(setup, serverport = serverport)
+    runtime, startup = BenchStartup(setup)
+    results = {"version": FORMAT_VERSION, "time": time.time(), "host": platform.node(), "python": platform.python_version(),
+               "params": {"speed": speed, "stations": stations, "repeat": repeat, "passes": passes, "requests": requests, "latency": latency},
+               "startup": startup}
+    results["drivers"] = BenchDrivers(runtime, repeat)
+    results["passes"] = BenchPasses(runtime, passes)
+    results["fill"] = BenchFill(runtime, sim, filltimeout)
+    results["server"] = BenchServer(serverport, requests)
+    runtime.docleanexit = True  # no "unexpected abort" notification when the benchmark finishes
+    return results
+
+def _latencies( results, prefix = '' ):
+    # flattens all latency figures into {"drivers.pump.p90": seconds, ...}
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict): flat.update(_latencies(value, prefix + key + '.'))
+        elif key in ('p50', 'p90', 'p99') or prefix + key == 'startup': flat[prefix + key] = value
+    return flat
+
+def Compare( results, baseline, tolerance ):
+    """Returns a list of (name, baseline, current) for every latency that grew by more than tolerance (relative)."""
+    current, previous = _latencies(results), _latencies(baseline)
+    return [(name, previous[name], current[name]) for name in sorted(current)
+            if name in previous and current[name] > previous[name]*(1.0 + tolerance)]
+
+def main( argv ):
+    parser = argparse.ArgumentParser(prog=argv[0], description='Benchmarks the LN2 controller against simulated devices.')
+    parser.add_argument('output', help='file to write the results to')
+    parser.add_argument('--baseline', help='results of an earlier run; exits with 2 if a latency got worse')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative latency increase that counts as a regression')
+    parser.add_argument('--speed', type=float, default=60.0, help='simulated seconds per real second')
+    parser.add_argument('--stations', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=50, help='round trips per driver')
+    parser.add_argument('--passes', type=int, default=50, help='control passes per station')
+    parser.add_argument('--requests', type=int, default=1000, help='server requests')
+    parser.add_argument('--latency', type=float, default=0.0, help='reply latency of the simulated devices in seconds')
+    parser.add_argument('--port', type=int, default=11911, help='server port used during the benchmark')
+    args = parser.parse_args(argv[1:])
+    results = Run(args.speed, args.stations, args.repeat, args.passes, args.requests, args.latency, args.port)
+    with open(args.output, 'w') as f:     # not stdout, the controller logs there
+        json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        regressions = Compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            sys.stderr.write('{}: {:.6f} s -> {:.6f} s\n'.format(name, before, after))
+        if regressions: return 2
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,55 @@
+import os
+import json
+import time
+import threading
+import logging
+
+_lock = threading.Lock()    # several pumps may share one file, and are set up at the same time
+
+class CalibrationCache:
+    """Sensor offsets of every pump seen so far, stored in a JSON file and keyed by the identity of the pump.
+
+    Every entry holds the offsets, the time they were first stored and the time they were last
+    confirmed by reading them back from the pump, e.g.
+    {"LN2-PUMP 0815": {"offsets": {"pumpsensoroffset": 145, ...}, "stored": "2017-04-15 00:00:08", "validated": "2017-04-16 08:00:11"}}
+
+    Args:
+        path: Name of the file, created on the first Put().
+    """
+
+    def __init__( self, path, loggername = "" ):
+        self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
+        self.path = path
+
+    def _load( self ):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except IOError:
+            return {}   # nothing stored yet
+        except ValueError as err:
+            self.logger.warning('Ignoring unreadable calibration file %s: %s', self.path, err)
+            return {}
+
+    def Get( self, identity, names ):
+        """Returns the stored offsets of a pump as a dictionary, or None unless all of names are stored for it."""
+        with _lock:
+            entry = self._load().get(identity)
+        if not entry or any(name not in entry.get("offsets", {}) for name in names): return None
+        return dict((name, entry["offsets"][name]) for name in names)
+
+    def Put( self, identity, offsets ):
+        """Stores the offsets of a pump that have just been read from it, and marks them as validated now."""
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        with _lock:
+            entries = self._load()
+            entry = entries.get(identity, {})
+            if entry.get("offsets") != offsets: entry = {"offsets": dict(offsets), "stored": now}
+            entry["validated"] = now
+            entries[identity] = entry
+            try:
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(entries, f, indent=1, sort_keys=True)
+                os.replace(self.path + '.tmp', self.path)   # readers never see a half-written file
+            except (IOError, OSError) as err:
+                self.logger.warning('Could not store calibration of <%s>: %s', identity, err)
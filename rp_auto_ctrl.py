@@ -1,17 +1,23 @@
 ﻿import sys
-import ConfigParser
+try:
+    import configparser as ConfigParser
+except ImportError:
+    import ConfigParser
 import time
-import datetime
+import heapq
+import atexit
+import threading
 import logging
-import logging.handlers
 import os
 
-from rp_auto_mod_scale import ModuleScale
+from concurrent.futures import ThreadPoolExecutor
+
 from rp_auto_mod_modem import ModuleModem
 from rp_auto_mod_server import ModuleServer
-from rp_auto_mod_pump import ModulePump
-from rp_auto_mod_mmeter import ModuleMMeter
-from rp_auto_smswarning import SmsWarning
+from rp_auto_station import Station
+from rp_auto_metrics import SharedRegistry
+from rp_auto_logging import SetupLogging
+from rp_auto_discovery import AUTO, Discover, Claim
 
 class _config:
 
@@ -19,175 +25,133 @@ class _config:
     
     def __init__( self, path ):
         self._setting = ConfigParser.ConfigParser()
-        self._setting.read('rp_auto_default.ini')   # initialize settings structure with defaults
+        self._setting.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rp_auto_default.ini'))   # initialize settings structure with defaults
         self._setting.read(path + '.ini')
+        self._ports = {}    # ports found by discovery, (section, station) -> {option: port}
         
-    def GetSetup( self, name ):
-        return dict(self._setting.items(name))
+    def GetSetup( self, name, station = '' ):
+        # settings of a station, e.g. [pump:det1], override the common ones in [pump]
+        setup = dict(self._setting.items(name))
+        if station and self._setting.has_section(name + ':' + station):
+            setup.update(self._setting.items(name + ':' + station))
+        setup.update(self._ports.get((name, station), {}))
+        return setup
+
+    def SetPort( self, name, station, option, port ):
+        # replaces a port setting of "auto" by the port the device was found at
+        self._ports.setdefault((name, station), {})[option] = port
+
+    def GetStations( self ):
+        # every [pump:<name>] section defines a station; without any, the plain sections make up a single unnamed one
+        stations = [section.split(':', 1)[1] for section in self._setting.sections() if section.startswith('pump:')]
+        return stations or ['']
 
 class _runtime:
 
-    def __init__( self ):
-        # get config options from file
-        self.config = _config('rp_auto_setup')
+    QUITCHECK = 1.0     # seconds between two looks for the quit file while no station is due
+
+    def __init__( self, setup = 'rp_auto_setup' ):
+        # get config options from file, setup is its name without .ini
+        self.config = _config(setup)
         # set up the logging system before everything else, so stuff can log its initialization
         self.logopts = self.config.GetSetup('logging')
         self.logger = logging.getLogger(self.logopts["loggername"] or 'rp_auto_ctrl')
         self.logger.setLevel(logging.DEBUG)
-        logFormatter = logging.Formatter("%(asctime)s %(levelname)-5.5s: [%(module)-18.18s] %(message)s",datefmt="%Y-%m-%d %H:%M:%S")
-        logFileHandler = logging.handlers.TimedRotatingFileHandler(self.logopts['logfile'], when='midnight', backupCount=int(self.logopts['keeplogs']))   # \ch: output to log file, new file is created for every day, files are retained for 31 days
-        logFileHandler.setFormatter(logFormatter)
-        self.logger.addHandler(logFileHandler)
-        logStreamHandler = logging.StreamHandler(sys.stdout)   # also output log to stdout
-        logStreamHandler.setFormatter(logFormatter)
-        logStreamHandler.setLevel(logging.INFO) # don't print debug info to stdout
-        self.logger.addHandler(logStreamHandler)
-        # set up the actual components
-        self.modem = ModuleModem(**self.config.GetSetup('modem'), loggername = self.logger.name)
-        self.scale = ModuleScale(**self.config.GetSetup('scale'), loggername = self.logger.name)
-        self.pump = ModulePump(**self.config.GetSetup('pump'), loggername = self.logger.name)
-        self.server = ModuleServer(**self.config.GetSetup('server'), loggername = self.logger.name)
-        self.mmeter = ModuleMMeter(**self.config.GetSetup('mmeter'), loggername = self.logger.name)
-        self.server.GatherModuleData = self._gather_data
+        # output to log file and stdout through a queue, new file is created for every day, files are retained for keeplogs days
+        SetupLogging(self.logger, self.logopts['logfile'], self.logopts['keeplogs'], bool(int(self.logopts['compresslogs'])))
+        # find the devices whose port is "auto"
+        names = self.config.GetStations()
+        self._discover(names)
+        # initialize the modem and the devices of all stations at the same time, they do not depend on each other
+        with ThreadPoolExecutor(max_workers=1 + len(names)) as startup:
+            modem = startup.submit(ModuleModem, **self.config.GetSetup('modem'), loggername = self.logger.name)
+            devices = [startup.submit(Station.OpenDevices, name, self.config, self.logger.name) for name in names]
+            self.server = ModuleServer(**self.config.GetSetup('server'), loggername = self.logger.name)
+            self.server.Metrics = SharedRegistry()  # timings and counters of drivers, stages and short mails, served by SVR:METRICS
+            self.modem = modem.result()
         # get other parameters
         self.runparams = self.config.GetSetup('runparams')
-        # process parameters
-        try:
-            self.lnlevel2fillings = float(self.runparams["dewarvolume"])/float(self.runparams["dewarheight"])*0.808/(float(self.runparams["maxweight"])-float(self.runparams["minweight"])) # scale ln2 level to total dewar volume, convert that to kg's (LN2 density is 0.808) and divide by "weight per pumping process"
-        except Exception as err:
-            self.logger.warning('Could not determine level-to-fillings conversion factor, setting it to 1: ' + str(err))
-            self.lnlevel2fillings = 1.0
+        # set up one station per dewar -- a station whose devices fail is left out, so it does not take the others down with it
+        self.stations = []
+        for name, opened in zip(names, devices):
+            try:
+                self.stations.append(Station(name, self.config, self.modem, self.server, devices = opened.result(), loggername = self.logger.name))   # each with a pool of its own, stations are polled concurrently
+            except Exception as err:
+                self.logger.error('%sCould not set up station, leaving it out: %s', '[' + name + '] ' if name else '', err)
+                if len(names) > 1: self.modem.SendSMS(self.logopts['address'], '[' + name + '] Could not set up station, leaving it out: ' + str(err))
+        if not self.stations: raise Exception('No station could be set up')
+        self.server.DefaultStation = self.stations[0].name     # serves commands without @station, so single-station clients keep working
+        self.logger.info('Controlling %s station(s)', len(self.stations))
         # initialize some other stuff
         self.docleanexit = False   # is queried to determine whether shutdown is intentional (i.e. user-initiated). Else, logopts["address"] is notified
         self.modem.RegisterExitCallback(self._sms_exitcallback)
-        
-        try:
-            self.pollinterval = float(self.runparams["pollinterval"])
-            if self.pollinterval<1.0:
-                self.logger.warning('pollinterval has to be at least 1.0 s')
-                self.pollinterval = 1.0
-        except Exception as err:
-            self.logger.warning('Could not set polling interval, setting it to 1.0 s: ' + str(err))
-            self.pollinterval = 1.0
-        try:
-            self.pollintwhilepumping = float(self.runparams["pollintwhilepumping"])
-            if self.pollintwhilepumping<1.0: 
-                self.logger.warning('pollintwhilepumping has to be at least 1.0 s')
-                self.pollintwhilepumping = 1.0
-        except Exception as err:
-            self.logger.warning('Could not set pump polling interval, setting it to ' +  "{:.1f}".format(self.pollinterval) + ' s: ' + str(err))
-            self.pollintwhilepumping = self.pollinterval
-        # set up sms warning objects
-        warn_interval = float(self.runparams['smswarninterval'])
-        warn_survive = float(self.runparams['smswarnsurvive'])
-        self.WarnGetterV = SmsWarning("GetterpumpVTooHigh", self.modem, self.logopts['address'], warn_interval, warn_survive, loggername = self.logger.name)
-        self.WarnPumpStart = SmsWarning("PumpNotStarted", self.modem, self.logopts['address'], warn_interval, warn_survive, loggername = self.logger.name)
-        self.WarnPumpNoLN2 = SmsWarning("DewarEmpty", self.modem, self.logopts['address'], warn_interval, warn_survive, loggername = self.logger.name)
+        self.modem.RegisterStatusCallback(self._sms_statuscallback, self.logopts['address'])  # recipients may ask for the current state by sending "STATUS"
+        # the devices were opened in parallel, so the order of their exit handlers is down to chance -- registered last, this one runs
+        # first and stops the pumps before the modem may spend up to sendtimeout on flushing its queue
+        atexit.register(self._on_exit)
     
+    def _discover( self, names ):
+        # probe the serial ports for every device configured with port "auto", and bind it to the first one that answers like it
+        options = [('modem', '', 'port')] + [(kind, name, option) for name in names for kind, option in (('pump', 'tty'), ('scale', 'port'), ('mmeter', 'port'))]
+        wanted = [(kind, name, option) for kind, name, option in options if self.config.GetSetup(kind, name)[option] == AUTO]
+        if not wanted: return
+        fixed = ['/dev/' + self.config.GetSetup(kind, name)[option] for kind, name, option in options if (kind, name, option) not in wanted]
+        discovery = self.config.GetSetup('discovery')
+        found = Discover(discovery['ports'], sorted(set(kind for kind, name, option in wanted)), float(discovery['timeout']), fixed, loggername = self.logger.name)
+        for kind, name, option in wanted:
+            port = Claim(found, kind, self.config.GetSetup(kind, name).get('identity', ''))
+            self.logger.info('Using %s on %s%s', kind, port, ' for station ' + name if name else '')
+            self.config.SetPort(kind, name, option, port)
+
     def _run( self ):
-        self.lastcheck = datetime.datetime.now()
-        self.logger.info('LN2 control started')
-        self.value_pump = self.pump.GetPumpState()     # needs to be initialized here so the external shutdown detection works
-        polltime = self.pollinterval
-        loopfails = 0   # counts number of consecutive failed loop passes
-        while True:
-            try:
+        # poll every station when it is due, on a worker of its own -- a slow pass of one station never delays the pass of another
+        # that is due, e.g. to stop its pump
+        self._due = [(time.time(), n, station) for n, station in enumerate(self.stations)]
+        heapq.heapify(self._due)
+        self._polling = 0   # number of passes in progress
+        self._cond = threading.Condition()
+        with ThreadPoolExecutor(max_workers=len(self.stations)) as pollers, self._cond:
+            while self._due or self._polling:
                 # offer a way to gracefully shut the program down
                 if os.path.isfile(self.runparams["quitfile"]):
-                    self.logger.info('Shutdown indicator file ' + self.runparams["quitfile"] + ' found, terminating...')
+                    self.logger.info('Shutdown indicator file %s found, terminating...', self.runparams["quitfile"])
                     self.docleanexit = True
                     os.rename(self.runparams["quitfile"], self.runparams["quitfile"] + '_bak') # rename indicator file
                     break
-
-                # DEBUG: provoke the emission of a warning by creating a file
-                if os.path.isfile(self.runparams["provokefile"]):
-                    self.logger.info('Warning provokation file detected. Emitting...')
-                    self.WarnUser.Emit('This is a debug warning provoked by the user.')
-                    
-                # check whether pump was shut down from aside, i.e. the program has a different on/off state stored than what is current
-                # need to make this the only time that PumpState is queried for each loop. If we do it again when checking all the other components,
-                # the pump state may have changed in the couple of seconds it takes the serial commands to complete. This change would then not be detected
-                # in the next loop because the stored value_pump is then already False
-                if self.value_pump != self.pump.GetPumpState():
-                    self.logger.warning('Inconsistent pump state detected: should be {}, is {}'.format(self.value_pump, not self.value_pump))
-                    self.modem.SendSMS(self.logopts['address'], 
-                                       'Inconsistent pump state detected: should be {}, is {}.{}'.format(self.value_pump,
-                                                                                                         not self.value_pump,
-                                                                                                         " Shutting down." if self.value_pump else ""
-                                                                                                        )
-                                      )
-                    if self.value_pump:
-                        # pump was shut OFF from aside, so value_pump is still true despite the pump being turned off
-                        self.logger.info("Pump was shut down, terminating...")
-                        self.docleanexit = True
-                        break
-                    else:
-                        # pump was turned ON from aside, but value_pump is still false
-                        self.value_pump = not self.value_pump  # correct the stored state of the pump
-                        polltime = self.pollintwhilepumping # switch to (usually shorter) poll interval
-                
-                # update the stored system state
-                self.value_mmeter = self.mmeter.GetValue()
-                self.value_scale = self.scale.GetValue()
-                self.level_pump = self.pump.GetPumpLevel()
-                
-                # toggle pump if necessary
-                if self.value_scale <= float(self.runparams["minweight"]):
-                    # start the pump if it's not yet running
-                    if not self.value_pump:
-                        if self.level_pump>0:
-                            self.logger.info('Lower boundary crossing (' + str(self.value_scale) + ') detected, attempting to start pump')
-                            try:
-                                self.pump.StartPump()
-                            except Exception as err:
-                                self.logger.warning('Unable to start pump: ' + str(err))
-                                self.WarnPumpStart.Emit('Could not start pump: ' + str(err))
-                            else:
-                                self.value_pump = True  # so the external turn-on detection is not triggered
-                            self.lastcheck = datetime.datetime.now()
-                            polltime = self.pollintwhilepumping # switch to (usually shorter) poll interval
-                        
-                            self.modem.SendSMS(self.logopts['address'],time.strftime("%Y-%m-%d %H:%M",time.gmtime()) + \
-                            ': Scale value is ' + str(self.value_scale) + \
-                            ' kg, starting LN2 pump. Dewar level is ' + "{:.1f}".format(self.level_pump) + \
-                            ' cm, so about ' +  "{:.1f}".format(self.level_pump*self.lnlevel2fillings) + \
-                            ' LN2 fillings remaining. Getter pump voltage is ' + str(self.value_mmeter) + ' ' + self.mmeter.OutUnit)    # send notification
-                        else:
-                            self.WarnPumpNoLN2.Emit('Unable to start pump because dewar is empty')
-                elif self.value_scale >= float(self.runparams["maxweight"]):
-                    # stop the pump if it's still running
-                    if self.value_pump:
-                        self.logger.info('Upper boundary crossing (' + str(self.value_scale) + ') detected, attempting to stop pump')
-                        self.pump.StopPump()
-                        self.value_pump = False  # so the external shutdown detection is not triggered
-                        polltime = self.pollinterval # reset polltime
-                        self.modem.SendSMS(self.logopts['address'],time.strftime("%Y-%m-%d %H:%M",time.gmtime()) + ': Scale value is ' + str(self.value_scale) + ' kg, stopping LN2 pump. Getter pump voltage is ' + str(self.value_mmeter) + ' ' + self.mmeter.OutUnit)
-                
-                # check getter pump voltage
-                if abs(self.value_mmeter)>float(self.runparams["maxgettervolt"]):
-                    self.logger.warning('Getter pump voltage above maximum level (' + self.runparams["maxgettervolt"] + '): ' + str(self.value_mmeter))
-                    self.WarnGetterV.Emit('Excessive getter pump voltage, is ' + str(self.value_mmeter) + ', should be less than ' + self.runparams["maxgettervolt"])
-                
-            except Exception as err:
-                loopfails += 1
-                self.logger.warning("System polling failed for the {}th time: {}".format(loopfails, str(err)))
+                # go to sleep to avoid log spamming, but look for the quit file every QUITCHECK seconds
+                if not self._due or self._due[0][0] > time.time():
+                    self._cond.wait(min(self._due[0][0] - time.time(), self.QUITCHECK) if self._due else self.QUITCHECK)
+                    continue
+                due, n, station = heapq.heappop(self._due)
+                self._polling += 1
+                pollers.submit(self._poll, n, station)
             else:
-                # reset fail counter once a loop goes through
-                loopfails = 0
-            
-            # if polling the state fails unexpectedly too often, shut the whole system down
-            if loopfails >= self.runparams["maxpollfails"]:
-                self.logger.warning("System polling failed too often, shutting down")
-                self.modem.SendSMS(self.logopts['address'], 'System polling failed {} times, shutting down'.format(loopfails))
+                # every station has stopped on its own, and has notified about it
                 self.docleanexit = True
-                break
-            
-            # go to sleep to avoid log spamming
-            time.sleep(polltime)
 
-    def _gather_data( self ):
-        return 'OK' + '\t' + str(self.value_scale) + '\t' + str(self.value_pump) + '\t' + str(self.level_pump) + '\t' + str(self.value_mmeter) + '\t' + str(self.lastcheck)
-        
+    def _poll( self, n, station ):
+        # one pass of a station, which is due again polltime seconds after it finished
+        polltime = station.pollinterval
+        try:
+            polltime = station.Poll()
+        except Exception as err:
+            self.logger.warning('%sPass failed: %s', station.tag, err)
+        finally:
+            with self._cond:
+                self._polling -= 1
+                if not station.Done: heapq.heappush(self._due, (time.time() + polltime, n, station))
+                self._cond.notify()
+
+    def _sms_statuscallback( self ):
+        return '\n'.join(station.Status() for station in self.stations)
+
+    def _on_exit( self ):
+        for station in self.stations:
+            try:
+                if station.pump.GetPumpState(): station.pump.StopPump()
+            except Exception as err:
+                self.logger.warning('%sCould not stop pump at exit: %s', station.tag, err)
+
     def _sms_exitcallback( self ):
         if not self.docleanexit:
             self.modem.SendSMS(self.logopts['address'], 'Unexpected LN2 control function abort in progress')
@@ -0,0 +1,175 @@
+import re
+import os
+import glob
+import time
+import select
+import fcntl
+import termios
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+from rp_auto_mod_pump import ModulePump
+
+AUTO = 'auto'   # port setting of a device that is looked for by discovery
+KINDS = ('modem', 'pump', 'scale', 'mmeter')   # order of the probes on a port: the ones that answer a command first, the listening one last
+
+# line settings of the devices that take commands, as used by their drivers
+SETTINGS = {"modem": dict(baudrate = 19200, rtscts = True, dsrdtr = True),
+            "pump": dict(baudrate = 19200, rtscts = False, dsrdtr = False),
+            "scale": dict(baudrate = 9600, rtscts = False, dsrdtr = False)}
+SCALE_READING = re.compile(r'^-?\s*\d+(\.\d*)?\s+[a-zA-Z]+$')  # e.g. "    1.234 kg"
+
+def _exchange( prt, command, done, timeout ):
+    # sends command and collects the reply until done(reply) holds; returns the reply, or None after the timeout
+    prt.flushInput()
+    if command: prt.write(command)
+    deadline = time.time() + timeout
+    buf = b''
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0: return None
+        prt.timeout = remaining
+        buf += prt.read(prt.inWaiting() or 1)
+        if done(buf): return buf
+
+def _open( path, kind, timeout ):
+    return serial.Serial(port = path, bytesize = serial.EIGHTBITS, parity = serial.PARITY_NONE, stopbits = serial.STOPBITS_ONE, timeout = timeout, xonxoff = False,
+                         exclusive = True, **SETTINGS[kind])
+
+def _busy( path ):
+    # whether another process holds the lock the drivers take on their ports, i.e. a controller is using it
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_NOCTTY)
+    except OSError:
+        return True     # cannot be opened at all, no use probing it
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    finally:
+        os.close(fd)    # releases the lock as well
+    return False
+
+def _lines( buf ):
+    return [line.strip().decode('ascii', 'replace') for line in buf.split(b'\n')]
+
+def _probe_modem( path, timeout ):
+    with _open(path, 'modem', timeout) as prt:
+        reply = _exchange(prt, b'AT+CGMI\r', lambda buf: any(line in ('OK', 'ERROR') for line in _lines(buf)), timeout)
+    if reply is None or 'OK' not in _lines(reply): return None
+    answer = [line for line in _lines(reply) if line and line != 'OK' and not line.startswith('AT')]   # skip the echo
+    return answer[0] if answer else None
+
+def _probe_pump( path, timeout ):
+    with _open(path, 'pump', timeout) as prt:
+        reply = _exchange(prt, b'i\r', lambda buf: ModulePump.TERMINATOR in _lines(buf), timeout)
+    if reply is None: return None
+    lines = _lines(reply)
+    if len(lines) < 6 or lines[5] != ModulePump.TERMINATOR: return None   # same check as ModulePump._check_pump
+    return lines[1][9:]
+
+def _probe_scale( path, timeout ):
+    with _open(path, 'scale', timeout) as prt:
+        reply = _exchange(prt, b'w', lambda buf: any(SCALE_READING.match(line) for line in _lines(buf)), timeout)
+    return None if reply is None else ''
+
+def _probe_mmeter( path, timeout ):
+    # the multimeter does not take commands, but sends records of 9 bytes continuously -- wait for one complete record;
+    # its seven bit line is set up through termios, like the fallback of ModuleMMeter, as not every port takes it from PySerial
+    prt = os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_NOCTTY)
+    try:
+        fcntl.flock(prt, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        attr = termios.tcgetattr(prt)
+        attr[2] = termios.CS7 | termios.CREAD | termios.CLOCAL
+        attr[4] = termios.B19200
+        attr[5] = termios.B19200
+        termios.tcsetattr(prt, termios.TCSADRAIN, attr)
+        termios.tcflush(prt, termios.TCIFLUSH)
+        deadline = time.time() + timeout
+        buf = b''
+        while not any(len(record) == 9 for record in buf.split(b'\r\n')[1:-1]):
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([prt], [], [], remaining)[0]: return None
+            buf += os.read(prt, 1024)
+        return ''
+    finally:
+        os.close(prt)
+
+PROBES = {"modem": _probe_modem, "pump": _probe_pump, "scale": _probe_scale, "mmeter": _probe_mmeter}
+
+def ProbePort( path, kinds = KINDS, timeout = 1.0, loggername = "" ):
+    """Asks the device on one serial port what it is, with the handshake of every kind of device in turn.
+
+    Args:
+        path: The port, e.g. '/dev/ttyUSB0'.
+        kinds: The kinds of device to try, out of KINDS.
+        timeout: Seconds to wait for the answer to each handshake.
+
+    Ports are locked while they are probed, and ports locked by someone else, like the drivers of a
+    running controller, are left alone.
+
+    Returns:
+        A tuple (kind, identity), or None if no device answered or the port is in use. The identity
+        is the answer of the pump to "i" or of the modem to +CGMI, and empty for scale and multimeter.
+    """
+    logger = logging.getLogger(loggername or 'rp_auto_ctrl')
+    if _busy(path):
+        logger.debug('Skipping %s, it is in use', path)
+        return None
+    for kind in KINDS:
+        if kind not in kinds: continue
+        try:
+            identity = PROBES[kind](path, timeout)
+        except Exception as err:
+            logger.debug('%s probe failed on %s: %s', kind, path, err)
+            identity = None
+        if identity is not None: return kind, identity
+    return None
+
+def Discover( patterns, kinds = KINDS, timeout = 1.0, exclude = (), loggername = "" ):
+    """Probes all ports matching patterns at the same time and returns the devices found.
+
+    Args:
+        patterns: Glob patterns of the ports to probe, separated by whitespace, e.g. '/dev/ttyUSB*'.
+        kinds: The kinds of device to look for, out of KINDS.
+        timeout: Seconds to wait for the answer to each handshake.
+        exclude: Ports not to touch, e.g. those of devices configured explicitly.
+
+    Returns:
+        A dictionary mapping every kind to a list of (port, identity) it was found at, ordered by
+        port. Ports are given relative to /dev, like the port settings of the drivers.
+    """
+    logger = logging.getLogger(loggername or 'rp_auto_ctrl')
+    paths = sorted(set(path for pattern in patterns.split() for path in glob.glob(pattern)) - set(exclude))
+    logger.info('Looking for %s on %s port(s)...', ', '.join(kinds), len(paths))
+    found = dict((kind, []) for kind in kinds)
+    if not paths: return found
+    with ThreadPoolExecutor(max_workers = len(paths)) as probes:
+        results = list(probes.map(lambda path: ProbePort(path, kinds, timeout, loggername), paths))
+    for path, result in zip(paths, results):
+        if result is None: continue
+        kind, identity = result
+        port = path[len('/dev/'):] if path.startswith('/dev/') else path
+        logger.info('Found %s%s on %s', kind, ' <' + identity + '>' if identity else '', port)
+        found[kind].append((port, identity))
+    return found
+
+def Claim( found, kind, identity = '' ):
+    """Takes the first device of a kind out of the result of Discover() and returns its port.
+
+    Args:
+        found: The result of Discover(); the device is removed from it, so it is not claimed twice.
+        kind: The kind of device, out of KINDS.
+        identity: Only take a device whose identity contains this, e.g. the serial number of a pump.
+
+    Raises:
+        Exception: If no such device was found.
+    """
+    for n, (port, answer) in enumerate(found.get(kind, [])):
+        if identity in answer:
+            del found[kind][n]
+            return port
+    raise Exception('No ' + kind + (' <' + identity + '>' if identity else '') + ' found')
@@ -0,0 +1,112 @@
+import os
+import sys
+import gzip
+import atexit
+import threading
+import logging
+import logging.handlers
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+FORMAT = "%(asctime)s %(levelname)-5.5s: [%(module)-18.18s] %(message)s"    # parsed by rp_auto_logparse, keep the columns
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+MEMBER_SIZE = 262144   # bytes of log per gzip member, rp_auto_logindex seeks to the start of a member
+
+def _compress( path ):
+    # gzip a rotated log next to itself. The temporary file is hidden, as a name that starts with the log's name would count as a backup
+    # in getFilesToDelete(), which matches the date in any dot-separated part, and could be deleted half-written by the next rollover.
+    # Every few hundred kB of whole lines go into a gzip member of their own, which is still read as one stream by gzip and zcat
+    dirname, basename = os.path.split(path)
+    temporary = os.path.join(dirname, '.' + basename + '.gz.tmp')
+    try:
+        with open(path, 'rb') as src, open(temporary, 'wb') as dst:
+            while True:
+                block = src.read(MEMBER_SIZE)
+                if not block: break
+                dst.write(gzip.compress(block + src.readline()))
+        os.rename(temporary, path + '.gz')
+        os.remove(path)
+    except (IOError, OSError) as err:
+        logging.getLogger('rp_auto_ctrl').warning('Could not compress %s: %s', path, err)
+
+class BufferedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """TimedRotatingFileHandler that writes through a large buffer and compresses rotated files in the background.
+
+    The buffer is not flushed after every record, but by the QueueListener once it has no more
+    records waiting, so a burst of log lines costs one write.
+    """
+
+    BUFFER_SIZE = 65536
+
+    def __init__( self, filename, when = 'midnight', backupCount = 0, compress = True ):
+        logging.handlers.TimedRotatingFileHandler.__init__(self, filename, when = when, backupCount = backupCount)
+        if compress: self.rotator = self._rotate
+
+    def _open( self ):
+        return open(self.baseFilename, self.mode, buffering = self.BUFFER_SIZE, encoding = self.encoding)
+
+    def flush( self ):
+        pass    # see Flush()
+
+    def Flush( self ):
+        logging.StreamHandler.flush(self)
+
+    def _rotate( self, source, dest ):
+        os.rename(source, dest)
+        thread = threading.Thread(target = _compress, args = (dest,))
+        thread.daemon = True
+        thread.start()
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare( self, record ):
+        # leave formatting to the listener thread -- the records never leave this process, so they need not be made picklable
+        return record
+
+class _BatchingListener(logging.handlers.QueueListener):
+
+    def dequeue( self, block ):
+        try:
+            return self.queue.get(False)
+        except queue.Empty:
+            self.Flush()    # caught up, write out what has been buffered before waiting for more
+            return self.queue.get(block)
+
+    def Flush( self ):
+        for handler in self.handlers: getattr(handler, 'Flush', handler.flush)()
+
+    def stop( self ):
+        logging.handlers.QueueListener.stop(self)
+        self.Flush()
+
+def SetupLogging( logger, logfile, keeplogs, compress = True ):
+    """Sends the records of logger to a rotating log file and stdout through a queue.
+
+    The calling threads only put the unformatted record on the queue. Formatting, writing and the
+    midnight rollover happen on the listener thread, so they add nothing to the control loop.
+
+    Args:
+        logger: The logger to set up, e.g. logging.getLogger('rp_auto_ctrl').
+        logfile: Name of the log file; a new one is started every midnight.
+        keeplogs: Number of rotated files to keep.
+        compress: Gzip rotated files, on a thread of their own.
+
+    Returns:
+        The started QueueListener, which is stopped at exit.
+    """
+    formatter = logging.Formatter(FORMAT, datefmt = DATEFMT)
+    fileHandler = BufferedRotatingFileHandler(logfile, when = 'midnight', backupCount = int(keeplogs), compress = compress)
+    fileHandler.setFormatter(formatter)
+    streamHandler = logging.StreamHandler(sys.stdout)   # also output log to stdout
+    streamHandler.setFormatter(formatter)
+    streamHandler.setLevel(logging.INFO)    # don't print debug info to stdout
+    records = queue.Queue()
+    listener = _BatchingListener(records, fileHandler, streamHandler, respect_handler_level = True)
+    logger.addHandler(_QueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop)  # registered before the devices, so their last words at exit are still written
+    return listener
@@ -0,0 +1,184 @@
+import os
+import glob
+import zlib
+import struct
+import gzip
+import contextlib
+
+from rp_auto_logparse import LogFiles, ParseLine, ParseTime, ShortLevels
+
+# sidecar layout: one (bucket start time, byte offset) entry per time bucket, then one (compressed offset,
+# decompressed offset) entry per gzip member, followed by a trailer with the bucket width, the number of
+# indexed bytes, the size and inode of the log file, the number of members and the first bytes of the file
+ENTRY = struct.Struct('<dQ')
+MEMBER = struct.Struct('<QQ')
+TRAILER = struct.Struct('<dQQQQ32s')
+
+def _open_binary( name ):
+    # byte offsets are only meaningful on the undecoded stream
+    if name.endswith('.gz'):
+        return gzip.open(name, 'rb')
+    return open(name, 'rb')
+
+def _members( name ):
+    # (compressed offset, decompressed offset) of every member of a gzip file; rp_auto_logging writes a new one every few
+    # hundred kB, so a seek only has to decompress from the start of the member it lands in
+    members = []
+    with open(name, 'rb') as f:
+        raw = out = 0
+        stream, pending = None, b''
+        while True:
+            chunk = pending or f.read(65536)
+            pending = b''
+            if not chunk: break
+            if stream is None:
+                members.append((raw, out))
+                stream = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                out += len(stream.decompress(chunk))
+            except zlib.error:
+                break   # trailing garbage, gzip.open stops there as well
+            if stream.eof:
+                pending = stream.unused_data
+                stream = None
+            raw += len(chunk) - len(pending)
+    return members
+
+class LogIndex:
+    """Sidecar index of byte offsets per time bucket for one log file.
+
+    The index is stored next to the log as .<logfile>.idx -- the leading dot keeps it from being
+    counted as a rotated log by TimedRotatingFileHandler. It is built lazily on the first query
+    and extended incrementally afterwards, so a log that is still being written only has its new
+    lines scanned. Offsets of gzipped files refer to the decompressed stream; the index also
+    records where each gzip member starts, so Open() only decompresses from there.
+
+    The index is thrown away when the log file is not the one it was built for any more, e.g.
+    after the midnight rollover replaced it by a new one, which is told by inode and first bytes.
+    """
+
+    def __init__( self, path, bucket = 60.0 ):
+        self.path = path
+        self.idxpath = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.idx')
+        self.bucket = float(bucket)
+        self.entries = []   # (bucket start time, offset of its first line), ascending
+        self.members = []   # (compressed offset, decompressed offset) of every gzip member, empty for plain files
+        self.indexed = 0    # number of bytes of the log covered by the index
+        self._load()
+
+    def _identity( self ):
+        # size, inode and first bytes of the log file
+        with open(self.path, 'rb') as f:
+            return os.fstat(f.fileno()).st_size, os.fstat(f.fileno()).st_ino, f.read(TRAILER.size - struct.calcsize('<dQQQQ'))
+
+    def _load( self ):
+        try:
+            with open(self.idxpath, 'rb') as f:
+                data = f.read()
+            bucket, indexed, size, inode, nmembers, head = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+            current = self._identity()
+        except (IOError, OSError, struct.error):
+            return
+        body = len(data) - TRAILER.size - nmembers*MEMBER.size
+        if body < 0 or body % ENTRY.size: return     # written in a different layout
+        if bucket != self.bucket or size > current[0] or inode != current[1]: return   # different bucket width, or the log was replaced
+        if head.rstrip(b'\0') != current[2][:len(head.rstrip(b'\0'))]: return     # the inode was reused by a new log
+        self.entries = [ENTRY.unpack_from(data, n) for n in range(0, body, ENTRY.size)]
+        self.members = [MEMBER.unpack_from(data, n) for n in range(body, body + nmembers*MEMBER.size, MEMBER.size)]
+        self.indexed = indexed
+
+    def _save( self ):
+        size, inode, head = self._identity()
+        with open(self.idxpath + '.tmp', 'wb') as f:
+            for entry in self.entries: f.write(ENTRY.pack(*entry))
+            for member in self.members: f.write(MEMBER.pack(*member))
+            f.write(TRAILER.pack(self.bucket, self.indexed, size, inode, len(self.members), head))
+        os.rename(self.idxpath + '.tmp', self.idxpath)   # replace atomically, so a reader never sees a half-written index
+
+    def Update( self ):
+        """Indexes all lines appended since the last update."""
+        if self.path.endswith('.gz'):
+            if self.indexed: return     # compressed files are never appended to
+            self.members = _members(self.path)
+        elif self.indexed >= os.path.getsize(self.path): return
+        with _open_binary(self.path) as f:
+            f.seek(self.indexed)
+            offset = self.indexed
+            last = self.entries[-1][0] if self.entries else None
+            for line in f:
+                if not line.endswith(b'\n'): break  # incomplete last line, pick it up next time
+                try:
+                    bucket = ParseTime(line.decode('ascii', 'replace')) // self.bucket * self.bucket
+                except ValueError:
+                    bucket = None   # continuation line, e.g. of a multi-line message
+                if bucket is not None and bucket != last:
+                    self.entries.append((bucket, offset))
+                    last = bucket
+                offset += len(line)
+            self.indexed = offset
+        self._save()
+
+    def Seek( self, start ):
+        """Returns the byte offset from which all lines logged at or after start can be found."""
+        lo, hi = 0, len(self.entries)
+        while lo < hi:  # last bucket that starts at or before start
+            mid = (lo + hi) // 2
+            if self.entries[mid][0] <= start: lo = mid + 1
+            else: hi = mid
+        return self.entries[lo - 1][1] if lo else 0
+
+    @contextlib.contextmanager
+    def Open( self, offset ):
+        """Opens the log in binary mode, positioned at the given offset of the (decompressed) stream."""
+        if not self.members:
+            with _open_binary(self.path) as f:
+                f.seek(offset)
+                yield f
+            return
+        raw, out = [member for member in self.members if member[1] <= offset][-1]
+        with open(self.path, 'rb') as f:
+            f.seek(raw)
+            with gzip.GzipFile(fileobj=f, mode='rb') as g:
+                g.seek(offset - out)    # decompresses the start of this member only
+                yield g
+
+def Prune( path ):
+    """Removes the index files of logs that no longer exist, e.g. of rotated logs that have been compressed or deleted."""
+    directory, name = os.path.dirname(path), os.path.basename(path)
+    for idxpath in glob.glob(os.path.join(directory, '.' + glob.escape(name) + '*.idx')):
+        if not os.path.exists(os.path.join(directory, os.path.basename(idxpath)[1:-len('.idx')])):
+            try:
+                os.remove(idxpath)
+            except OSError:
+                pass    # removed by another reader in the meantime
+
+def Query( path, start, end, levels = None, modules = None, bucket = 60.0 ):
+    """Yields (time, level, module, message) for all lines logged between start and end.
+
+    The log file at path and its rotated predecessors are searched. Every file is only read from
+    the index bucket containing start, and reading stops at the first line past end. Rotated files
+    are gzipped in members of a few hundred kB, so the work scales with the size of the result
+    plus at most one member per file, rather than with the size of the archive.
+
+    Args:
+        path: Name of the current log file, e.g. "rp_auto_log.txt".
+        start: First time to include, in seconds since the epoch.
+        end: Time up to which lines are included (exclusive).
+        levels: If given, only lines with one of these levels, e.g. "WARNING", are returned.
+        modules: If given, only lines logged by one of these modules, e.g. "rp_auto_mod_pump", are returned.
+    """
+    levels = ShortLevels(levels)
+    Prune(path)
+    for name in LogFiles(path):
+        index = LogIndex(name, bucket)
+        index.Update()
+        if not index.entries or index.entries[0][0] >= end or index.entries[-1][0] + bucket <= start: continue
+        with index.Open(index.Seek(start)) as f:
+            for line in f:
+                record = ParseLine(line.decode('utf-8', 'replace'))
+                if record is None: continue
+                if record[0] >= end: break
+                if record[0] < start: continue
+                if levels and record[1] not in levels: continue
+                if modules and record[2] not in modules: continue
+                yield record
@@ -0,0 +1,118 @@
+import sys
+import os
+import re
+import glob
+import gzip
+import time
+
+from array import array
+
+# Log line layout, as set up in rp_auto_logging:
+# 2017-04-15 00:00:08 DEBUG: [rp_auto_mod_scale ] Converted value to -3.14
+# date, warn level and module name have fixed widths
+DATE = slice(0, 19)
+LEVEL = slice(20, 25)
+MODULE = slice(28, 46)
+MESSAGE = slice(48, None)
+
+ROTATED = re.compile(r'\.(\d{4}-\d{2}-\d{2})(\.gz)?$')    # suffix of files rotated by TimedRotatingFileHandler
+
+def LogFiles( path ):
+    """Returns the log file at path and all of its rotated (and possibly gzipped) predecessors, oldest first."""
+    rotated = []
+    for name in glob.glob(path + '.*'):
+        m = ROTATED.match(name[len(path):])
+        if m: rotated.append((m.group(1), name))
+    retval = [name for day, name in sorted(rotated)]
+    if os.path.isfile(path): retval.append(path)
+    return retval
+
+def OpenLog( name ):
+    if name.endswith('.gz'):
+        return gzip.open(name, 'rt', errors='replace')
+    return open(name, 'r', errors='replace')
+
+_hours = {}     # epoch time of the start of every hour seen so far, keyed by "YYYY-MM-DD HH"
+
+def ParseTime( line ):
+    """Converts the timestamp at the start of a log line to seconds since the epoch."""
+    hour = line[0:13]
+    start = _hours.get(hour)
+    if start is None:
+        start = _hours[hour] = time.mktime((int(line[0:4]), int(line[5:7]), int(line[8:10]), int(line[11:13]), 0, 0, 0, 0, -1))
+    return start + int(line[14:16])*60 + int(line[17:19])
+
+def ParseLine( line ):
+    """Splits one log line into (time, level, module, message), or returns None if it does not match the layout."""
+    if len(line) < 48 or line[19] != ' ' or line[27] != '[':
+        return None
+    try:
+        timestamp = ParseTime(line)
+    except ValueError:
+        return None
+    return timestamp, line[LEVEL].strip(), line[MODULE].strip(), line[MESSAGE].rstrip()
+
+def ShortLevels( levels ):
+    """Returns the level names as they appear in the log, which keeps five characters of them, e.g. "WARNI" for "WARNING"."""
+    return set(level[:5] for level in levels) if levels else None
+
+def SplitValue( message ):
+    """Splits a message into its text and the numeric value of its last word, like "Converted value to" and -3.14.
+
+    Returns:
+        A tuple (text, value), or (message, None) if the last word is not a number.
+    """
+    head, sep, tail = message.rpartition(' ')
+    try:
+        return head, float(tail.strip('<>'))
+    except ValueError:
+        return message, None
+
+def Records( paths, levels = None, modules = None ):
+    """Yields (time, level, module, message) for every line of the given files, one line at a time.
+
+    Args:
+        paths: Names of the log files to read, e.g. the result of LogFiles().
+        levels: If given, only lines with one of these levels, e.g. "WARNING", are returned.
+        modules: If given, only lines logged by one of these modules are returned.
+    """
+    levels = ShortLevels(levels)
+    for name in paths:
+        with OpenLog(name) as f:
+            for line in f:
+                record = ParseLine(line)
+                if record is None: continue
+                if levels and record[1] not in levels: continue
+                if modules and record[2] not in modules: continue
+                yield record
+
+def Collect( paths, levels = None, modules = None ):
+    """Extracts all numeric values from the given log files into columns.
+
+    Returns:
+        A dictionary mapping (module, message text) to a dictionary with the columns "time" and
+        "value", both array('d'). Only the columns grow with the input; the files themselves are streamed.
+    """
+    series = {}
+    for timestamp, level, module, message in Records(paths, levels, modules):
+        text, value = SplitValue(message)
+        if value is None: continue
+        columns = series.get((module, text))
+        if columns is None:
+            columns = series[(module, text)] = {"time": array('d'), "value": array('d')}
+        columns["time"].append(timestamp)
+        columns["value"].append(value)
+    return series
+
+def main( argv ):
+    if len(argv) < 2:
+        sys.stderr.write('Usage: ' + argv[0] + ' <logfile> [module ...]\n')
+        return 1
+    series = Collect(LogFiles(argv[1]), modules = argv[2:] or None)
+    for (module, text), columns in sorted(series.items()):
+        values = columns["value"]
+        sys.stdout.write('{}\t{}\t{}\t{}\t{}\n'.format(module, text, len(values), min(values), max(values)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
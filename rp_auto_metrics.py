@@ -0,0 +1,168 @@
+import time
+import math
+import bisect
+import threading
+import functools
+
+# latency buckets in seconds, from a fast in-memory read up to a slow short mail
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Counter:
+
+    def __init__( self ):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def Inc( self, amount = 1 ):
+        with self._lock:
+            self.value += amount
+
+    def _samples( self, name, labels ):
+        return [(name, labels, self.value)]
+
+class Gauge:
+
+    def __init__( self ):
+        self.value = 0.0
+
+    def Set( self, value ):
+        self.value = value
+
+    def _samples( self, name, labels ):
+        return [(name, labels, self.value)]
+
+class Histogram:
+    """Counts observations in fixed buckets, so memory stays the same no matter how many values are observed."""
+
+    def __init__( self, buckets = LATENCY_BUCKETS ):
+        self.bounds = tuple(buckets)
+        self.counts = [0]*(len(self.bounds) + 1)   # the last one counts values above the largest bound
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def Observe( self, value ):
+        n = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[n] += 1
+            self.sum += value
+
+    def Since( self, start ):
+        """Observes the time passed since start, a time.perf_counter() value, and returns the current one."""
+        now = time.perf_counter()
+        self.Observe(now - start)
+        return now
+
+    def _samples( self, name, labels ):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            samples.append((name + '_bucket', labels + (('le', _format(bound)),), cumulative))
+        return samples + [(name + '_sum', labels, total), (name + '_count', labels, cumulative)]
+
+def _format( value ):
+    if value == float('inf'): return '+Inf'
+    if value == float('-inf'): return '-Inf'
+    return repr(float(value)) if not float(value).is_integer() or abs(value) >= 1e15 else str(int(value))
+
+class Registry:
+    """Named metrics with labels, rendered in the Prometheus text exposition format.
+
+    Metrics are created on first use and then looked up by name and labels, so callers on a hot
+    path should keep the returned object instead of asking the registry every time.
+    """
+
+    def __init__( self ):
+        self._families = {}     # name -> (type, help, {labels: metric})
+        self._lock = threading.Lock()
+
+    def _get( self, kind, factory, name, help, labels ):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (kind, help, {})
+            elif family[0] != kind:
+                raise ValueError('Metric ' + name + ' is a ' + family[0])
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def Counter( self, name, help = '', **labels ):
+        return self._get('counter', Counter, name, help, labels)
+
+    def Gauge( self, name, help = '', **labels ):
+        return self._get('gauge', Gauge, name, help, labels)
+
+    def Histogram( self, name, help = '', buckets = LATENCY_BUCKETS, **labels ):
+        return self._get('histogram', lambda: Histogram(buckets), name, help, labels)
+
+    def Render( self ):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            families = [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in sorted(self._families.items())]
+        for name, kind, help, metrics in families:
+            if help: lines.append('# HELP ' + name + ' ' + help.replace('\\', '\\\\').replace('\n', '\\n'))
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for labels, metric in sorted(metrics, key=lambda item: item[0]):
+                for sample, sample_labels, value in metric._samples(name, labels):
+                    lines.append(sample + _labels(sample_labels) + ' ' + _format(value))
+        return '\n'.join(lines) + '\n'
+
+def _labels( labels ):
+    if not labels: return ''
+    return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels) + '}'
+
+def _has_nan( value ):
+    # a reading, or a record of readings, that could not be taken -- fields of a record that were not asked for are None, not NaN
+    if isinstance(value, float): return math.isnan(value)
+    if isinstance(value, tuple): return any(isinstance(x, float) and math.isnan(x) for x in value)
+    return False
+
+def Instrument( driver, methods, registry, **labels ):
+    """Replaces the given methods of a driver object with versions that record their latency.
+
+    Every call is observed in rp_auto_driver_seconds; calls that raise are counted in
+    rp_auto_driver_errors_total, and calls that return NaN readings in rp_auto_driver_nan_total.
+
+    Args:
+        driver: The driver object, e.g. a ModuleScale.
+        methods: Names of the methods to wrap, e.g. ['GetValue'].
+        registry: The Registry to record into.
+        labels: Labels for all metrics, e.g. station='det1', device='scale'.
+    """
+    for method in methods:
+        call = dict(labels, call=method)
+        wrapped = _timed(getattr(driver, method),
+                         registry.Histogram('rp_auto_driver_seconds', 'Duration of driver calls', **call),
+                         registry.Counter('rp_auto_driver_errors_total', 'Driver calls that raised', **call),
+                         registry.Counter('rp_auto_driver_nan_total', 'Driver calls that returned no valid reading', **call))
+        setattr(driver, method, wrapped)
+
+def _timed( f, histogram, errors, nans ):
+    @functools.wraps(f)
+    def wrapper( *args, **kwargs ):
+        start = time.perf_counter()
+        try:
+            retval = f(*args, **kwargs)
+        except Exception:
+            errors.Inc()
+            raise
+        finally:
+            histogram.Since(start)
+        if _has_nan(retval): nans.Inc()
+        return retval
+    return wrapper
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def SharedRegistry( ):
+    """Returns the registry shared by all modules in this process, creating it on first use."""
+    global _shared
+    with _shared_lock:
+        if _shared is None: _shared = Registry()
+        return _shared
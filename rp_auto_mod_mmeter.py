@@ -1,12 +1,16 @@
 import serial
 import os
 import termios
-import re
+import select
+import fcntl
+import threading
 import atexit
 import time
 import sys
 import logging
 
+from rp_auto_ringbuffer import RingBuffer
+
 def write( str ):
     sys.stdout.write( str )
 
@@ -14,30 +18,38 @@ class ModuleMMeter:
     
     _prt = None
     
-    def __init__( self, port, outunit='V', loggername = ""):
+    def __init__( self, port, outunit='V', buffersize=1024, maxage=5.0, loggername = ""):
         self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
         self.logger.info('Initializing multimeter...')
         self.__tty = port
+        self.Samples = RingBuffer(int(buffersize))     # decoded readings, filled continuously by the reader thread
+        self.maxage = float(maxage)     # samples older than this many seconds are considered stale
+        self._lasterror = 'No reading received yet'
         try:
             self._prt = self._open_port('/dev/' + port, 'P') # try PySerial first
             time.sleep(1)
-            if self._prt.inWaiting()<11 or not '\n' in self._prt.read(self._prt.inWaiting()): raise Exception('Unable to contact device')
+            if self._prt.inWaiting()<11 or not b'\n' in self._prt.read(self._prt.inWaiting()): raise Exception('Unable to contact device')
         except Exception as err:
             try:
                 self._prt.close() # make sure that partially-opened port is closed before overwriting the property
             except:
                 pass
-            self.logger.info('PySerial linkup failed, switching to TermIOS: ' + str(err))
+            self.logger.info('PySerial linkup failed, switching to TermIOS: %s', err)
             
             self._prt = self._open_port('/dev/' + port, 'T') # use termios implementation
             
         self.OutUnit = outunit
+        self.DoRun = True   # indicates graceful shutdown to reader thread
+        self._reader = threading.Thread(target=self._wkr_reader)
+        self._reader.daemon = True
+        self._reader.start()
         self.logger.info('Multimeter initialization complete')
 
     def _open_port( self, tty, mode = 'P' ):      # mode='P' for PySerial, 'T' for TermIOS
         if mode == 'T':
-            self.logger.debug('Opening port [' + tty + '] via TermIOS...')
+            self.logger.debug('Opening port [%s] via TermIOS...', tty)
             retval = os.open(tty, os.O_RDWR | os.O_NONBLOCK)
+            fcntl.flock(retval, fcntl.LOCK_EX | fcntl.LOCK_NB)     # the same lock PySerial takes with exclusive = True
             attr = termios.tcgetattr(retval)
             attr[2] = termios.CS7 # sevenbit, no parity, one stopbit
             attr[4] = termios.B19200
@@ -45,7 +57,7 @@ class ModuleMMeter:
             termios.tcsetattr(retval, termios.TCSADRAIN, attr)
             termios.tcflush(retval, termios.TCIFLUSH)
         else: 
-            self.logger.debug('Opening port [' + tty + '] via PySerial...')
+            self.logger.debug('Opening port [%s] via PySerial...', tty)
             retval = serial.Serial( 
                 port = tty,
                 baudrate = 19200,
@@ -55,7 +67,8 @@ class ModuleMMeter:
                 timeout = 1,
                 xonxoff = False,
                 rtscts = False,
-                dsrdtr = False
+                dsrdtr = False,
+                exclusive = True    # locks the port, so another controller or the port discovery keeps off it
             )
             if not retval.isOpen(): retval.open()
             retval.flushInput() # purge input buffer, since device writes continuously to buffer
@@ -65,50 +78,67 @@ class ModuleMMeter:
         #write( '<DONE>\n' )    
         return retval
 
-    def GetValue( self ):
-        self.logger.debug('Getting value from multimeter...')
-        if type(self._prt) is serial.serialposix.Serial:  # pyserial implementation
-            # clear input buffer, then get reading from byte stream -- delimited by b1101 b1010
-            try:
-                self._prt.read(self._prt.inWaiting())
-            except:
-                pass
-            echo = bytearray(self._prt.readline().strip())
+    def _read_chunk( self ):
+        if type(self._prt) is serial.serialposix.Serial:  # pyserial implementation, read() returns after at most one timeout
+            return self._prt.read(self._prt.inWaiting() or 1)
         else:
-            time.sleep(1) # wait a bit for the next transmission to arrive
-            echo = os.read(self._prt,22) # record length is 11 -- read enough that complete record is safely included
-            m = re.findall('([^\r\n]{9})\r',echo) # extract complete records from string reading, into a list of strings
-            if m:
-                echo = bytearray(m[-1]) # return latest record
-            else:
-                self.logger.warning('Unexpected record structure found: ' + echo)
-                return float("nan")
-            
-        self.logger.debug('Received <' + str(echo).strip() + '>')
+            if not select.select([self._prt], [], [], 1.0)[0]: return b''
+            return os.read(self._prt, 1024)
+
+    def _wkr_reader( self ):
+        # the device transmits continuously, so keep decoding records as they arrive -- records are delimited by b1101 b1010
+        buf = b''
+        while self.DoRun:
+            try:
+                buf += self._read_chunk()
+            except Exception as err:
+                if self.DoRun: self.logger.warning('Terminating multimeter reader thread because of an error: %s', err)
+                break
+            records = buf.split(b'\r\n')
+            buf = records.pop()     # keep incomplete record for the next pass
+            for record in records:
+                self._decode(bytearray(record))
+
+    def _decode( self, echo ):
         # check correct length
         if len(echo) != 9:
-            self.logger.warning('Wrong data size received: expected 11, got ' + str(len(echo)))
-            return float("nan")
+            self._lasterror = 'Wrong data size received: expected 11, got ' + str(len(echo) + 2)
+            return
         # parse the reading
         try:
-            retval = parseReading(echo)
+            retval = parseReading(echo, self.logger)
         except Exception as err:
-            self.logger.warning('Failed to convert input to number: ' + str(err))
-            return float("nan")
+            self._lasterror = 'Failed to convert input to number: ' + str(err)
+            return
         # check overload, units
-        if retval["overload"]: 
-            self.logger.warning('Multimeter overload')
-            return float("inf")
-        if retval["unit"] != self.OutUnit:
-            self.logger.warning('Multimeter not in ' + self.OutUnit + ' mode')
+        if retval["overload"]:
+            self._lasterror = 'Multimeter overload'
+            self.Samples.Append(float("inf"))
+        elif retval["unit"] != self.OutUnit:
+            self._lasterror = 'Multimeter not in ' + self.OutUnit + ' mode'
+        else:
+            self.Samples.Append(retval["value"])
+
+    def GetValue( self ):
+        """Returns the latest valid reading without blocking, or NaN if there is no recent one."""
+        self.logger.debug('Getting value from multimeter...')
+        sample = self.Samples.Latest()
+        if sample is None or time.time() - sample[0] > self.maxage:
+            self.logger.warning('No recent multimeter reading: %s', self._lasterror)
             return float("nan")
-        # if everything is ok, return the value
-        self.logger.debug('Converted value to ' + str(retval["value"]))
-        return retval["value"]
+        if sample[1] == float("inf"):
+            self.logger.warning('Multimeter overload')
+        self.logger.debug('Converted value to %s', sample[1])
+        return sample[1]
+
+    def GetStatistics( self, window ):
+        """Returns min, max and mean of the readings from the last window seconds, see RingBuffer.Statistics()."""
+        return self.Samples.Statistics(window)
         
     def _on_exit( self ):
         #write( '** Closing port [' + self._prt.port + ']\n' ) 
-        self.logger.debug('Closing port [/dev/' + self.__tty + ']')
+        self.DoRun = False
+        self.logger.debug('Closing port [/dev/%s]', self.__tty)
         try:
             if type(self._prt) is serial.serialposix.Serial:  # pyserial implementation
                 self._prt.close()
@@ -117,8 +147,9 @@ class ModuleMMeter:
         except OSError:     # if _port_open was executed more than once (because the first call actually did not provide a usable port), _on_exit will try to close the self._prt more than once
             pass
         
-def parseReading(byte_array):
+def parseReading(byte_array, logger = None):
     # takes a 9-byte input array and extracts the actual instrument reading
+    logger = logger or logging.getLogger('rp_auto_ctrl')
     # check for overload
     overload = 0b0001 & byte_array[6] # get overload flag from byte 6 through bitmask
     # read number
@@ -132,14 +163,14 @@ def parseReading(byte_array):
     try:
         opmode = opmode_array[0b1111 & byte_array[5]]
     except Exception as err:
-        self.logger.warning('Failed to determine operation mode: ' + str(err))
+        logger.warning('Failed to determine operation mode: %s', err)
         opmode = ""
     # get range from byte 0. range_array lists decimal value of last digit of reading
     range_array={ "kHz": [1, 1e1, 1e2, 1e3, 1e4], "Ohm": [1e-1, 1, 1e1, 1e2, 1e3, 1e4], "nFarad": [1e-3, 1e-2, 1e-1, 1, 1e1, 1e2, 1e3], "A": [1e-2], "V": [1e-3, 1e-2, 1e-1, 1, 1e-4], "uA": [1e-1, 1], "mA": [1e-2, 1e-1] }
     try:
         value = value * range_array[opmode][0b0111 & byte_array[0]]
     except Exception as err:
-        self.logger.warning('Failed to convert value: ' + str(err))
+        logger.warning('Failed to convert value: %s', err)
         #value=value # assume conversion factor 1
         
     return {"value": value , "unit": opmode, "overload": overload}
@@ -2,27 +2,133 @@
 import atexit
 import time
 import sys
+import re
+import heapq
+import itertools
+import threading
 import logging
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from rp_auto_metrics import SharedRegistry
+
 def write( str ):
     sys.stdout.write( str )
 
+SMS_LENGTH = 160    # maximum number of characters of one short mail
+FINAL_RESULTS = re.compile(r'^(OK|ERROR|NO CARRIER|\+CM[ES] ERROR:.*)$')  # lines that end the response to a command
+URC_PREFIXES = ('+CMTI:', '+CMT:', '+CDS:', '+CDSI:', '+CREG:', '+CBM:', '+CRING:', 'RING', '+WIND:')  # unsolicited result codes
+
+class _Transaction:
+    # a command waiting for its response
+
+    def __init__( self, command, prompt = False ):
+        self.command = command  # command name, e.g. '+CREG', so its own information responses are not taken for URCs
+        self.prompt = prompt    # the '>' prompt ends the response, too
+        self.lines = []
+        self.done = threading.Event()
+
+class _Message:
+    # one short mail waiting in the outbound queue, possibly a digest of several notifications for the same recipient
+
+    def __init__( self, address, text, key, deadline, retries, callback ):
+        self.address = address
+        self.entries = [(text, key, callback)]  # callback is called as callback(address, text, success) once the message is done
+        self.deadline = deadline    # time after which the message is dropped instead of sent
+        self.retries = retries      # number of further attempts after a failed one
+        self.unsent = []    # parts left over from an attempt that failed halfway
+        self.covered = 0    # number of entries contained in the parts that were already composed
+
+    def Merge( self, other ):
+        # entries that were composed into parts already, sent or left over in unsent, stay in front and are not composed again
+        self.entries = self.entries[:self.covered] + other.entries[:other.covered] + self.entries[self.covered:] + other.entries[other.covered:]
+        self.covered += other.covered
+        self.unsent = self.unsent + other.unsent
+        self.deadline = min(self.deadline, other.deadline)
+        self.retries = max(self.retries, other.retries)
+
+    def Parts( self ):
+        # combines all entries into the texts of the short mails to send
+        texts = []
+        entries = self.entries[self.covered:]
+        keys = [key for text, key, callback in entries]
+        for n, (text, key, callback) in enumerate(entries):
+            if key is not None and key in keys[n + 1:]: continue    # a newer notification with the same key supersedes this one
+            if text not in texts: texts.append(text)    # drop verbatim duplicates
+        self.covered = len(self.entries)
+        return self.unsent + (SplitText('\n'.join(texts)) if texts else [])
+
+def SplitText( text, length = SMS_LENGTH ):
+    """Splits text into parts of at most length characters, at line breaks or spaces where possible.
+
+    If more than one part is needed, every part starts with a counter like "(1/3) ".
+    """
+    if len(text) <= length: return [text]
+    width = length - 8  # room for the counter
+    parts = []
+    while text:
+        if len(text) <= width:
+            parts.append(text)
+            break
+        cut = max(text.rfind('\n', 0, width + 1), text.rfind(' ', 0, width + 1))
+        if cut <= 0: cut = width
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n ')
+    return ['({}/{}) '.format(n + 1, len(parts)) + part for n, part in enumerate(parts)]
+
 class ModuleModem:
     
     _prt = None
     
-    def __init__( self, port, pin, loggername = ""):
+    def __init__( self, port, pin, retries = 2, retrydelay = 30.0, messagetimeout = 3600.0, sendtimeout = 60.0, digestwindow = 10.0, cmdtimeout = 5.0, metrics = None, loggername = ""):
         self.logger = logging.getLogger(loggername or 'rp_auto_ctrl') 
         self.logger.info('Initializing WAVECOM modem...')
+        self.retries = int(retries)     # attempts per message after the first one failed
+        self.retrydelay = float(retrydelay)     # seconds between two attempts for the same message
+        self.messagetimeout = float(messagetimeout)     # default lifetime of a queued message in seconds
+        self.sendtimeout = float(sendtimeout)   # seconds to wait for the network to confirm a message
+        self.digestwindow = float(digestwindow)     # seconds to collect notifications for the same recipient into one short mail
+        self.cmdtimeout = float(cmdtimeout)     # seconds to wait for the final result code of a command
+        self.exitcallback = None
+        self.statuscallback = None
+        self.allowed = []  # numbers whose status requests are answered
+        self._transaction = None    # command currently waiting for its response
+        self._cmdlock = threading.RLock()   # only one command may be in progress at a time
+        self._urchandlers = {'+CMTI:': self._on_new_message}
+        self._urcs = queue.Queue()  # URCs are handled on their own thread, so handlers may send commands themselves
+        self.DoRun = True   # indicates graceful shutdown to worker threads
+        self.metrics = metrics or SharedRegistry()
+        self._sendtime = self.metrics.Histogram('rp_auto_sms_send_seconds', 'Duration of sending one short mail')
+        self._queued = self.metrics.Counter('rp_auto_sms_queued_total', 'Notifications queued')
+        self._sent = self.metrics.Counter('rp_auto_sms_sent_total', 'Short mails sent')
+        self._failed = self.metrics.Counter('rp_auto_sms_failed_total', 'Attempts to send a short mail that failed')
+        self._retried = self.metrics.Counter('rp_auto_sms_retries_total', 'Messages queued again after a failed attempt')
+        self._dropped = self.metrics.Counter('rp_auto_sms_dropped_total', 'Messages given up on')
+        # outbound queue, ordered by the time a message is due to be (re)sent
+        self._queue = []
+        self._sequence = itertools.count()   # keeps messages that are due at the same time in order
+        self._busy = False
+        self._undelivered = 0   # messages given up on so far, Flush() tells by it whether all of its messages went out
+        self._cond = threading.Condition()
         self._prt = self._open_port('/dev/' + port)
+        for worker in (self._wkr_reader, self._wkr_urc):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
         self._check_device()
         self._check_pin(pin)
         self._check_network()
-        self.exitcallback = None
+        self._enable_notifications()
+        self._sender = threading.Thread(target=self._wkr_sender)
+        self._sender.daemon = True
+        self._sender.start()
         self.logger.info('WAVECOM modem initialization complete')
 
     def _open_port( self, tty ):
-        self.logger.debug('Opening port [' + tty + ']... ')
+        self.logger.debug('Opening port [%s]... ', tty)
         retval = serial.Serial( 
             port = tty,
             baudrate = 19200,
@@ -32,21 +138,70 @@ class ModuleModem:
             timeout = 1,
             xonxoff = False,
             rtscts = True,
-            dsrdtr = True
+            dsrdtr = True,
+            exclusive = True    # locks the port, so another controller or the port discovery keeps off it
         )
         if not retval.isOpen(): retval.open()
-        while retval.inWaiting() > 0: retval.read(self._prt.inWaiting())
+        while retval.inWaiting() > 0: retval.read(retval.inWaiting())
         atexit.register( self._on_exit)
-        self.logger.debug('Port ' + tty + ' opened')
+        self.logger.debug('Port %s opened', tty)
         return retval
 
-    def _send_cmd( self, cmd ):
-        cmd = 'AT' + cmd + '\r'
-        self._prt.write(cmd.encode('utf-8'))
-        time.sleep(0.5)
-        echo = []
-        while self._prt.inWaiting() > 0: echo.append(self._prt.readline().strip())
-        return echo
+    def _wkr_reader( self ):
+        # split the stream from the modem into responses to the pending command and unsolicited result codes
+        buf = b''
+        while self.DoRun:
+            try:
+                buf += self._prt.read(self._prt.inWaiting() or 1)  # returns after at most one port timeout
+            except Exception as err:
+                if self.DoRun: self.logger.warning('Terminating modem reader thread because of an error: %s', err)
+                break
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                line = line.strip().decode('utf-8', 'replace')
+                if line: self._dispatch(line)
+            if buf.strip() == b'>':     # the prompt for the text of a short mail is not followed by a line break
+                buf = b''
+                self._dispatch('>')
+
+    def _dispatch( self, line ):
+        transaction = self._transaction
+        if line.startswith(URC_PREFIXES) and not (transaction and line.startswith(transaction.command + ':')):
+            self.logger.debug('Received unsolicited result code <%s>', line)
+            self._urcs.put(line)
+        elif transaction is None or transaction.done.is_set():
+            self.logger.debug('Ignoring unexpected line <%s>', line)
+        else:
+            transaction.lines.append(line)
+            if FINAL_RESULTS.match(line) or (transaction.prompt and line == '>'): transaction.done.set()
+
+    def _wkr_urc( self ):
+        while self.DoRun:
+            line = self._urcs.get()
+            if line is None: break
+            for prefix, handler in list(self._urchandlers.items()):
+                if not line.startswith(prefix): continue
+                try:
+                    handler(line)
+                except Exception as err:
+                    self.logger.warning('Error handling <%s>: %s', line, err)
+
+    def RegisterUrcHandler( self, prefix, f ):
+        """Calls f(line) for every unsolicited result code starting with prefix, e.g. '+CMTI:'."""
+        self._urchandlers[prefix] = f
+
+    def _transact( self, data, command, timeout = None, prompt = False ):
+        # writes data and returns the response lines once a final result code (or the prompt) arrived, or the timeout passed
+        with self._cmdlock:
+            self._transaction = transaction = _Transaction(command, prompt)
+            self._prt.write(data)
+            if not transaction.done.wait(self.cmdtimeout if timeout is None else timeout):
+                self.logger.debug('No final result code received for <%s>', command)
+            self._transaction = None
+            return list(transaction.lines)
+
+    def _send_cmd( self, cmd, prompt = False ):
+        return self._transact(('AT' + cmd + '\r').encode('utf-8'), re.split('[=?]', cmd)[0], prompt = prompt)
         
     def _send_cmd_ret( self, cmd ):
         echo = self._send_cmd(cmd)
@@ -57,7 +212,7 @@ class ModuleModem:
     def _check_device( self ):
         self.logger.debug('Checking connected device...')
         retval = self._send_cmd_ret('+CGMI')
-        self.logger.debug('Received response <' + retval + '>')
+        self.logger.debug('Received response <%s>', retval)
         if retval == 'WAVECOM MODEM':
             self.logger.debug('Device recognized')
             return True
@@ -67,14 +222,14 @@ class ModuleModem:
     def _check_pin( self, pin ):
         self.logger.debug('Checking SIM PIN...')
         retval = self._send_cmd_ret('+CPIN?')
-        self.logger.debug('Recieved response <' + retval + '>')
+        self.logger.debug('Recieved response <%s>', retval)
         if retval == '+CPIN: READY':
             self.logger.debug('SIM PIN accepted')
             return True
         elif retval == '+CPIN: SIM PIN':
             self.logger.debug('Entering SIM PIN...')
             retval = self._send_cmd_ret('+CPIN=' + pin)
-            self.logger.debug('Using PIN ' + retval)
+            self.logger.debug('Using PIN %s', retval)
             if retval == "ERROR": raise Exception('** Invalid PIN!')
             time.sleep(10)
             self.logger.debug('Complete')
@@ -93,40 +248,187 @@ class ModuleModem:
             return True
         else:
             raise Exception('** Unknown network registration state!')
+
+    def _enable_notifications( self ):
+        # text mode, and report new messages by +CMTI instead of keeping quiet about them
+        for cmd in ('+CMGF=1', '+CNMI=2,1,0,0,0'):
+            echo = self._send_cmd(cmd)
+            if not echo or echo[-1] != 'OK': self.logger.warning('Modem did not accept AT%s, incoming messages are not handled', cmd)
+
+    def RegisterStatusCallback( self, f, allowed = '' ):
+        """Answers incoming "STATUS" short mails with the text returned by f().
+
+        Args:
+            f: Function without arguments that returns the current status as text.
+            allowed: Comma-separated list of numbers whose requests are answered.
+        """
+        self.statuscallback = f
+        self.allowed = [x for x in allowed.split(',') if x]
+
+    def _is_allowed( self, sender ):
+        # compare numbers without country code or leading zeros, so +49171... and 0171... match
+        digits = re.sub(r'\D', '', sender).lstrip('0')[-9:]
+        return bool(digits) and any(re.sub(r'\D', '', x).lstrip('0')[-9:] == digits for x in self.allowed)
+
+    def _on_new_message( self, line ):
+        # +CMTI: "SM",3 -- read the message at the given index, then delete it from the SIM
+        index = line.split(',')[-1].strip()
+        echo = self._send_cmd('+CMGR=' + index)
+        self._send_cmd('+CMGD=' + index)
+        header = [n for n, x in enumerate(echo) if x.startswith('+CMGR:')]
+        if not header or echo[-1] != 'OK':
+            self.logger.warning('Could not read incoming short mail: <%s>', '><'.join(echo))
+            return
+        sender = echo[header[0]].split(',')[1].strip('"')
+        text = ' '.join(echo[header[0] + 1:-1]).strip()
+        self.logger.info('Received short mail from [%s]: %s', sender, text)
+        if text.upper() != 'STATUS' or not self.statuscallback: return
+        if not self._is_allowed(sender):
+            self.logger.warning('Ignoring status request from unknown number [%s]', sender)
+            return
+        self.SendSMS(sender, self.statuscallback(), timeout = 600.0)
     
-    def SendSMS( self, address, msg ):
-        if ',' in address:            # recursive call to allow comma-separated list of recipients
-            addresslist = address.split(',')
-            for x in addresslist: self.SendSMS(x, msg)
+    def SendSMS( self, address, msg, callback = None, timeout = None, key = None ):
+        """Queues a short mail for sending by the background thread and returns right away.
+
+        Messages for the same recipient that are queued within digestwindow seconds are sent as one
+        digest, split into several short mails if it is too long.
+
+        Args:
+            address: The recipient, or a comma-separated list of recipients.
+            msg: The text to send.
+            callback: Optional function, called as callback(address, msg, success) for every recipient
+                once the message was sent, finally failed or expired.
+            timeout: Seconds after which the message is dropped if it could not be sent, defaults to messagetimeout.
+            key: Optional identifier, e.g. the name of a warning. Of several messages with the same key
+                in one digest, only the newest is sent.
+
+        Returns:
+            True if the message was queued for at least one recipient.
+        """
+        deadline = time.time() + (self.messagetimeout if timeout is None else timeout)
+        queued = False
+        with self._cond:
+            for x in address.split(','):    # allow comma-separated list of recipients
+                if not x:    # i.e., address is empty
+                    self.logger.info('No recipient address defined')
+                    continue
+                heapq.heappush(self._queue, (time.time() + self.digestwindow, next(self._sequence), _Message(x, msg, key, deadline, self.retries, callback)))
+                self._queued.Inc()
+                queued = True
+            self._cond.notify()
+        return queued
+
+    def Flush( self, timeout ):
+        """Sends all queued messages right away and waits up to timeout seconds for that.
+
+        Failed attempts are retried right away as well, as long as the messages have retries left.
+
+        Returns:
+            True once the queue is empty and every message in it was sent, False if some message
+            was given up on, or the timeout passed with messages still queued.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            undelivered = self._undelivered
+            while self._busy or self._queue:
+                if time.time() >= deadline or not self._sender.is_alive(): return False
+                # end all digest windows and retry delays, including those of messages queued again since the last round
+                self._queue = [(min(due, time.time()), seq, message) for due, seq, message in self._queue]
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                self._cond.wait(deadline - time.time())
+            return self._undelivered == undelivered
+
+    def _wkr_sender( self ):
+        while self.DoRun:
+            with self._cond:
+                while self.DoRun and (not self._queue or self._queue[0][0] > time.time()):
+                    self._cond.wait(self._queue[0][0] - time.time() if self._queue else None)
+                if not self.DoRun: break
+                message = heapq.heappop(self._queue)[2]
+                # fold everything else that is queued for the same recipient into this message
+                others = [item for item in self._queue if item[2].address == message.address]
+                if others:
+                    for item in sorted(others, key=lambda item: item[1]): message.Merge(item[2])
+                    self._queue = [item for item in self._queue if item[2].address != message.address]
+                    heapq.heapify(self._queue)
+                self._busy = True
+            try:
+                self._deliver(message)
+            except Exception as err:
+                self.logger.warning('Error sending short mail to [%s]: %s', message.address, err)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _deliver( self, message ):
+        # one attempt to send a queued message, which is re-queued if it failed and may still be retried
+        if time.time() > message.deadline:
+            self.logger.warning('Dropping expired short mail to [%s]', message.address)
+            success = False
         else:
-            if not address:    # i.e., address is empty
-                self.logger.info('No recipient address defined')
-                return False
-            self.logger.info('Sending short mail to [' + address + ']... ')
-            self.logger.debug('Mail content: ' + msg)
-            echo = self._send_cmd('+CMGS="' + address + '"')
-            self.logger.debug('Modem returned <' + '><'.join(echo) + '>')
-            if not ( len(echo) >= 2 and echo[-1] == '>' ):  # usually echo will only be two elements, but sometimes modem will notify about unread incoming messages as well
+            parts = message.Parts()
+            if len(message.entries) > 1: self.logger.info('Sending %s notifications as %s short mail(s)', len(message.entries), len(parts))
+            success = True
+            for n, part in enumerate(parts):
+                start = time.perf_counter()
+                try:
+                    success = self._send_sms(message.address, part)
+                except Exception as err:
+                    self.logger.warning('Error sending short mail to [%s]: %s', message.address, err)
+                    success = False
+                self._sendtime.Since(start)
+                (self._sent if success else self._failed).Inc()
+                if not success:
+                    message.unsent = parts[n:]  # do not send the parts that went through again
+                    break
+            if not success and message.retries > 0 and time.time() + self.retrydelay <= message.deadline:
+                message.retries -= 1
+                self._retried.Inc()
+                self.logger.info('Retrying in %s s', self.retrydelay)
+                with self._cond:
+                    heapq.heappush(self._queue, (time.time() + self.retrydelay, next(self._sequence), message))
+                return
+        if not success:
+            self._dropped.Inc()
+            with self._cond:
+                self._undelivered += 1
+        for text, key, callback in message.entries:
+            if not callback: continue
+            try:
+                callback(message.address, text, success)
+            except Exception as err:
+                self.logger.warning('Error in delivery callback: %s', err)
+
+    def _send_sms( self, address, msg ):
+        self.logger.info('Sending short mail to [%s]... ', address)
+        self.logger.debug('Mail content: %s', msg)
+        with self._cmdlock:     # prompt and text belong together, no other command may get in between
+            echo = self._send_cmd('+CMGS="' + address + '"', prompt = True)
+            self.logger.debug('Modem returned <%s>', '><'.join(echo))
+            if not ( echo and echo[-1] == '>' ):
                 self.logger.warning('Aborting send operation due to invalid return value')
+                if not echo or echo[-1] != 'ERROR': self._prt.write(b'\x1b')  # cancel, in case the prompt comes late
                 return False
-            self._prt.write(msg + chr(26))
-            time.sleep(0.2)
-            self._prt.readline() 
-            while self._prt.inWaiting() == 0: time.sleep(0.01)
-            retval = []
-            time.sleep(0.2)
-            while self._prt.inWaiting() > 0: retval.append(self._prt.readline().strip())
-            if retval[-1] == 'OK':
-                self.logger.info('Success, return value ' + retval[1])
-                return True
-            else:
-                self.logger.info('Failed')
-                return False   
+            retval = self._transact((msg + chr(26)).encode('utf-8'), '+CMGS', self.sendtimeout)
+        if retval and retval[-1] == 'OK':
+            self.logger.info('Success, return value %s', ' '.join(x for x in retval[:-1] if x.startswith('+CMGS')))
+            return True
+        else:
+            self.logger.info('Failed')
+            return False   
         
     def RegisterExitCallback( self, f):
         self.exitcallback = f
         
     def _on_exit( self ):
         if self.exitcallback: self.exitcallback()
-        self.logger.debug('Closing port [' + self._prt.port +']')
+        if not self.Flush(self.sendtimeout): self.logger.warning('Could not send all queued short mails before exit')
+        with self._cond:
+            self.DoRun = False
+            self._cond.notify_all()
+        self._urcs.put(None)
+        self.logger.debug('Closing port [%s]', self._prt.port)
         self._prt.close()
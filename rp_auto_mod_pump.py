@@ -2,23 +2,49 @@
 import time
 import sys
 import os
+import select
+import fcntl
+import threading
+import termios
+from collections import namedtuple
 try:
     import serial
 except ModuleNotFoundError:
-    import termios
+    serial = None   # only the TermIOS implementation is available
 import logging
 
+from rp_auto_calibration import CalibrationCache
+
 def write( str ):
     sys.stdout.write( str )
 
+# memory map of the pump controller: name -> (address, number of bytes), values are stored little-endian
+MEMORY = {"state": (0x114, 1), "level": (0x0ce, 1), "pumptemp": (0x086, 2), "auxtemp": (0x084, 2)}
+EEPROM = {"pumpsensoroffset": (0x016, 2), "auxsensoroffset": (0x014, 2), "levelsensoroffset": (0x01c, 2)}
+# fallback offsets, in case the EEPROM cannot be read -- these are values that were previously observed
+DEFAULT_OFFSETS = {"pumpsensoroffset": 145, "auxsensoroffset": 145, "levelsensoroffset": 38}
+
+# debug line naming each reading, followed by a "Converted value to <x>" line -- parseRpAutoLog.m and rp_auto_logparse read the values from these
+GETTING = {"level": 'Getting LN2 level from pump...', "pumptemp": 'Getting pump sensor temperature...', "auxtemp": 'Getting auxiliary sensor temperature ...'}
+
+# one complete set of pump readings, as returned by ModulePump.GetPumpStatus()
+PumpStatus = namedtuple('PumpStatus', ['running', 'level', 'pumptemp', 'auxtemp'])
+
 class ModulePump:
     
     _prt = None
+    TERMINATOR = 'Ready'    # last line of every reply sent by the pump
     
-    def __init__( self, tty, loggername = ""):
+    def __init__( self, tty, timeout = 2.0, maxreadspan = 8, identity = '', calibrationfile = '', loggername = ""):
         self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
         self.logger.info('Initializing LN2 pump...')
         self.__tty = tty
+        self.timeout = float(timeout)   # deadline in seconds for a complete reply to arrive
+        self.maxreadspan = int(maxreadspan)     # maximum number of bytes fetched with a single rm/re command
+        self.identity = identity    # part of the answer to "i" the pump must give, e.g. its serial number; empty accepts any pump
+        self.Identity = None    # the answer to "i" the connected pump gave
+        self.calibration = CalibrationCache(calibrationfile, loggername = self.logger.name) if calibrationfile else None   # sensor offsets read at earlier starts
+        self._cmdlock = threading.Lock()    # offsets may be checked in the background while the pump is in use
         try:
             self._prt = self._open_port('/dev/' + tty, 'P') # try PySerial protocol first
             self._check_pump()
@@ -27,7 +53,7 @@ class ModulePump:
                 self._prt.close() # just to be sure that previous prt does not remain open
             except:
                 pass
-            self.logger.info('PySerial linkup failed, switching to TermIOS: ' + str(err))
+            self.logger.info('PySerial linkup failed, switching to TermIOS: %s', err)
             
             self._prt = self._open_port('/dev/' + tty, 'T')
             self._check_pump()
@@ -37,8 +63,13 @@ class ModulePump:
 
     def _open_port( self, tty, mode = 'P'):     # mode='P' for PySerial implementation, 'T' for TermIOS implementation
         if mode == 'T':     # termios implementation
-            self.logger.debug('Opening port [' + tty + '] via TermIOS...')
+            self.logger.debug('Opening port [%s] via TermIOS...', tty)
             retval = os.open(tty, os.O_RDWR | os.O_NONBLOCK)
+            try:
+                fcntl.flock(retval, fcntl.LOCK_EX | fcntl.LOCK_NB)     # the same lock PySerial takes with exclusive = True
+            except OSError:
+                os.close(retval)
+                raise
             attr = termios.tcgetattr(retval)
             attr[2] = termios.CS8 # byte size is 8 bits
             attr[4] = termios.B19200
@@ -46,7 +77,8 @@ class ModulePump:
             termios.tcsetattr(retval, termios.TCSADRAIN, attr)
             termios.tcflush(retval, termios.TCIFLUSH)   # sometimes the buffer will not be empty on connection, so that replies to commands are appended at the end and not found where expected when read back
         else:       # default PySerial implementation
-            self.logger.debug('Opening port [' + tty + '] via PySerial...')
+            self.logger.debug('Opening port [%s] via PySerial...', tty)
+            if serial is None: raise Exception('PySerial is not installed')
             retval = serial.Serial( 
                 port = tty,
                 baudrate = 19200,
@@ -56,68 +88,162 @@ class ModulePump:
                 timeout = 1,
                 xonxoff = False,
                 rtscts = False,
-                dsrdtr = False
+                dsrdtr = False,
+                exclusive = True    # locks the port, so another controller or the port discovery keeps off it
             )
             if not retval.isOpen(): retval.open()
             retval.flushInput() # purge input buffer, since device writes continuously to buffer
             
         atexit.register( self._on_exit)
-        self.logger.debug('Port opened in ' + mode + ' mode')
+        self.logger.debug('Port opened in %s mode', mode)
         return retval
 
     def _send_cmd( self, cmd ):
         if isinstance(cmd, str):
             cmd = cmd.encode('utf-8')  # make sure cmd is byte array
-        if type(self._prt) is serial.serialposix.Serial:  # pyserial implementation
-            self._prt.write(cmd)
-            time.sleep(0.4)
-            echo = []
-            while self._prt.inWaiting() > 0: echo.append(self._prt.readline().strip())
-            return echo
+        with self._cmdlock:
+            if serial is not None and type(self._prt) is serial.serialposix.Serial:  # pyserial implementation
+                self._prt.flushInput()  # drop leftovers, so they are not mistaken for the reply
+                self._prt.write(cmd)
+            else:
+                termios.tcflush(self._prt, termios.TCIFLUSH)
+                os.write(self._prt, cmd + b'\x0d')
+            return self._read_reply()
+
+    def _read_chunk( self, timeout ):
+        # returns whatever arrived within timeout seconds, possibly nothing
+        if serial is not None and type(self._prt) is serial.serialposix.Serial:  # pyserial implementation
+            self._prt.timeout = timeout
+            return self._prt.read(self._prt.inWaiting() or 1)
         else:
-            os.write(self._prt, cmd + '\x0d')
-            time.sleep(0.4)
-            return os.read(self._prt, 1024).split('\r\n')
+            if not select.select([self._prt], [], [], timeout)[0]: return b''
+            return os.read(self._prt, 1024)
+
+    def _read_reply( self ):
+        # collect reply lines until the terminator line arrives or the deadline passes
+        deadline = time.time() + self.timeout
+        buf = b''
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.logger.debug('No terminator received within %s s', self.timeout)
+                break
+            buf += self._read_chunk(remaining)
+            if self.TERMINATOR.encode('ascii') in [line.strip() for line in buf.split(b'\n')]: break
+        lines = [line.strip().decode('ascii', 'replace') for line in buf.split(b'\n')]
+        if lines and not lines[-1]: lines.pop()   # remove the empty element after the final line break
+        return lines
 
     def _check_pump( self ):
         self.logger.debug('Checking device...')
         retval = self._send_cmd('i')
         if len(retval)<5 or not retval[5] == 'Ready': raise Exception('Unknown device connected!')
-        self.logger.debug('Received answer <' + retval[1][9:] + '>')
+        self.logger.debug('Received answer <%s>', retval[1][9:])
+        if self.identity not in retval[1][9:]: raise Exception('Connected pump <' + retval[1][9:] + '> is not <' + self.identity + '>')
+        self.Identity = retval[1][9:]
         self.logger.debug('Device check complete')
         
+    def _plan_reads( self, fields ):
+        # group the requested fields into as few contiguous blocks as possible; returns a list of (address, length, [names])
+        blocks = []
+        for name, (addr, length) in sorted(fields.items(), key=lambda item: item[1][0]):
+            if blocks and addr + length - blocks[-1][0] <= self.maxreadspan:
+                blocks[-1][1] = max(blocks[-1][1], addr + length - blocks[-1][0])
+                blocks[-1][2].append(name)
+            else:
+                blocks.append([addr, length, [name]])
+        return blocks
+
+    def ReadRegisters( self, fields, space = 'rm' ):
+        """Reads a set of fields from the pump with as few commands as possible.
+
+        Args:
+            fields: Dictionary mapping field names to (address, number of bytes), e.g. MEMORY.
+            space: 'rm' to read from memory, 're' to read from EEPROM.
+
+        Returns:
+            A dictionary mapping field names to their decoded integer values. Fields of a block
+            that could not be read are missing from the result.
+        """
+        values = {}
+        for addr, length, names in self._plan_reads(fields):
+            try:
+                retval = self._send_cmd('{} {:03x} {}'.format(space, addr, length))
+                self.logger.debug('Received <%s>', '><'.join(retval[1:-1]))
+                if len(retval) < 3 or not retval[-1] == self.TERMINATOR: raise Exception('Unable to contact LN2 pump!')
+                data = [int(x, 16) for line in retval[1:-1] for x in line.split() if len(x) == 2]   # skip the echoed command, collect all byte values
+                if len(data) != length: raise Exception('Expected ' + str(length) + ' bytes, got ' + str(len(data)))
+            except Exception as err:
+                self.logger.warning('Error reading %s: %s', ', '.join(names), err)
+                continue
+            for name in names:
+                start, size = fields[name][0] - addr, fields[name][1]
+                values[name] = sum(b << (8*n) for n, b in enumerate(data[start:start + size]))   # little-endian
+        return values
+
     def _querySensorOffsets( self ):
+        # offsets stored for this very pump are used right away, and read back from its EEPROM in the background
+        cached = self.calibration.Get(self.Identity, EEPROM) if self.calibration and self.Identity is not None else None
+        if cached is not None:
+            self.logger.debug('Using cached sensor offsets %s', cached)
+            for name in EEPROM: setattr(self, name, cached[name])
+            validator = threading.Thread(target=self._wkr_validate)
+            validator.daemon = True
+            validator.start()
+            return
         self.logger.debug('Getting sensor offsets...')
-        # first, the "main" sensor at the pump inlet
-        try:
-            retval = self._send_cmd('re 016 2')
-            self.logger.debug('Received <' + retval[1] + '>')
-            if not retval[2] == 'Ready': raise Exception('Unable to contact LN2 pump!')
-            self.pumpsensoroffset = (int(''.join(reversed(retval[1].split())), 16))   # reversed() acrobatics needed because retval is big-endian
-            self.logger.debug('Converted value to ' + str(self.pumpsensoroffset))
-        except Exception as err:
-            self.logger.warning('Error getting pump sensor offset: ' + str(err))
-            self.pumpsensoroffset = 145   # use a value that was previously observed
-        # second, the "auxiliary" sensor, e.g positioned at the tube outlet
-        try:
-            retval = self._send_cmd('re 014 2')
-            self.logger.debug('Received <' + retval[1] + '>')
-            if not retval[2] == 'Ready': raise Exception('Unable to contact LN2 pump!')
-            self.auxsensoroffset = (int(''.join(reversed(retval[1].split())), 16))   # reversed() acrobatics needed because retval is big-endian
-            self.logger.debug('Converted value to ' + str(self.auxsensoroffset))
-        except Exception as err:
-            self.logger.warning('Error getting auxiliary sensor offset: ' + str(err))
-            self.auxsensoroffset = 145   # use a value that was previously observed
-        # third, the level sensor
-        try:
-            retval = self._send_cmd('re 01c 2')
-            self.logger.debug('Received <' + retval[1] + '>')
-            if not retval[2] == 'Ready': raise Exception('Unable to contact LN2 pump!')
-            self.levelsensoroffset = (int(''.join(reversed(retval[1].split())), 16))   # reversed() acrobatics needed because retval is big-endian
-            self.logger.debug('Converted value to ' + str(self.levelsensoroffset))
-        except Exception as err:
-            self.logger.warning('Error getting level sensor offset: ' + str(err))
-            self.levelsensoroffset = 38   # use a value that was previously observed
+        # "main" sensor at the pump inlet, "auxiliary" sensor, e.g positioned at the tube outlet, and the level sensor
+        values = self.ReadRegisters(EEPROM, 're')
+        for name in EEPROM:
+            if name not in values:
+                self.logger.warning('Error getting %s, using %s', name, DEFAULT_OFFSETS[name])
+            else:
+                self.logger.debug('Converted value to %s', values[name])
+            setattr(self, name, values.get(name, DEFAULT_OFFSETS[name]))
+        if self.calibration and self.Identity is not None and len(values) == len(EEPROM): self.calibration.Put(self.Identity, values)
+
+    def _wkr_validate( self ):
+        # compare the cached offsets with the EEPROM, and switch over if they are out of date
+        values = self.ReadRegisters(EEPROM, 're')
+        if len(values) != len(EEPROM):
+            self.logger.warning('Could not validate cached sensor offsets, keeping them')
+            return
+        changed = [name for name in EEPROM if values[name] != getattr(self, name)]
+        if changed: self.logger.warning('Cached %s out of date, using %s from the pump', ', '.join(changed), values)
+        for name in EEPROM: setattr(self, name, values[name])
+        self.calibration.Put(self.Identity, values)
+        self.logger.debug('Sensor offsets validated')
+
+    def _convert_level( self, raw ):
+        return (raw - self.levelsensoroffset)*0.542888/0.808
+
+    def GetPumpStatus( self, fields = tuple(MEMORY) ):
+        """Reads state, LN2 level and both sensor temperatures in one go.
+
+        Args:
+            fields: Names out of MEMORY to read; the state is always read. Every block of the
+                memory map that is left out saves a round trip to the pump.
+
+        Returns:
+            A PumpStatus record. Values that could not be read are NaN, values that were not asked
+            for are None -- so a NaN always means a failed reading.
+
+        Raises:
+            Exception: If the pump state could not be read.
+        """
+        self.logger.debug('Getting pump status...')
+        values = self.ReadRegisters(dict((name, MEMORY[name]) for name in set(fields) | set(["state"])))
+        if "state" not in values: raise Exception('Unable to contact LN2 pump!')
+        def convert( name, f ):
+            if name not in fields: return None
+            if name not in values: return float("nan")
+            self.logger.debug(GETTING[name])    # the same lines the single getters log
+            self.logger.debug('Converted value to %s', f(values[name]))
+            return f(values[name])
+        return PumpStatus(values["state"] == 1,
+                          convert("level", self._convert_level),
+                          convert("pumptemp", lambda raw: raw - self.pumpsensoroffset),
+                          convert("auxtemp", lambda raw: raw - self.auxsensoroffset))
 
     def StartPump( self ):
         self.logger.info('Start pumping LN2...')
@@ -134,49 +260,30 @@ class ModulePump:
     def GetPumpState( self ):
         """Returns True if pump is running, False otherwise."""
         self.logger.debug('Getting pump status...')
-        retval = self._send_cmd('rm 114')
-        self.logger.debug('Received <' + retval[1] + '>')
-        if not retval[2] == 'Ready': raise Exception('Unable to contact LN2 pump!')
-        return retval[1] == '01'
+        values = self.ReadRegisters({"state": MEMORY["state"]})
+        if "state" not in values: raise Exception('Unable to contact LN2 pump!')
+        return values["state"] == 1
     
     def GetPumpLevel( self ):
-        self.logger.debug('Getting LN2 level from pump...')
-        try: 
-            retval = self._send_cmd('rm 0ce 1')
-            self.logger.debug('Received <' + retval[1] + '>')
-            if not retval[2] == 'Ready': raise Exception('Unable to contact LN2 pump!')
-            level = (int(retval[1], 16) - self.levelsensoroffset)*0.542888/0.808   
-            self.logger.debug('Converted value to ' + str(level))
-            return level
-        except Exception as err:
-            self.logger.warning('Error getting pump level: ' + str(err))
-            return float("nan")
+        self.logger.debug(GETTING["level"])
+        values = self.ReadRegisters({"level": MEMORY["level"]})
+        if "level" not in values: return float("nan")
+        self.logger.debug('Converted value to %s', self._convert_level(values["level"]))
+        return self._convert_level(values["level"])
     
     def GetPumpSensorTemperature( self ):
-        self.logger.debug('Getting pump sensor temperature...')
-        try:
-            retval = self._send_cmd('rm 086 2')
-            self.logger.debug('Received <' + retval[1] + '>')
-            if not retval[2] == 'Ready': raise Exception('Unable to contact LN2 pump!')
-            temp = (int(''.join(reversed(retval[1].split())), 16)-self.pumpsensoroffset)   # reversed() acrobatics needed because retval is big-endian
-            self.logger.debug('Converted value to ' + str(temp))
-            return temp
-        except Exception as err:
-            self.logger.warning('Error getting pump sensor temperature: ' + str(err))
-            return float("nan")
+        self.logger.debug(GETTING["pumptemp"])
+        values = self.ReadRegisters({"pumptemp": MEMORY["pumptemp"]})
+        if "pumptemp" not in values: return float("nan")
+        self.logger.debug('Converted value to %s', values["pumptemp"] - self.pumpsensoroffset)
+        return values["pumptemp"] - self.pumpsensoroffset
         
     def GetAuxSensorTemperature( self ):
-        self.logger.debug('Getting auxiliary sensor temperature ...')
-        try:
-            retval = self._send_cmd('rm 084 2')
-            self.logger.debug('Received <' + retval[1] + '>')
-            if not retval[2] == 'Ready': raise Exception('Unable to contact LN2 pump!')
-            temp = (int(''.join(reversed(retval[1].split())), 16)-self.auxsensoroffset)   # reversed() acrobatics needed because retval is big-endian
-            self.logger.debug('Converted value to ' + str(temp))
-            return temp
-        except Exception as err:
-            self.logger.warning('Error getting auxiliary sensor temperature: ' + str(err))
-            return float("nan")
+        self.logger.debug(GETTING["auxtemp"])
+        values = self.ReadRegisters({"auxtemp": MEMORY["auxtemp"]})
+        if "auxtemp" not in values: return float("nan")
+        self.logger.debug('Converted value to %s', values["auxtemp"] - self.auxsensoroffset)
+        return values["auxtemp"] - self.auxsensoroffset
     
     def _on_exit( self ):
         # try shutting down the pump if it's still running when the handler terminates
@@ -185,9 +292,9 @@ class ModulePump:
                 self.StopPump()
         except Exception:
             pass
-        self.logger.debug('Closing port [/dev/' + self.__tty + ']')
+        self.logger.debug('Closing port [/dev/%s]', self.__tty)
         try:
-            if type(self._prt) is serial.serialposix.Serial:  # pyserial implementation
+            if serial is not None and type(self._prt) is serial.serialposix.Serial:  # pyserial implementation
                 self._prt.close()
             else:   # termios implementation
                 os.close(self._prt)
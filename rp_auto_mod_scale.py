@@ -2,23 +2,38 @@
 import atexit
 import time
 import sys
+import threading
 import logging
 
+from rp_auto_ringbuffer import RingBuffer
+
 def write( str ):
     sys.stdout.write( str )
 
 class ModuleScale:
     
     _prt = None
+    MODES = ('request', 'poll', 'stream')
     
-    def __init__( self, port, loggername = ""):
+    def __init__( self, port, mode = 'request', buffersize = 256, maxage = 5.0, loggername = ""):
+        # mode='request' sends one weighing command per GetValue() call, 'poll' sends them from a background thread as fast as the
+        # scale answers, 'stream' only listens to a scale that has been set to continuous transmission on its own
         self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
         self.logger.info('Initializing KERN scale...')
+        if mode not in self.MODES: raise ValueError('Unknown scale mode <' + mode + '>')
+        self.mode = mode
+        self.Samples = RingBuffer(int(buffersize))     # parsed readings, only filled in 'poll' and 'stream' mode
+        self.maxage = float(maxage)     # samples older than this many seconds are considered stale
         self._prt = self._open_port('/dev/' + port)
+        self.DoRun = True   # indicates graceful shutdown to reader thread
+        if self.mode != 'request':
+            self._reader = threading.Thread(target=self._wkr_reader)
+            self._reader.daemon = True
+            self._reader.start()
         self.logger.info('Scale initialization complete')
 
     def _open_port( self, tty ):
-        self.logger.debug('Opening port ' + tty)
+        self.logger.debug('Opening port %s', tty)
         retval = serial.Serial( 
             port = tty,
             baudrate = 9600,
@@ -28,7 +43,8 @@ class ModuleScale:
             timeout = 1,
             xonxoff = False,
             rtscts = False,
-            dsrdtr = False
+            dsrdtr = False,
+            exclusive = True    # locks the port, so another controller or the port discovery keeps off it
         )
         if not retval.isOpen(): retval.open()
         while retval.inWaiting() > 0: retval.read(self._prt.inWaiting())
@@ -36,26 +52,54 @@ class ModuleScale:
         self.logger.debug('Successfully opened port')
         return retval
 
+    def _parse( self, echo ):
+        # converts one line sent by the scale into a float
+        retval = echo
+        if ' ' in retval: retval = retval[0:(retval.rfind(' '))]
+        if retval.replace(' ', '' ) == '-': retval = echo
+        return float(retval.replace(' ', ''))
+
+    def _wkr_reader( self ):
+        # parse readings as they arrive; in 'poll' mode, ask for the next one as soon as the previous answer is in
+        while self.DoRun:
+            try:
+                if self.mode == 'poll': self._prt.write(b'w')
+                line = self._prt.readline().strip()     # returns empty after the port timeout
+            except Exception as err:
+                if self.DoRun: self.logger.warning('Terminating scale reader thread because of an error: %s', err)
+                break
+            if not line: continue
+            try:
+                self.Samples.Append(self._parse(line.decode('ascii', 'replace')))
+            except ValueError:
+                pass    # e.g. a line that was only partially received
+
     def GetValue( self ):
         self.logger.debug('Getting value from scale...')
+        if self.mode != 'request':
+            sample = self.Samples.Latest()
+            if sample is None or time.time() - sample[0] > self.maxage:
+                self.logger.warning('Error getting value from scale: no reading within the last %s s', self.maxage)
+                return float("nan")
+            self.logger.debug('Converted value to %s', sample[1])
+            return sample[1]
         try:
             cmd = 'w'
             self._prt.write(cmd.encode('utf-8'))
             time.sleep(0.5)
             echo = []
-            while self._prt.inWaiting() > 0: echo.append(self._prt.readline().strip())
+            while self._prt.inWaiting() > 0: echo.append(self._prt.readline().strip().decode('ascii', 'replace'))
             if len(echo) != 1: raise ValueError('Unable to read value!')
             retval = echo[0]
-            self.logger.debug('Received <' + retval + '>')
-            if ' ' in retval: retval = retval[0:(retval.rfind(' '))]
-            if retval.replace(' ', '' ) == '-': retval = echo[0]
-            retval = retval.replace(' ', '')
-            self.logger.debug('Converted value to ' + retval)
-            return float(retval)
+            self.logger.debug('Received <%s>', retval)
+            retval = self._parse(retval)
+            self.logger.debug('Converted value to %s', retval)
+            return retval
         except Exception as err:
-            self.logger.warning('Error getting value from scale: ' + str(err))
+            self.logger.warning('Error getting value from scale: %s', err)
             return float("nan")
         
     def _on_exit( self ):
-        self.logger.debug('Closing port [' + self._prt.port + ']')
+        self.DoRun = False
+        self.logger.debug('Closing port [%s]', self._prt.port)
         self._prt.close()
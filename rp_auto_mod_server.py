@@ -1,63 +1,454 @@
-﻿import socket
+﻿import errno
+import socket
+import selectors
+import threading
 import atexit
 import time
 import sys
 import logging
 
-from thread import start_new_thread
-
 def write( str ):
     sys.stdout.write( str )
 
+class UnknownStation(Exception):
+    pass
+
+class _Subscription:
+    # what a client wants to be pushed about one station
+
+    def __init__( self, tag, deadband, pushformat ):
+        self.tag = tag              # inserted into the push lines, so clients can tell stations apart
+        self.deadband = deadband    # minimum change of a numeric field that triggers a push
+        self.pushformat = pushformat
+        self.lastpushed = None      # last snapshot pushed for this subscription
+
+class _Connection:
+    # state of one client connection
+
+    def __init__( self, sock, addr ):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = b''
+        self.outbuf = bytearray()
+        self.lastactive = time.time()
+        self.closing = False    # close as soon as outbuf has been sent
+        self.eof = False        # client shut down its sending side, close once everything it sent has been answered
+        self.legacy = False     # client speaks the V1.0 one-command-per-connection protocol
+        self.subscriptions = {} # _Subscription per station name
+        self.skipped = 0        # records not pushed because the client did not keep up
+        self.pending = []       # received command lines that wait for the current stream to finish
+        self.producer = None    # iterator yielding the rest of a streamed reply in chunks
+
 class ModuleServer:
-    
+
     BUFFER_SIZE = 1024
+    MAX_LINE = 4096     # longest command line accepted before the client is considered broken
+    LINGER = 0.25       # seconds to wait for a line break before an unterminated command is served the pre-V1.1 way
+    MAX_BACKLOG = 65536 # subscribers with more unsent bytes than this skip records until they have caught up
+    CHUNK_SIZE = 500    # rows per chunk of a streamed history reply
+    ACCEPT_PAUSE = 1.0  # seconds no connections are accepted after running out of descriptors
 
-    def __init__( self, port, loggername = ""):
+    def __init__( self, port, maxclients = 16, idletimeout = 300.0, loggername = ""):
         self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
         self.logger.info('Initializing IPv4/TCP server...')
+        self.maxclients = int(maxclients)
+        self.idletimeout = float(idletimeout)   # connections without traffic for this many seconds are closed
+        self._clients = {}
+        self._commands = {'SVR:HELLO': self._cmd_hello, 'SVR:DATA': self._cmd_data, 'SVR:HISTORY': self._cmd_history,
+                          'SVR:SUBSCRIBE': self._cmd_subscribe, 'SVR:UNSUBSCRIBE': self._cmd_unsubscribe,
+                          'SVR:STATIONS': self._cmd_stations, 'SVR:METRICS': self._cmd_metrics, 'GET': self._cmd_http}
+        self.DefaultStation = ''    # station served to commands without @station argument
+        self.Snapshots = {}     # latest StatusSnapshot per station, each replaced as a whole by Publish()
+        self.Histories = {}     # TimeSeriesStore per station, queried by SVR:HISTORY
+        self._published = {}    # latest snapshots handed over by Publish(), not yet pushed
+        self.Metrics = None     # Registry rendered by SVR:METRICS
+        self._publock = threading.Lock()
         self._init_server(port)
-        self.DoRun = True # indicates graceful shutdown to worker thread 
-        start_new_thread(self._wkr_server, ()) 
+        self.DoRun = True # indicates graceful shutdown to worker thread
+        self._thread = threading.Thread(target=self._wkr_server)
+        self._thread.daemon = True
+        self._thread.start()
         self.logger.info('Successfully initialized server')
-    
+
     def _init_server( self, port ):
-        self.logger.debug('Opening IPv4/TCP port [' + port + ']...')
+        self.logger.debug('Opening IPv4/TCP port [%s]...', port)
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._sock.bind(('', int(port)))
-        self._sock.listen(1)
+        self._sock.listen(self.maxclients)
+        self._sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ, None)
+        self._resume = None     # time to accept connections again, while paused
+        self._wakeup, self._wakeup_sender = socket.socketpair()  # lets Publish() interrupt the select() call
+        self._wakeup.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ, self._wakeup)
         atexit.register(self._on_exit)
         self.logger.debug('Successfully opened port')
-        
+
+    @property
+    def Snapshot( self ):
+        return self.Snapshots.get(self.DefaultStation)
+
+    @property
+    def History( self ):
+        return self.Histories.get(self.DefaultStation)
+
+    def _station( self, args ):
+        # splits an optional leading @station argument off the arguments of a command
+        if args and args[0].startswith('@'):
+            station = args[0][1:]
+            if station not in self.Snapshots and station not in self.Histories: raise UnknownStation(station)
+            return station, args[1:]
+        return self.DefaultStation, args
+
+    def _cmd_stations( self, conn, args ):
+        return 'CNT:STATIONS=' + '\t'.join(sorted(set(self.Snapshots) | set(self.Histories)))
+
+    def _cmd_metrics( self, conn, args ):
+        # SVR:METRICS -- Prometheus text format, preceded by its length like a binary reply
+        if self.Metrics is None:
+            return 'CNT:ERROR=NO_DATA'
+        text = self.Metrics.Render().encode('utf-8')
+        return b'CNT:METRICS=' + str(len(text)).encode('ascii') + b'\r\n' + text
+
+    def _cmd_http( self, conn, args ):
+        # GET /metrics HTTP/1.x -- lets Prometheus scrape the command port directly; the request headers are ignored
+        conn.closing = True
+        conn.pending = []
+        if args[:1] != ['/metrics'] or self.Metrics is None:
+            return b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+        text = self.Metrics.Render().encode('utf-8')
+        return (b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' + str(len(text)).encode('ascii') +
+                b'\r\nConnection: close\r\n\r\n' + text)
+
+    def _cmd_hello( self, conn, args ):
+        return 'CNT:HELLO=RP_AUTO_SERVER_V1.0' if conn.legacy else 'CNT:HELLO=RP_AUTO_SERVER_V1.1'
+
+    def _cmd_data( self, conn, args ):
+        # SVR:DATA [@station] [TSV|JSON|BIN] [version] -- with a version, "unchanged" is returned if that is still the current one
+        station, args = self._station(args)
+        fmt, version = 'TSV', None
+        for arg in args:
+            if arg.upper() in ('TSV', 'JSON', 'BIN'): fmt = arg.upper()
+            else: version = int(arg)
+        snapshot = self.Snapshots.get(station)
+        if snapshot is None:
+            return 'CNT:ERROR=NO_DATA'
+        if version == snapshot.version:
+            return 'CNT:UNCHANGED=' + str(version)
+        self.logger.debug('Sending data entry to client... <%s>', conn.addr)
+        if fmt == 'JSON':
+            return b'CNT:JSON=' + snapshot.json
+        if fmt == 'BIN':
+            return b'CNT:BIN=' + str(len(snapshot.binary)).encode('ascii') + b'\r\n' + snapshot.binary
+        if version is not None:
+            return b'CNT:DATA@' + str(snapshot.version).encode('ascii') + b'=' + snapshot.tsv
+        return b'CNT:DATA=' + snapshot.tsv
+
+    def _cmd_history( self, conn, args ):
+        # SVR:HISTORY [@station] <from> <to> [channel,channel,...] [buckets] -- times in seconds since the epoch, or relative to now if <= 0
+        station, args = self._station(args)
+        history = self.Histories.get(station)
+        if history is None:
+            return 'CNT:ERROR=NO_DATA'
+        if len(args) < 2: raise ValueError('Missing time range')
+        now = time.time()
+        start, end = [float(x) + now if float(x) <= 0 else float(x) for x in args[:2]]
+        channels, buckets = history.channels, None
+        for arg in args[2:]:
+            if arg.isdigit(): buckets = int(arg)
+            else: channels = arg.split(',')
+        if any(name not in history.channels for name in channels) or buckets == 0: raise ValueError('Invalid channel or decimation')
+        self.logger.debug('Streaming history to client... <%s>', conn.addr)
+        if buckets is None:
+            conn.producer = self._history_rows(history, start, end, channels)
+            return 'CNT:HISTORY=' + '\t'.join(['time'] + channels)
+        conn.producer = self._history_buckets(history, start, end, channels, buckets)
+        return 'CNT:HISTORY=' + '\t'.join(['time'] + [name + '.' + stat for name in channels for stat in ('min', 'max', 'mean')])
+
+    def _history_rows( self, history, start, end, channels ):
+        for chunk in history.Chunks(start, end, channels, self.CHUNK_SIZE):
+            columns = [chunk["time"]] + [chunk[name] for name in channels]
+            yield ''.join('\t'.join(repr(float(x)) for x in row) + '\r\n' for row in zip(*columns)).encode('ascii')
+        yield b'CNT:END\r\n'
+
+    def _history_buckets( self, history, start, end, channels, buckets ):
+        lines = []
+        for bucket, stats in history.Decimate(start, end, buckets, channels):
+            lines.append('\t'.join(repr(float(x)) for x in [bucket] + [value for stat in stats for value in stat]) + '\r\n')
+            if len(lines) >= self.CHUNK_SIZE:
+                yield ''.join(lines).encode('ascii')
+                lines = []
+        lines.append('CNT:END\r\n')
+        yield ''.join(lines).encode('ascii')
+
+    def _cmd_subscribe( self, conn, args ):
+        # SVR:SUBSCRIBE [@station] [deadband] [TSV|JSON] -- may be repeated to follow several stations
+        tag = args[0] if args and args[0].startswith('@') else ''   # pushes for an explicitly named station are sent as CNT:PUSH@station=
+        station, args = self._station(args)
+        deadband, pushformat = 0.0, 'TSV'
+        for arg in args:
+            if arg.upper() in ('TSV', 'JSON'): pushformat = arg.upper()
+            else: deadband = float(arg)
+        conn.subscriptions[station] = _Subscription(tag, deadband, pushformat)
+        self.logger.debug('Client %s subscribed to station [%s] with deadband %s', conn.addr, station, deadband)
+        return 'CNT:SUBSCRIBE=OK'
+
+    def _cmd_unsubscribe( self, conn, args ):
+        # SVR:UNSUBSCRIBE [@station] -- without a station, all subscriptions are cancelled
+        if args:
+            station, args = self._station(args)
+            conn.subscriptions.pop(station, None)
+        else:
+            conn.subscriptions.clear()
+        return 'CNT:UNSUBSCRIBE=OK'
+
+    def Publish( self, snapshot, station = '' ):
+        """Makes a new StatusSnapshot the current one of a station and hands it to all subscribers.
+
+        Only the newest snapshot of every station is kept, so this never blocks the caller, no matter how slow the clients are.
+        """
+        self.Snapshots[station] = snapshot  # a single reference assignment, so requests see either the old or the new snapshot
+        with self._publock:
+            self._published[station] = snapshot
+        try:
+            self._wakeup_sender.send(b'\0')
+        except socket.error:
+            pass    # a wakeup is already pending
+
+    def _changed( self, subscription, snapshot ):
+        old = subscription.lastpushed
+        if old is None or old.pump != snapshot.pump or old.lastcheck != snapshot.lastcheck: return True
+        for name in ('scale', 'level', 'mmeter'):
+            a, b = getattr(old, name), getattr(snapshot, name)
+            if not abs(a - b) <= subscription.deadband and not (a != a and b != b): return True     # a NaN counts as changed, unless it was NaN before
+        return False
+
+    def _push( self ):
+        # forward the latest published entry to every subscriber that can take it
+        try:
+            while self._wakeup.recv(self.BUFFER_SIZE): pass
+        except socket.error:
+            pass
+        with self._publock:
+            published, self._published = self._published, {}
+        for station, snapshot in published.items():
+            for conn in list(self._clients.values()):
+                subscription = conn.subscriptions.get(station)
+                if subscription is None or conn.closing or not self._changed(subscription, snapshot): continue
+                if len(conn.outbuf) > self.MAX_BACKLOG or conn.producer is not None:   # also keep pushes out of a streamed reply
+                    conn.skipped += 1
+                    if conn.skipped == 1: self.logger.debug('Client %s is not keeping up, skipping records', conn.addr)
+                    continue
+                conn.skipped = 0
+                subscription.lastpushed = snapshot
+                try:
+                    self._send(conn, b'CNT:PUSH' + subscription.tag.encode('utf-8') + b'=' +
+                               (snapshot.json if subscription.pushformat == 'JSON' else snapshot.tsv) + b'\r\n')
+                except Exception as err:
+                    self._drop(conn, err)
+
+    def _execute( self, conn, line ):
+        # runs one command line and returns the reply, without line terminator
+        self.logger.debug('Received command string %s', line)
+        words = line.split()
+        handler = self._commands.get(words[0]) if words else None
+        if handler is None:
+            return 'CNT:ERROR=UNKNOWN_CMD'
+        if self.Metrics is not None: self.Metrics.Counter('rp_auto_server_requests_total', 'Commands served', command = words[0]).Inc()
+        try:
+            return handler(conn, words[1:])
+        except ValueError:
+            return 'CNT:ERROR=INVALID_ARGUMENT'
+        except UnknownStation:
+            return 'CNT:ERROR=UNKNOWN_STATION'
+        except Exception as err:
+            self.logger.warning('Error executing command <%s>: %s', line, err)
+            return 'CNT:ERROR=FAILED'
+
+    def _send( self, conn, data ):
+        conn.outbuf += data.encode('utf-8') if isinstance(data, str) else data
+        self._selector.modify(conn.sock, selectors.EVENT_WRITE if conn.eof else selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+
+    def _accept( self ):
+        try:
+            sock, addr = self._sock.accept()
+        except socket.error as err:
+            # the client may have given up already, or the process is out of descriptors -- then stop accepting for a
+            # while, as the listening socket would be reported readable again right away
+            if err.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                self.logger.warning('Could not accept connection, pausing for %s s: %s', self.ACCEPT_PAUSE, err)
+                self._selector.unregister(self._sock)
+                self._resume = time.time() + self.ACCEPT_PAUSE
+            else:
+                self.logger.debug('Could not accept connection: %s', err)
+            return
+        sock.setblocking(False)
+        if len(self._clients) >= self.maxclients:
+            self.logger.warning('Rejecting connection from %s, too many clients', addr)
+            try:
+                sock.send(b'CNT:ERROR=TOO_MANY_CLIENTS\r\n')
+            except socket.error:
+                pass
+            sock.close()
+            return
+        self.logger.debug('Accepted connection from %s', addr)
+        conn = _Connection(sock, addr)
+        self._clients[sock] = conn
+        self._selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _close( self, conn ):
+        self.logger.debug('Closing connection to %s', conn.addr)
+        self._clients.pop(conn.sock, None)
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def _read( self, conn ):
+        try:
+            data = conn.sock.recv(self.BUFFER_SIZE)
+        except socket.error as err:
+            self.logger.debug('Receive from %s failed: %s', conn.addr, err)
+            self._close(conn)
+            return
+        if not data:    # client hung up, or only shut down its sending side and waits for the replies
+            if conn.inbuf.strip() and not conn.closing: self._serve_legacy(conn)
+            conn.eof = True
+            if conn.outbuf or conn.producer is not None or conn.pending:
+                self._selector.modify(conn.sock, selectors.EVENT_WRITE, conn)  # nothing more to read, and the socket would stay readable
+            else:
+                self._close(conn)
+            return
+        conn.lastactive = time.time()
+        if conn.closing: return
+        conn.inbuf += data
+        *lines, conn.inbuf = conn.inbuf.split(b'\n')
+        conn.pending.extend(line.strip().decode('utf-8', 'replace') for line in lines)
+        self._process(conn)
+        if len(conn.inbuf) > self.MAX_LINE:
+            self._send(conn, 'CNT:ERROR=LINE_TOO_LONG\r\n')
+            conn.closing = True
+
+    def _process( self, conn ):
+        # serve every complete line, so several pipelined commands are answered in order -- a streamed reply has to finish first
+        while conn.pending and conn.producer is None:
+            line = conn.pending.pop(0)
+            if line:
+                self._send(conn, self._execute(conn, line))
+                if not conn.closing: self._send(conn, b'\r\n')     # an HTTP reply is complete as it is
+                self._refill(conn)
+
+    def _refill( self, conn ):
+        # move the next chunks of a streamed reply to the output buffer, as long as the client keeps up
+        while conn.producer is not None and len(conn.outbuf) < self.MAX_BACKLOG:
+            try:
+                self._send(conn, next(conn.producer))
+            except StopIteration:
+                conn.producer = None
+            except Exception as err:
+                self.logger.warning('Error streaming reply to %s: %s', conn.addr, err)
+                self._send(conn, 'CNT:ERROR=FAILED\r\n')
+                conn.producer = None
+
+    def _write( self, conn ):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as err:
+            self.logger.debug('Send to %s failed: %s', conn.addr, err)
+            self._close(conn)
+            return
+        del conn.outbuf[:sent]
+        conn.lastactive = time.time()
+        if conn.producer is not None:
+            self._refill(conn)
+            if conn.producer is None: self._process(conn)   # stream finished, serve commands that came in meanwhile
+        if not conn.outbuf:
+            if conn.closing or (conn.eof and conn.producer is None and not conn.pending):
+                self._close(conn)
+            else:
+                self._selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def _serve_legacy( self, conn ):
+        # clients written for V1.0 send one command without line break and expect the connection to be closed after the reply
+        conn.legacy = True
+        line = conn.inbuf.strip().decode('utf-8', 'replace')
+        reply = self._execute(conn, line)
+        self._send(conn, reply)
+        if line != 'SVR:DATA': self._send(conn, b'\r\n')    # V1.0 sent the data entry without line break
+        self._refill(conn)
+        conn.inbuf = b''
+        conn.closing = True
+
+    def _check_timeouts( self ):
+        # returns the number of seconds until the next connection needs attention
+        now = time.time()
+        wait = self.idletimeout
+        if self._resume is not None:
+            if now >= self._resume:
+                self._selector.register(self._sock, selectors.EVENT_READ, None)
+                self._resume = None
+            else:
+                wait = self._resume - now
+        for conn in list(self._clients.values()):
+            try:
+                if conn.inbuf.strip() and not conn.closing:
+                    if now - conn.lastactive >= self.LINGER:
+                        self._serve_legacy(conn)
+                    else:
+                        wait = min(wait, conn.lastactive + self.LINGER - now)
+                if now - conn.lastactive >= self.idletimeout:
+                    self.logger.debug('Connection to %s timed out', conn.addr)
+                    self._close(conn)
+                else:
+                    wait = min(wait, conn.lastactive + self.idletimeout - now)
+            except Exception as err:
+                self._drop(conn, err)
+        return max(wait, 0.0)
+
+    def _drop( self, conn, err ):
+        # an error serving one client only ends its own connection
+        self.logger.warning('Error serving %s, closing the connection: %s', conn.addr, err)
+        self._close(conn)
+
     def _wkr_server( self ):
+        wait = self.idletimeout
         while True:
             try:
-                conn, addr = self._sock.accept()
-                self.logger.debug('Accepted connection from ' + str(addr))
-                data = conn.recv(self.BUFFER_SIZE).strip()
-                self.logger.debug('Received command string ' + data)
-                if data == 'SVR:HELLO':
-                    conn.send('CNT:HELLO=RP_AUTO_SERVER_V1.0\r\n')
-                elif data == 'SVR:DATA':
-                    self.logger.debug('Sending data entry to client... <' + str(addr) + '>')
-                    conn.send('CNT:DATA=' + self.GatherModuleData())
-                else:
-                    conn.send('CNT:ERROR=UNKNOWN_CMD\r\n')
-                conn.close()
-                self.logger.debug('Closing connection to ' + str(addr))
+                for key, mask in self._selector.select(wait):
+                    if key.data is None:
+                        self._accept()
+                        continue
+                    if key.data is self._wakeup:
+                        self._push()
+                        continue
+                    try:
+                        if mask & selectors.EVENT_READ: self._read(key.data)
+                        if mask & selectors.EVENT_WRITE and key.data.sock in self._clients: self._write(key.data)
+                    except Exception as err:
+                        if not self.DoRun: raise
+                        self._drop(key.data, err)
+                wait = self._check_timeouts()
             except Exception as err:    # when rp_auto_ctrl finishes, this thread will try to still use _sock -- catch that
                 if not self.DoRun:
                     self.logger.debug('Terminating listener thread')
                 else:
-                    self.logger.warning('Terminating listener thread because of an error: ' + str(err))
+                    self.logger.warning('Terminating listener thread because of an error: %s', err)
                 break
-    
+
     def _on_exit( self ):
-        self.logger.debug('Closing IPv4/TCP port [' + str(self._sock.getsockname()[1]) + ']')
+        self.logger.debug('Closing IPv4/TCP port [%s]', self._sock.getsockname()[1])
         self.DoRun = False
+        for conn in list(self._clients.values()):
+            conn.sock.close()
         try:
-            self._sock.shutdown(socket.SHUT_RDWR) 
+            self._sock.shutdown(socket.SHUT_RDWR)
         except Exception as err:
-            self.logger.warning('Encountered error during socket shutdown: ' + str(err))
-        self._sock.close() 
-             
+            self.logger.warning('Encountered error during socket shutdown: %s', err)
+        self._sock.close()
+        self._selector.close()
+        self._wakeup.close()
+        self._wakeup_sender.close()
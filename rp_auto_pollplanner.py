@@ -0,0 +1,74 @@
+from collections import deque
+
+class PollPlanner:
+    """Places the next poll of a station by the predicted time until the scale crosses a threshold.
+
+    The rate at which the weight changes is estimated online by a least-squares fit over the recent
+    readings, separately for boil-off (pump off) and filling (pump on). When the pump is switched,
+    the estimate from the previous period of the same kind is used until enough new readings are in,
+    so the first fill after a restart is the only one polled at the fixed interval throughout.
+
+    The next poll is placed at a fraction (safety) of the predicted time to the crossing, but never
+    closer than mininterval, and never further than maxinterval or the fixed interval of the current
+    pump state, idleinterval or fillinterval. The latter keeps the scale and the pump state checked
+    at least as often as with fixed intervals, so neither a fill nor a pump switched on from aside
+    goes unwatched for longer; approaching a threshold, the interval shrinks geometrically.
+
+    Args:
+        minweight, maxweight: Thresholds of the scale, see [runparams].
+        idleinterval, fillinterval: Fixed intervals used while there is no estimate, pollinterval and pollintwhilepumping.
+        mininterval, maxinterval: Bounds of the planned interval in seconds.
+        window: Seconds of readings the rate is fitted over.
+        safety: Fraction of the predicted time to the crossing to wait.
+    """
+
+    MIN_SAMPLES = 3     # readings needed for a fit
+
+    def __init__( self, minweight, maxweight, idleinterval, fillinterval, mininterval = 1.0, maxinterval = 60.0, window = 300.0, safety = 0.5 ):
+        self.minweight = float(minweight)
+        self.maxweight = float(maxweight)
+        self.idleinterval = float(idleinterval)
+        self.fillinterval = float(fillinterval)
+        self.mininterval = float(mininterval)
+        self.maxinterval = float(maxinterval)
+        self.window = float(window)
+        self.safety = float(safety)
+        self.Rates = {False: None, True: None}  # latest estimate in kg/s, with the pump off and on
+        self._samples = deque()     # (time, weight) since the pump was last switched
+        self._pumping = None
+
+    def Observe( self, timestamp, weight, pumping ):
+        """Adds a scale reading, taken with the pump in the given state."""
+        if weight != weight: return     # NaN, no reading
+        if pumping != self._pumping:
+            self._samples.clear()   # a new period, the old readings follow a different slope
+            self._pumping = pumping
+        self._samples.append((timestamp, weight))
+        while self._samples[0][0] < timestamp - self.window: self._samples.popleft()
+        rate = self._fit()
+        if rate is not None: self.Rates[pumping] = rate
+
+    def _fit( self ):
+        # slope of the least-squares line through the readings
+        n = len(self._samples)
+        if n < self.MIN_SAMPLES: return None
+        t0 = self._samples[0][0]
+        mt = sum(t - t0 for t, w in self._samples)/n
+        mw = sum(w for t, w in self._samples)/n
+        stt = sum((t - t0 - mt)**2 for t, w in self._samples)
+        if stt <= 0: return None
+        return sum((t - t0 - mt)*(w - mw) for t, w in self._samples)/stt
+
+    def Next( self, weight, pumping ):
+        """Returns the number of seconds until the next poll, given the latest weight and the current pump state."""
+        fallback = self.fillinterval if pumping else self.idleinterval
+        rate = self.Rates[pumping]
+        if weight != weight or rate is None: return fallback
+        if pumping:
+            distance, speed = self.maxweight - weight, rate
+        else:
+            distance, speed = weight - self.minweight, -rate
+        if distance <= 0: return self.mininterval   # already across, the next pass acts on it
+        if speed <= 0: return fallback     # not moving towards the threshold
+        longest = min(self.maxinterval, fallback)  # never wait longer than with fixed intervals
+        return min(max(self.safety*distance/speed, self.mininterval), longest)
@@ -0,0 +1,59 @@
+import threading
+import time
+import math
+
+class RingBuffer:
+    """Fixed-size buffer of timestamped samples.
+
+    Once the buffer is full, every new sample overwrites the oldest one, so the
+    memory footprint stays constant no matter how long the program runs. The buffer
+    may be written by a reader thread and queried from the control loop at the same time.
+    """
+
+    def __init__( self, size ):
+        self.size = int(size)
+        self._times = [0.0] * self.size
+        self._values = [float("nan")] * self.size
+        self._count = 0     # total number of samples ever appended
+        self._lock = threading.Lock()
+
+    def Append( self, value, timestamp = None ):
+        with self._lock:
+            idx = self._count % self.size
+            self._times[idx] = time.time() if timestamp is None else timestamp
+            self._values[idx] = value
+            self._count += 1
+
+    def Latest( self ):
+        """Returns the newest sample as (timestamp, value), or None if the buffer is empty."""
+        with self._lock:
+            if not self._count: return None
+            idx = (self._count - 1) % self.size
+            return self._times[idx], self._values[idx]
+
+    def Window( self, seconds, now = None ):
+        """Returns the values of all samples from the last seconds, oldest first."""
+        cutoff = (time.time() if now is None else now) - seconds
+        retval = []
+        with self._lock:
+            for n in range(self._count - 1, max(self._count - self.size, 0) - 1, -1):   # walk backwards from the newest sample
+                idx = n % self.size
+                if self._times[idx] < cutoff: break
+                retval.append(self._values[idx])
+        retval.reverse()
+        return retval
+
+    def Statistics( self, seconds, now = None ):
+        """Returns min, max and mean of all non-NaN samples from the last seconds.
+
+        Returns:
+            A dictionary with the keys "min", "max", "mean" and "count". If no sample is
+            available, the statistics are NaN and "count" is 0.
+        """
+        values = [x for x in self.Window(seconds, now) if not math.isnan(x)]
+        if not values:
+            return {"min": float("nan"), "max": float("nan"), "mean": float("nan"), "count": 0}
+        return {"min": min(values), "max": max(values), "mean": sum(values)/len(values), "count": len(values)}
+
+    def __len__( self ):
+        return min(self._count, self.size)
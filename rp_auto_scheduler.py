@@ -0,0 +1,69 @@
+import threading
+import heapq
+import itertools
+import time
+import atexit
+import logging
+
+class Scheduler:
+    """Runs callbacks at given times from a single worker thread.
+
+    Pending events are kept in a heap, so scheduling and firing an event costs O(log n), no matter
+    how many timers are active. Callbacks run on the worker thread and should return quickly.
+    """
+
+    def __init__( self, loggername = ""):
+        self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
+        self._heap = []
+        self._sequence = itertools.count()   # keeps events that are due at the same time in order
+        self._cond = threading.Condition()
+        self.DoRun = True   # indicates graceful shutdown to worker thread
+        self._thread = threading.Thread(target=self._wkr_scheduler)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self._on_exit)
+
+    def Schedule( self, when, callback ):
+        """Runs callback() at time when, in seconds since the epoch.
+
+        Returns:
+            A handle that can be passed to Cancel().
+        """
+        event = [when, next(self._sequence), callback]
+        with self._cond:
+            heapq.heappush(self._heap, event)
+            if self._heap[0] is event: self._cond.notify()  # new earliest event, wake the worker
+        return event
+
+    def Cancel( self, event ):
+        """Keeps an event returned by Schedule() from firing; cancelling one that has fired already does nothing."""
+        with self._cond:
+            event[2] = None     # removed lazily when it comes up
+
+    def _wkr_scheduler( self ):
+        while True:
+            with self._cond:
+                while self.DoRun and (not self._heap or self._heap[0][0] > time.time()):
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if not self.DoRun: break
+                callback = heapq.heappop(self._heap)[2]
+            if callback is None: continue
+            try:
+                callback()
+            except Exception as err:
+                self.logger.warning('Error in scheduled callback: %s', err)
+
+    def _on_exit( self ):
+        with self._cond:
+            self.DoRun = False
+            self._cond.notify()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def SharedScheduler( loggername = ""):
+    """Returns the scheduler shared by all users in this process, creating it on first use."""
+    global _shared
+    with _shared_lock:
+        if _shared is None: _shared = Scheduler(loggername)
+        return _shared
@@ -0,0 +1,350 @@
+import os
+import sys
+import tty
+import time
+import random
+import select
+import threading
+import logging
+
+# Simulated devices on pseudo-terminals, for running drivers and controller without the hardware.
+# Every device opens a pty pair and serves its protocol on the master side; the drivers open the
+# slave side by its name below /dev, e.g. "pts/3", exactly as they would open "ttyUSB0".
+
+LN2_DENSITY = 0.808     # kg per liter
+
+class FillModel:
+    """LN2 transfer from a storage dewar into the detector dewar standing on the scale.
+
+    The detector dewar loses boiloff kg per second and gains pumprate kg per second while the
+    pump runs, as long as the storage dewar is not empty. Simulated time runs speed times faster
+    than real time, so a whole fill cycle can be observed in seconds.
+
+    Args:
+        speed: Simulated seconds per real second.
+        storage: LN2 in the storage dewar in kg.
+        volume, height: Size of the storage dewar in liters and cm, sets the level read from the pump.
+        content: LN2 in the detector dewar in kg, as weighed by the scale.
+        boiloff, pumprate: Loss and fill rate of the detector dewar in kg per simulated second.
+        getter: Mean getter pump reading shown by the multimeter.
+    """
+
+    def __init__( self, speed = 1.0, storage = 50.0, volume = 100.0, height = 100.0, content = 0.5,
+                  boiloff = 1e-4, pumprate = 5e-3, getter = 0.01 ):
+        self.speed = float(speed)
+        self.storage = float(storage)
+        self.volume = float(volume)
+        self.height = float(height)
+        self.content = float(content)
+        self.boiloff = float(boiloff)
+        self.pumprate = float(pumprate)
+        self.getter = float(getter)
+        self.running = False
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def Advance( self ):
+        """Brings the model up to the current time."""
+        with self._lock:
+            now = time.time()
+            dt = (now - self._last)*self.speed
+            self._last = now
+            transfer = min(self.pumprate*dt, self.storage) if self.running else 0.0
+            self.storage -= transfer
+            self.content = max(self.content + transfer - self.boiloff*dt, 0.0)
+
+    def SetPump( self, running ):
+        self.Advance()
+        self.running = running
+
+    def Level( self ):
+        """Returns the level of the storage dewar in cm."""
+        self.Advance()
+        return self.storage/LN2_DENSITY/self.volume*self.height
+
+    def Weight( self ):
+        self.Advance()
+        return self.content
+
+class _Device:
+    # one end of a pty pair with a thread that feeds everything received to Receive()
+
+    def __init__( self, latency = 0.0, dropout = 0.0, loggername = ""):
+        self.logger = logging.getLogger(loggername or 'rp_auto_sim')
+        self.latency = float(latency)   # seconds until a reply is sent
+        self.dropout = float(dropout)   # probability that a command is not answered at all
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)     # no echo, no line editing -- the slave stays open, so the master never sees a hangup
+        os.set_blocking(self._master, False)   # output nobody reads is dropped instead of blocking the device
+        self.Port = os.ttyname(self._slave)[len('/dev/'):]
+        self.DoRun = True
+        self._buf = b''
+        self._thread = threading.Thread(target=self._wkr_device)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _wkr_device( self ):
+        while self.DoRun:
+            if not select.select([self._master], [], [], 0.05)[0]:
+                self.Idle()
+                continue
+            try:
+                self.Receive(os.read(self._master, 1024))
+            except BlockingIOError:
+                pass
+            except OSError:
+                break
+
+    def Receive( self, data ):
+        pass
+
+    def Idle( self ):
+        pass
+
+    def Reply( self, data ):
+        if random.random() < self.dropout:
+            self.logger.debug('Dropping reply on %s', self.Port)
+            return
+        if self.latency: time.sleep(self.latency)
+        self.Send(data)
+
+    def Send( self, data ):
+        try:
+            os.write(self._master, data.encode('ascii') if isinstance(data, str) else data)
+        except BlockingIOError:
+            pass    # the pty buffer is full, like an overrun serial line
+
+    def Close( self ):
+        self.DoRun = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+class SimPump(_Device):
+    """LN2 pump controller: "i", "rm <addr> <n>", "re <addr> <n>", "pon" and "pof", each answered with lines ending in "Ready".
+
+    Commands end with a carriage return; the PySerial path of the driver sends none, so a command
+    is also taken as complete once the line has been quiet for one idle period.
+    """
+
+    def __init__( self, model, identity = 'LN2-PUMP SIM 0001', offsets = None, **kwargs ):
+        self.model = model
+        self.identity = identity    # returned by "i"
+        self.offsets = offsets or {"pumpsensoroffset": 145, "auxsensoroffset": 145, "levelsensoroffset": 38}
+        _Device.__init__(self, **kwargs)
+
+    def Receive( self, data ):
+        self._buf += data
+        while b'\r' in self._buf:
+            cmd, self._buf = self._buf.split(b'\r', 1)
+            self._command(cmd.decode('ascii', 'replace').strip())
+
+    def Idle( self ):
+        if self._buf.strip():
+            cmd, self._buf = self._buf, b''
+            self._command(cmd.decode('ascii', 'replace').strip())
+
+    def _memory( self ):
+        level = int(round(self.model.Level()*LN2_DENSITY/0.542888)) + self.offsets["levelsensoroffset"]
+        pumptemp = self.offsets["pumpsensoroffset"] + (-20 if self.model.running else 20)
+        auxtemp = self.offsets["auxsensoroffset"] + 20
+        return {0x114: [1 if self.model.running else 0], 0x0ce: [max(0, min(level, 255))],
+                0x086: [pumptemp & 0xff, pumptemp >> 8], 0x084: [auxtemp & 0xff, auxtemp >> 8]}
+
+    def _eeprom( self ):
+        return {0x016: [self.offsets["pumpsensoroffset"] & 0xff, self.offsets["pumpsensoroffset"] >> 8],
+                0x014: [self.offsets["auxsensoroffset"] & 0xff, self.offsets["auxsensoroffset"] >> 8],
+                0x01c: [self.offsets["levelsensoroffset"] & 0xff, self.offsets["levelsensoroffset"] >> 8]}
+
+    def _read( self, space, addr, length ):
+        cells = {}
+        for start, data in (self._memory() if space == 'rm' else self._eeprom()).items():
+            for n, b in enumerate(data): cells[start + n] = b
+        return [cells.get(addr + n, 0) for n in range(length)]
+
+    def _command( self, cmd ):
+        words = cmd.split()
+        if not words: return
+        lines = [cmd]   # the pump echoes the command
+        if words[0] == 'i':
+            lines += ['Device:  ' + self.identity, 'Firmware: 2.1', 'Sensors: 2', 'Level sensor: 1']
+        elif words[0] in ('rm', 're') and len(words) == 3:
+            addr, length = int(words[1], 16), int(words[2])
+            lines.append('{:03x}: '.format(addr) + ' '.join('{:02x}'.format(b) for b in self._read(words[0], addr, length)))
+        elif words[0] in ('pon', 'pof'):
+            self.model.SetPump(words[0] == 'pon')
+            lines.append('Pump ' + ('on' if self.model.running else 'off'))
+        else:
+            lines.append('Unknown command')
+        lines.append('Ready')
+        self.Reply(''.join(line + '\r\n' for line in lines))
+
+class SimScale(_Device):
+    """KERN scale: answers "w" with the current weight, or transmits continuously if stream is set."""
+
+    def __init__( self, model, noise = 0.0, stream = False, period = 0.1, **kwargs ):
+        self.model = model
+        self.noise = float(noise)   # standard deviation of the reading in kg
+        self.stream = stream
+        self.period = float(period)     # seconds between two readings in stream mode
+        self._next = 0.0
+        _Device.__init__(self, **kwargs)
+
+    def _reading( self ):
+        return '{:9.3f} kg\r\n'.format(self.model.Weight() + random.gauss(0.0, self.noise))
+
+    def Receive( self, data ):
+        for _ in range(data.count(b'w')): self.Reply(self._reading())
+
+    def Idle( self ):
+        if self.stream and time.time() >= self._next:
+            self._next = time.time() + self.period
+            self.Send(self._reading())
+
+class SimMMeter(_Device):
+    """Multimeter that transmits 11-byte records continuously, see rp_auto_mod_mmeter.parseReading()."""
+
+    UNITS = {"V": (11, 0, 1e-3), "A": (9, 0, 1e-2), "mA": (15, 1, 1e-1), "uA": (13, 1, 1)}     # mode nibble, range, value of the last digit
+
+    def __init__( self, model, unit = 'A', noise = 0.0, overload = 0.0, period = 0.1, **kwargs ):
+        self.model = model
+        self.unit = unit
+        self.noise = float(noise)   # standard deviation of the reading
+        self.overload = float(overload)     # probability of an overload record
+        self.period = float(period)
+        _Device.__init__(self, **kwargs)
+
+    def _record( self ):
+        mode, rng, step = self.UNITS[self.unit]
+        value = self.model.getter + random.gauss(0.0, self.noise)
+        digits = min(int(round(abs(value)/step)), 9999)
+        flags = (0b0100 if value < 0 else 0) | (0b0001 if random.random() < self.overload else 0)
+        nibbles = [rng] + [int(d) for d in '{:04d}'.format(digits)] + [mode, flags, 0, 0]
+        return bytes(0x30 | n for n in nibbles) + b'\r\n'   # high nibble keeps every byte clear of CR and LF
+
+    def Idle( self ):
+        if random.random() >= self.dropout: self.Send(self._record())
+        time.sleep(self.period)
+
+class SimModem(_Device):
+    """WAVECOM GSM modem in text mode. Sent short mails are collected in Sent, incoming ones are injected with Deliver()."""
+
+    def __init__( self, pin = None, **kwargs ):
+        self.pin = pin  # if set, the SIM asks for it once
+        self.Sent = []  # (address, text) of every short mail sent
+        self._inbox = {}
+        self._text = None   # recipient while the text of a short mail is being entered
+        _Device.__init__(self, **kwargs)
+
+    def Deliver( self, sender, text ):
+        """Simulates an incoming short mail."""
+        index = max(self._inbox or [0]) + 1
+        self._inbox[index] = (sender, text)
+        self.Send('\r\n+CMTI: "SM",' + str(index) + '\r\n')
+
+    def Receive( self, data ):
+        self._buf += data
+        while True:
+            if self._text is not None:
+                if b'\x1a' not in self._buf: return
+                text, self._buf = self._buf.split(b'\x1a', 1)
+                self.Sent.append((self._text, text.decode('utf-8', 'replace')))
+                self._text = None
+                self.Reply(text.decode('utf-8', 'replace') + '\r\n+CMGS: ' + str(len(self.Sent)) + '\r\n\r\nOK\r\n')
+            elif b'\r' in self._buf:
+                cmd, self._buf = self._buf.split(b'\r', 1)
+                self._command(cmd.decode('ascii', 'replace').strip())
+            else:
+                return
+
+    def _command( self, cmd ):
+        if not cmd: return
+        reply = cmd + '\r\r\n'  # echo
+        if cmd == 'AT+CGMI':
+            reply += 'WAVECOM MODEM\r\n\r\nOK\r\n'
+        elif cmd == 'AT+CPIN?':
+            reply += ('+CPIN: SIM PIN' if self.pin else '+CPIN: READY') + '\r\n\r\nOK\r\n'
+        elif cmd.startswith('AT+CPIN='):
+            ok = cmd[len('AT+CPIN='):] == self.pin
+            if ok: self.pin = None
+            reply += 'OK\r\n' if ok else 'ERROR\r\n'
+        elif cmd == 'AT+CREG?':
+            reply += '+CREG: 0,1\r\n\r\nOK\r\n'
+        elif cmd.startswith('AT+CMGS='):
+            self._text = cmd[len('AT+CMGS='):].strip('"')
+            reply += '> '
+        elif cmd.startswith('AT+CMGR='):
+            message = self._inbox.get(int(cmd[len('AT+CMGR='):]))
+            if message is None:
+                reply += '+CMS ERROR: 321\r\n'
+            else:
+                reply += '+CMGR: "REC UNREAD","' + message[0] + '",,"' + time.strftime('%y/%m/%d,%H:%M:%S') + '"\r\n' + message[1] + '\r\n\r\nOK\r\n'
+        elif cmd.startswith('AT+CMGD='):
+            self._inbox.pop(int(cmd[len('AT+CMGD='):]), None)
+            reply += 'OK\r\n'
+        elif cmd.startswith('AT'):
+            reply += 'OK\r\n'
+        else:
+            reply += 'ERROR\r\n'
+        self.Reply(reply)
+
+class Simulator:
+    """A modem and, for every station, a pump, scale and multimeter sharing one FillModel.
+
+    Args:
+        stations: Station names, see rp_auto_station; [''] simulates a plain single-station setup.
+        speed: Simulated seconds per real second, passed to every FillModel.
+        latency, dropout: Passed to every device.
+        noise: Standard deviation of the scale readings in kg.
+    """
+
+    def __init__( self, stations = ('',), speed = 1.0, latency = 0.0, dropout = 0.0, noise = 0.0, loggername = ""):
+        self.logger = logging.getLogger(loggername or 'rp_auto_sim')
+        options = dict(latency = latency, dropout = dropout, loggername = loggername)
+        self.modem = SimModem(latency = latency, loggername = loggername)
+        self.stations = {}
+        for n, name in enumerate(stations):
+            model = FillModel(speed)
+            self.stations[name] = {"model": model,
+                                   "pump": SimPump(model, identity = 'LN2-PUMP SIM {:04d}'.format(n + 1), **options),
+                                   "scale": SimScale(model, noise = noise, **options),
+                                   "mmeter": SimMMeter(model, **options)}
+            self.logger.info('Simulating station [%s] on %s', name, ', '.join(kind + ' ' + self.stations[name][kind].Port for kind in ('pump', 'scale', 'mmeter')))
+
+    def WriteSetup( self, path, serverport = 11111, **runparams ):
+        """Writes a controller configuration for the simulated ports to path + '.ini', with runparams overriding [runparams]."""
+        lines = ['[modem]', 'port: ' + self.modem.Port, '', '[server]', 'port: ' + str(serverport), '']
+        directory = os.path.dirname(os.path.abspath(path))
+        for name, devices in self.stations.items():
+            suffix = ':' + name if name else ''
+            lines += ['[pump' + suffix + ']', 'tty: ' + devices["pump"].Port, 'calibrationfile: ' + os.path.join(directory, 'rp_auto_calibration.json'), '',
+                      '[scale' + suffix + ']', 'port: ' + devices["scale"].Port, '',
+                      '[mmeter' + suffix + ']', 'port: ' + devices["mmeter"].Port, 'outunit: ' + devices["mmeter"].unit, '']
+        lines += ['[logging]', 'logfile: ' + os.path.join(directory, 'rp_auto_log.txt'),
+                  'telemetryfile: ' + os.path.join(directory, 'rp_auto_telemetry.bin'), '',
+                  '[runparams]', 'quitfile: ' + os.path.join(directory, 'rp_auto_quit'),
+                  'provokefile: ' + os.path.join(directory, 'rp_auto_provoke')]
+        lines += [key + ': ' + str(value) for key, value in runparams.items()]
+        with open(path + '.ini', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def Close( self ):
+        for device in [self.modem] + [devices[kind] for devices in self.stations.values() for kind in ('pump', 'scale', 'mmeter')]:
+            device.Close()
+
+def main( argv ):
+    # rp_auto_sim.py <directory> [speed] [station ...] -- simulates the devices and runs the controller against them
+    if len(argv) < 2:
+        sys.stderr.write('Usage: ' + argv[0] + ' <directory> [speed] [station ...]\n')
+        return 1
+    logging.basicConfig(level=logging.INFO)
+    speed = float(argv[2]) if len(argv) > 2 else 60.0
+    sim = Simulator(argv[3:] or [''], speed)
+    setup = os.path.join(argv[1], 'rp_auto_setup')
+    sim.WriteSetup(setup)
+    from rp_auto_ctrl import _runtime
+    _runtime(setup)._run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -3,8 +3,9 @@ import time
 import sys
 import logging
 import datetime
+import threading
 
-from thread import start_new_thread
+from rp_auto_scheduler import SharedScheduler
 
 class SmsWarning:
     
@@ -12,46 +13,57 @@ class SmsWarning:
     last_issued = 0 # is updated whenever the warning is encountered
     last_emit = 0 # is only updated when a notification message is sent
 
-    def __init__( self, name, modem, recipients, time_suppress, time_resolve, loggername = ""):
+    def __init__( self, name, modem, recipients, time_suppress, time_resolve, scheduler = None, loggername = ""):
         self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
-        self.logger.info('Created issue tracker <' + name + '>.')
+        self.logger.info('Created issue tracker <%s>.', name)
         self.name = name    # an identifier
         self.modem = modem    # the ModuleModem object
         self.recipients = recipients    # the list of notification recipients, directly passed to modem's SendSMS() method
         self.suppress = time_suppress    # the time interval in seconds after a notification has been sent for which no new one will be sent if the warning condition is encountered again
         self.release = time_resolve     # the time interval in seconds after which an issue is considered resolved if the warning is not encountered again
-        start_new_thread(self._wkr_warning, ()) # start new thread to track time_resolve independently
+        self.scheduler = scheduler or SharedScheduler(loggername)     # one timer thread for all warnings, tracks time_resolve independently
+        self._lock = threading.RLock()    # Emit() and the resolve timer may run at the same time
+        self._timer = None    # the pending resolve timer, cancelled when the warning is resolved by other means
         atexit.register(self._on_exit)
         
 
-    def _wkr_warning( self ):
+    def _on_timer( self ):
     
-        while True:
-            if self.IsIssued(): # warning is marked as "active"...
-                if abs(datetime.datetime.now() - self.last_issued).total_seconds() >= self.release:    # ... but has not been encountered for self.release seconds
-                    self.Resolve()
-            time.sleep(10)  # need some time here to avoid hogging resources, but not too long w.r.t. self.release
+        with self._lock:
+            if not self.IsIssued(): return  # resolved in the meantime
+            remaining = self.release - abs(datetime.datetime.now() - self.last_issued).total_seconds()
+            if remaining <= 0:    # warning is marked as "active", but has not been encountered for self.release seconds
+                self.Resolve()
+            else:   # encountered again since the timer was set, so wait until exactly self.release seconds after that
+                self._timer = self.scheduler.Schedule(time.time() + remaining, self._on_timer)
 
     def Emit( self, message='' ):
     
-        self.last_issued = datetime.datetime.now()      # update last_issued
-        is_first_issue = False
-        
-        if not self.IsIssued():
-            is_first_issue = True
-            self.first_issued = datetime.datetime.now()     # record current time in first_issued if this is the first time the warning is encountered
+        with self._lock:
+            self.last_issued = datetime.datetime.now()      # update last_issued
+            is_first_issue = False
             
-        if is_first_issue or (abs(self.last_issued - self.last_emit).total_seconds() >= self.suppress):
-            self.modem.SendSMS(self.recipients, 'Warning <' + self.name + '> active since ' + self.first_issued.strftime("%Y-%m-%d %H:%M") + ': ' + message)
-            self.last_emit = self.last_issued
-        else:
-            self.logger.debug('Suppressed warning <' + self.name + '>.')
+            if not self.IsIssued():
+                is_first_issue = True
+                self.first_issued = datetime.datetime.now()     # record current time in first_issued if this is the first time the warning is encountered
+                self._timer = self.scheduler.Schedule(time.time() + self.release, self._on_timer)
+                
+            if is_first_issue or (abs(self.last_issued - self.last_emit).total_seconds() >= self.suppress):
+                self.modem.SendSMS(self.recipients, 'Warning <' + self.name + '> active since ' + self.first_issued.strftime("%Y-%m-%d %H:%M") + ': ' + message, key = self.name)
+                self.last_emit = self.last_issued
+            else:
+                self.logger.debug('Suppressed warning <%s>.', self.name)
             
     def Resolve( self ):
     
-        self.modem.SendSMS(self.recipients, 'Warning <' + self.name + '> has been resolved (active since ' + self.first_issued.strftime("%Y-%m-%d %H:%M") + ').')
-        self.first_issued = 0
-        self.last_emit = 0 # \ch: for safety? -- shouldn't be necessary bc last_emit is overwritten once is_first_issue is detected in Emit()
+        with self._lock:
+            if not self.IsIssued(): return
+            if self._timer is not None:    # resolved before the timer fired, so it must not run on into a later issue
+                self.scheduler.Cancel(self._timer)
+                self._timer = None
+            self.modem.SendSMS(self.recipients, 'Warning <' + self.name + '> has been resolved (active since ' + self.first_issued.strftime("%Y-%m-%d %H:%M") + ').', key = self.name)
+            self.first_issued = 0
+            self.last_emit = 0 # \ch: for safety? -- shouldn't be necessary bc last_emit is overwritten once is_first_issue is detected in Emit()
        
     def IsIssued( self ):
     
@@ -59,4 +71,5 @@ class SmsWarning:
         
     def _on_exit( self ):
     
-        self.logger.debug('Closed issue <' + self.name + '>.')
+        if self._timer is not None: self.scheduler.Cancel(self._timer)
+        self.logger.debug('Closed issue <%s>.', self.name)
@@ -0,0 +1,277 @@
+import os
+import time
+import datetime
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from rp_auto_mod_scale import ModuleScale
+from rp_auto_mod_pump import ModulePump
+from rp_auto_mod_mmeter import ModuleMMeter
+from rp_auto_acquisition import Acquisition
+from rp_auto_timeseries import TimeSeriesStore
+from rp_auto_telemetry import TelemetryWriter
+from rp_auto_status import MakeSnapshot
+from rp_auto_smswarning import SmsWarning
+from rp_auto_metrics import SharedRegistry, Instrument
+from rp_auto_pollplanner import PollPlanner
+
+class Station:
+    """One dewar with its scale, LN2 pump and getter pump multimeter.
+
+    Stations are set up from the [scale], [pump], [mmeter] and [runparams] sections of the
+    configuration, overridden by the sections named after the station, e.g. [pump:det1]. The
+    controller calls Poll() whenever the station is due; modem and server are shared by all stations.
+    """
+
+    HISTORY_CHANNELS = ['scale', 'pump', 'level', 'mmeter', 'duration']   # columns of the in-memory reading history
+    STAGES = ['acquire', 'control', 'getter', 'record', 'publish']  # parts of a pass that are timed separately
+
+    def __init__( self, name, config, modem, server, pool = None, metrics = None, devices = None, loggername = ""):
+        self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
+        self.name = name    # empty for the single station of a configuration without station sections
+        self.tag = '[' + name + '] ' if name else ''    # prefixed to log lines and notifications
+        self.modem = modem
+        self.server = server
+        self.logopts = config.GetSetup('logging')
+        self.runparams = config.GetSetup('runparams', name)
+        # set up the devices, unless they have been opened beforehand by OpenDevices()
+        self.scale, self.pump, self.mmeter = devices or Station.OpenDevices(name, config, self.logger.name)
+        self.acquisition = Acquisition(self.pump, self.scale, self.mmeter, pool = pool, loggername = self.logger.name)
+        # time every driver call and every stage of a pass
+        self.metrics = metrics or SharedRegistry()
+        Instrument(self.scale, ['GetValue'], self.metrics, station = name, device = 'scale')
+        Instrument(self.pump, ['GetPumpStatus', 'GetPumpState', 'GetPumpLevel', 'StartPump', 'StopPump'], self.metrics, station = name, device = 'pump')
+        Instrument(self.mmeter, ['GetValue'], self.metrics, station = name, device = 'mmeter')
+        self._stages = dict((stage, self.metrics.Histogram('rp_auto_stage_seconds', 'Duration of the stages of a control pass', station = name, stage = stage))
+                            for stage in self.STAGES + ['pass'])
+        self._passes = self.metrics.Counter('rp_auto_passes_total', 'Control passes run', station = name)
+        self._failures = self.metrics.Counter('rp_auto_pass_failures_total', 'Control passes that failed', station = name)
+        self._loopfails = self.metrics.Gauge('rp_auto_consecutive_failures', 'Control passes that failed in a row', station = name)
+        # process parameters
+        try:
+            self.lnlevel2fillings = float(self.runparams["dewarvolume"])/float(self.runparams["dewarheight"])*0.808/(float(self.runparams["maxweight"])-float(self.runparams["minweight"])) # scale ln2 level to total dewar volume, convert that to kg's (LN2 density is 0.808) and divide by "weight per pumping process"
+        except Exception as err:
+            self.logger.warning('%sCould not determine level-to-fillings conversion factor, setting it to 1: %s', self.tag, err)
+            self.lnlevel2fillings = 1.0
+        try:
+            historysize = int(self.runparams["historysize"])
+        except Exception as err:
+            self.logger.warning('%sCould not set history size, setting it to 100000: %s', self.tag, err)
+            historysize = 100000
+        self.history = TimeSeriesStore(self.HISTORY_CHANNELS, historysize)
+        self.server.Histories[name] = self.history
+        telemetryfile = self.logopts['telemetryfile']
+        if name:    # one file per station, e.g. rp_auto_telemetry_det1.bin
+            telemetryfile = os.path.splitext(telemetryfile)[0] + '_' + name + os.path.splitext(telemetryfile)[1]
+        self.telemetry = TelemetryWriter(telemetryfile, self.logopts['keeplogs'], loggername = self.logger.name)
+        try:
+            self.pollinterval = float(self.runparams["pollinterval"])
+            if self.pollinterval<1.0:
+                self.logger.warning('%spollinterval has to be at least 1.0 s', self.tag)
+                self.pollinterval = 1.0
+        except Exception as err:
+            self.logger.warning('%sCould not set polling interval, setting it to 1.0 s: %s', self.tag, err)
+            self.pollinterval = 1.0
+        try:
+            self.pollintwhilepumping = float(self.runparams["pollintwhilepumping"])
+            if self.pollintwhilepumping<1.0:
+                self.logger.warning('%spollintwhilepumping has to be at least 1.0 s', self.tag)
+                self.pollintwhilepumping = 1.0
+        except Exception as err:
+            self.logger.warning('%sCould not set pump polling interval, setting it to %.1f s: %s', self.tag, self.pollinterval, err)
+            self.pollintwhilepumping = self.pollinterval
+        try:
+            # place polls by the predicted time until the next threshold crossing, instead of the two fixed intervals
+            self.adaptive = int(self.runparams["adaptivepolling"]) != 0
+            self.planner = PollPlanner(self.runparams["minweight"], self.runparams["maxweight"], self.pollinterval, self.pollintwhilepumping,
+                                       max(float(self.runparams["minpollinterval"]), 1.0), self.runparams["maxpollinterval"],
+                                       self.runparams["ratewindow"], self.runparams["pollsafety"])
+        except Exception as err:
+            self.logger.warning('%sCould not set up adaptive polling, using fixed intervals: %s', self.tag, err)
+            self.adaptive = False
+        self._rates = dict((pumping, self.metrics.Gauge('rp_auto_weight_rate', 'Estimated change of the scale reading in kg/s', station = name, pump = 'on' if pumping else 'off'))
+                           for pumping in (False, True))
+        self._interval = self.metrics.Gauge('rp_auto_poll_interval_seconds', 'Time until the next pass', station = name)
+        self.maxpollfails = int(self.runparams["maxpollfails"])
+        # set up sms warning objects, named after the station so the notifications can be told apart
+        warn_interval = float(self.runparams['smswarninterval'])
+        warn_survive = float(self.runparams['smswarnsurvive'])
+        prefix = name + ':' if name else ''
+        self.WarnGetterV = SmsWarning(prefix + "GetterpumpVTooHigh", self.modem, self.logopts['address'], warn_interval, warn_survive, loggername = self.logger.name)
+        self.WarnPumpStart = SmsWarning(prefix + "PumpNotStarted", self.modem, self.logopts['address'], warn_interval, warn_survive, loggername = self.logger.name)
+        self.WarnPumpNoLN2 = SmsWarning(prefix + "DewarEmpty", self.modem, self.logopts['address'], warn_interval, warn_survive, loggername = self.logger.name)
+        self.WarnUser = SmsWarning(prefix + "UserProvoked", self.modem, self.logopts['address'], warn_interval, warn_survive, loggername = self.logger.name)
+        # initialize the control state
+        self.lastcheck = datetime.datetime.now()
+        self.value_pump = self.pump.GetPumpState()     # needs to be initialized here so the external shutdown detection works
+        self.value_scale = self.value_mmeter = self.level_pump = float('nan')
+        self.polltime = self.pollinterval
+        self.lastpass = None    # time.time() at the start of the previous pass, spikes since then are checked
+        self.loopfails = 0   # counts number of consecutive failed loop passes
+        self.loopcount = 0   # counts all loop passes, serves as version number of the published status
+        self.Done = False    # set once the station has stopped, the controller does not poll it any more
+        self.logger.info('%sLN2 control started', self.tag)
+
+    @staticmethod
+    def OpenDevices( name, config, loggername = "" ):
+        """Initializes scale, pump and multimeter of a station at the same time and returns them as a tuple.
+
+        The drivers do not depend on each other, so this takes as long as the slowest of them. It
+        may run before the modem and server the station needs are ready; pass the result to the
+        constructor as devices.
+
+        Raises:
+            Exception: If any of the devices could not be opened, after all three have been tried.
+        """
+        with ThreadPoolExecutor(max_workers=3) as startup:
+            scale = startup.submit(ModuleScale, **config.GetSetup('scale', name), loggername = loggername)
+            pump = startup.submit(ModulePump, **config.GetSetup('pump', name), loggername = loggername)
+            mmeter = startup.submit(ModuleMMeter, **config.GetSetup('mmeter', name), loggername = loggername)
+            return scale.result(), pump.result(), mmeter.result()
+
+    def _notify( self, text ):
+        self.modem.SendSMS(self.logopts['address'], self.tag + text)
+
+    def Poll( self ):
+        """Runs one control pass.
+
+        Returns:
+            The number of seconds until the station is due again. Done is set if the station stopped.
+        """
+        self.loopcount += 1
+        self._passes.Inc()
+        start = time.perf_counter()
+        try:
+            # DEBUG: provoke the emission of a warning by creating a file
+            if os.path.isfile(self.runparams["provokefile"]):
+                self.logger.info('%sWarning provokation file detected. Emitting...', self.tag)
+                self.WarnUser.Emit('This is a debug warning provoked by the user.')
+
+            # read all devices at once, so every decision below is based on the same consistent set of values
+            passstart = time.time()
+            stage = time.perf_counter()
+            snapshot = self.acquisition.Acquire()
+            stage = self._stages['acquire'].Since(stage)
+
+            # check whether pump was shut down from aside, i.e. the program has a different on/off state stored than what is current
+            # need to make this the only time that PumpState is queried for each loop. If we do it again when checking all the other components,
+            # the pump state may have changed in the couple of seconds it takes the serial commands to complete. This change would then not be detected
+            # in the next loop because the stored value_pump is then already False
+            if self.value_pump != snapshot.pump_state:
+                self.logger.warning('%sInconsistent pump state detected: should be %s, is %s', self.tag, self.value_pump, not self.value_pump)
+                self._notify('Inconsistent pump state detected: should be {}, is {}.{}'.format(self.value_pump,
+                                                                                              not self.value_pump,
+                                                                                              " Shutting down." if self.value_pump else ""
+                                                                                             )
+                            )
+                if self.value_pump:
+                    # pump was shut OFF from aside, so value_pump is still true despite the pump being turned off
+                    self.logger.info('%sPump was shut down, terminating...', self.tag)
+                    self.Done = True
+                    return 0.0
+                else:
+                    # pump was turned ON from aside, but value_pump is still false
+                    self.value_pump = not self.value_pump  # correct the stored state of the pump
+                    self.polltime = self.pollintwhilepumping # switch to (usually shorter) poll interval
+
+            # update the stored system state
+            self.value_mmeter = snapshot.mmeter
+            self.value_scale = snapshot.scale
+            self.level_pump = snapshot.pump_level
+            timestamp = snapshot.time
+            self.history.Append(timestamp,
+                                scale = snapshot.scale, pump = float(snapshot.pump_state), level = snapshot.pump_level,
+                                mmeter = snapshot.mmeter, duration = snapshot.duration)
+            if self.adaptive: self.planner.Observe(timestamp, snapshot.scale, snapshot.pump_state)
+
+            # toggle pump if necessary
+            if self.value_scale <= float(self.runparams["minweight"]):
+                # start the pump if it's not yet running
+                if not self.value_pump:
+                    if self.level_pump>0:
+                        self.logger.info('%sLower boundary crossing (%s) detected, attempting to start pump', self.tag, self.value_scale)
+                        try:
+                            self.pump.StartPump()
+                        except Exception as err:
+                            self.logger.warning('%sUnable to start pump: %s', self.tag, err)
+                            self.WarnPumpStart.Emit('Could not start pump: ' + str(err))
+                        else:
+                            self.value_pump = True  # so the external turn-on detection is not triggered
+                        self.lastcheck = datetime.datetime.now()
+                        self.polltime = self.pollintwhilepumping # switch to (usually shorter) poll interval
+
+                        self._notify(time.strftime("%Y-%m-%d %H:%M",time.gmtime()) + \
+                        ': Scale value is ' + str(self.value_scale) + \
+                        ' kg, starting LN2 pump. Dewar level is ' + "{:.1f}".format(self.level_pump) + \
+                        ' cm, so about ' +  "{:.1f}".format(self.level_pump*self.lnlevel2fillings) + \
+                        ' LN2 fillings remaining. Getter pump voltage is ' + str(self.value_mmeter) + ' ' + self.mmeter.OutUnit)    # send notification
+                    else:
+                        self.WarnPumpNoLN2.Emit('Unable to start pump because dewar is empty')
+            elif self.value_scale >= float(self.runparams["maxweight"]):
+                # stop the pump if it's still running
+                if self.value_pump:
+                    self.logger.info('%sUpper boundary crossing (%s) detected, attempting to stop pump', self.tag, self.value_scale)
+                    self.pump.StopPump()
+                    self.value_pump = False  # so the external shutdown detection is not triggered
+                    self.polltime = self.pollinterval # reset polltime
+                    self._notify(time.strftime("%Y-%m-%d %H:%M",time.gmtime()) + ': Scale value is ' + str(self.value_scale) + ' kg, stopping LN2 pump. Getter pump voltage is ' + str(self.value_mmeter) + ' ' + self.mmeter.OutUnit)
+
+            stage = self._stages['control'].Since(stage)
+
+            # check getter pump voltage, including spikes the multimeter recorded since the last pass -- polltime may have been changed above,
+            # and the station may have been polled later than planned, so the window is measured instead
+            stats = self.mmeter.GetStatistics(time.time() - (self.lastpass if self.lastpass is not None else passstart - self.polltime))
+            self.lastpass = passstart
+            peak_mmeter = max(abs(stats["min"]), abs(stats["max"])) if stats["count"] else abs(self.value_mmeter)
+            if peak_mmeter>float(self.runparams["maxgettervolt"]):
+                self.logger.warning('%sGetter pump voltage above maximum level (%s): %s, peak %s', self.tag, self.runparams["maxgettervolt"], self.value_mmeter, peak_mmeter)
+                self.WarnGetterV.Emit('Excessive getter pump voltage, is ' + str(self.value_mmeter) + ' (peak ' + str(peak_mmeter) + '), should be less than ' + self.runparams["maxgettervolt"])
+
+            if self.adaptive:
+                self.polltime = self.planner.Next(self.value_scale, self.value_pump)
+                for pumping, rate in self.planner.Rates.items():
+                    if rate is not None: self._rates[pumping].Set(rate)
+            self._interval.Set(self.polltime)
+            stage = self._stages['getter'].Since(stage)
+
+            # record the pass in the binary telemetry file
+            self.telemetry.Write(timestamp, self.value_scale, float(self.value_pump), self.level_pump, self.value_mmeter, time.time() - passstart)
+            stage = self._stages['record'].Since(stage)
+            # publish the outcome of this pass to the server and its subscribers
+            self.server.Publish(MakeSnapshot(self.loopcount, snapshot.timestamp, self.value_scale, self.value_pump, self.level_pump, self.value_mmeter, self.lastcheck, timestamp), self.name)
+            self._stages['publish'].Since(stage)
+
+        except Exception as err:
+            self.loopfails += 1
+            self._failures.Inc()
+            self.logger.warning('%sSystem polling failed for the %sth time: %s', self.tag, self.loopfails, err)
+        else:
+            # reset fail counter once a loop goes through
+            self.loopfails = 0
+        self._loopfails.Set(self.loopfails)
+        self._stages['pass'].Since(start)
+
+        # if polling the state fails unexpectedly too often, shut the station down -- the pump is stopped right here, as the other
+        # stations keep the process, and with it the exit handler of the pump, alive while nobody watches this scale any more
+        if self.loopfails >= self.maxpollfails:
+            self.logger.warning('%sSystem polling failed too often, shutting down', self.tag)
+            stopped = ''
+            try:
+                self.pump.StopPump()
+                self.value_pump = False
+            except Exception as err:
+                self.logger.error('%sCould not stop pump: %s', self.tag, err)
+                stopped = ' Could not stop pump: ' + str(err)
+            self._notify('System polling failed {} times, shutting down.{}'.format(self.loopfails, stopped))
+            self.Done = True
+        return self.polltime
+
+    def Status( self ):
+        """Returns the latest published state as text for a status short mail."""
+        snapshot = self.server.Snapshots.get(self.name)
+        if snapshot is None: return self.tag + 'No status available yet'
+        return self.tag + snapshot.timestamp.strftime("%Y-%m-%d %H:%M") + ': Scale value is ' + str(snapshot.scale) + ' kg, pump is ' + \
+            ('running' if snapshot.pump else 'off') + '. Dewar level is ' + "{:.1f}".format(snapshot.level) + \
+            ' cm. Getter pump voltage is ' + str(snapshot.mmeter) + ' ' + self.mmeter.OutUnit + \
+            '. Last pump start ' + snapshot.lastcheck.strftime("%Y-%m-%d %H:%M")
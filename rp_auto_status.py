@@ -0,0 +1,40 @@
+import json
+import math
+import struct
+
+from collections import namedtuple
+
+# binary layout: version, time, pump state, scale, level, mmeter, time of last pump check -- times in seconds since the epoch
+BINARY = struct.Struct('<Qd?dddd')
+
+# Status of the controller after one loop pass. Instances are never modified, and every encoding
+# served to clients is computed once on creation, so readers in other threads always see a
+# consistent view and serving a request costs no formatting work.
+StatusSnapshot = namedtuple('StatusSnapshot', ['version', 'timestamp', 'scale', 'pump', 'level', 'mmeter', 'lastcheck',
+                                               'tsv', 'json', 'binary'])
+
+def _epoch( dt ):
+    # unlike time.mktime(), this tells the two passes through the hour repeated at the end of daylight saving time apart by dt.fold,
+    # which datetime.now() and datetime.fromtimestamp() set
+    return dt.timestamp()
+
+def _finite( value ):
+    # JSON has no representation for NaN and infinity
+    return float(value) if math.isfinite(value) else None
+
+def MakeSnapshot( version, timestamp, scale, pump, level, mmeter, lastcheck, epoch = None ):
+    """Creates a StatusSnapshot from the values of one loop pass.
+
+    Args:
+        version: Number of the loop pass, increases with every snapshot.
+        timestamp: Time the readings were taken, as datetime.
+        scale, pump, level, mmeter: The readings, pump being the on/off state.
+        lastcheck: Time of the last pump start, as datetime.
+        epoch: Time the readings were taken, as time.time() value; derived from timestamp if not given.
+    """
+    tsv = 'OK' + '\t' + str(scale) + '\t' + str(pump) + '\t' + str(level) + '\t' + str(mmeter) + '\t' + str(lastcheck)
+    encoded_json = json.dumps({"version": version, "time": timestamp.isoformat(), "scale": _finite(scale), "pump": pump,
+                               "level": _finite(level), "mmeter": _finite(mmeter), "lastcheck": lastcheck.isoformat()})
+    binary = BINARY.pack(version, _epoch(timestamp) if epoch is None else epoch, pump, scale, level, mmeter, _epoch(lastcheck))
+    return StatusSnapshot(version, timestamp, scale, pump, level, mmeter, lastcheck,
+                          tsv.encode('utf-8'), encoded_json.encode('utf-8'), binary)
@@ -0,0 +1,154 @@
+import os
+import glob
+import mmap
+import shutil
+import struct
+import time
+import datetime
+import atexit
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # readers fall back to struct unpacking, which copies the records
+
+# file layout: 8-byte magic, followed by fixed-size little-endian records
+MAGIC = b'RPTELEM1'
+FIELDS = ['time', 'scale', 'pump', 'level', 'mmeter', 'duration']
+RECORD = struct.Struct('<' + 'd'*len(FIELDS))
+if numpy is not None:
+    DTYPE = numpy.dtype([(name, '<f8') for name in FIELDS])
+SUFFIX = '%Y-%m-%d'     # same naming scheme as the rotated text logs
+
+class TelemetryWriter:
+    """Appends one fixed-size binary record per control loop pass.
+
+    The file is rotated at midnight, the old one is renamed with a date suffix like the text
+    log, and only the newest keep rotated files are retained -- all of them if keep is 0, as
+    with the backupCount of the text log.
+    """
+
+    def __init__( self, path, keep = 7, loggername = ""):
+        self.logger = logging.getLogger(loggername or 'rp_auto_ctrl')
+        self.path = path
+        self.keep = int(keep)
+        self._file = None
+        if os.path.isfile(self.path):
+            day = datetime.date.fromtimestamp(os.path.getmtime(self.path))
+            if day != datetime.date.today(): self._rotate(day)   # left over from an earlier day
+        self._open(datetime.date.today())
+        atexit.register(self._on_exit)
+
+    def _open( self, day ):
+        self._day = day     # the day whose records go into the current file
+        self._file = open(self.path, 'ab')
+        if self._file.tell() == 0: self._file.write(MAGIC)
+        self.logger.debug('Writing telemetry to %s', self.path)
+
+    def _rotate( self, day ):
+        if self._file: self._file.close()
+        target = self.path + '.' + day.strftime(SUFFIX)
+        if os.path.exists(target):
+            # the clock was set back into a day that has been rotated already, keep the records of both files
+            with open(self.path, 'rb') as src, open(target, 'r+b') as dst:
+                dst.truncate(len(MAGIC) + max(os.fstat(dst.fileno()).st_size - len(MAGIC), 0) // RECORD.size * RECORD.size)   # drop a partially written last record
+                dst.seek(0, os.SEEK_END)
+                src.seek(len(MAGIC))
+                shutil.copyfileobj(src, dst)
+            os.remove(self.path)
+        else:
+            os.rename(self.path, target)
+        if not self.keep: return
+        for old in sorted(glob.glob(self.path + '.*'))[:-self.keep]:    # date suffixes sort chronologically
+            os.remove(old)
+
+    def Write( self, timestamp, scale, pump, level, mmeter, duration ):
+        day = datetime.date.fromtimestamp(timestamp)
+        if day != self._day:
+            self._rotate(self._day)
+            self._open(day)
+        self._file.write(RECORD.pack(timestamp, scale, pump, level, mmeter, duration))
+        self._file.flush()      # make the record visible to readers right away
+
+    def _on_exit( self ):
+        if self._file: self._file.close()
+
+class TelemetryReader:
+    """Memory-maps one telemetry file.
+
+    With NumPy, Records() and Range() return zero-copy structured views on the file, with one
+    field per entry of FIELDS. Without NumPy, they return lists of tuples.
+    """
+
+    def __init__( self, path ):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.count = max(size - len(MAGIC), 0) // RECORD.size   # ignores a partially written last record
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if self._map[:len(MAGIC)] != MAGIC[:size]: raise ValueError('Not a telemetry file: ' + path)
+
+    def _time_at( self, idx ):
+        return struct.unpack_from('<d', self._map, len(MAGIC) + idx*RECORD.size)[0]
+
+    def _bisect( self, timestamp ):
+        # index of the first record with time >= timestamp
+        if numpy is not None:
+            return int(numpy.searchsorted(self.Records()['time'], timestamp))
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid) < timestamp: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def Records( self, lo = 0, hi = None ):
+        hi = self.count if hi is None else hi
+        if numpy is not None:
+            if not self.count: return numpy.empty(0, dtype=DTYPE)
+            return numpy.frombuffer(self._map, dtype=DTYPE, count=self.count, offset=len(MAGIC))[lo:hi]
+        start = len(MAGIC) + lo*RECORD.size
+        return list(RECORD.iter_unpack(self._map[start:start + (hi - lo)*RECORD.size]))
+
+    def Range( self, start, end ):
+        """Returns all records with start <= time < end, times in seconds since the epoch."""
+        return self.Records(self._bisect(start), self._bisect(end))
+
+    def Close( self ):
+        if self._map: self._map.close()
+
+class TelemetryArchive:
+    """Gives access to the current telemetry file and all of its rotated predecessors."""
+
+    def __init__( self, path ):
+        self.path = path
+
+    def Files( self ):
+        # (first day covered, path) of every file, oldest first
+        retval = []
+        for name in glob.glob(self.path + '.*'):
+            try:
+                retval.append((datetime.datetime.strptime(name[len(self.path) + 1:], SUFFIX).date(), name))
+            except ValueError:
+                pass    # not a rotated telemetry file
+        retval.sort()
+        if os.path.isfile(self.path): retval.append((datetime.date.today(), self.path))
+        return retval
+
+    def Range( self, start, end ):
+        """Returns all records with start <= time < end from every file, see TelemetryReader.Range()."""
+        first, last = datetime.date.fromtimestamp(start), datetime.date.fromtimestamp(min(end, time.time()))
+        parts = []
+        for day, name in self.Files():
+            if name != self.path and not first <= day <= last: continue    # rotated files hold exactly one day
+            reader = TelemetryReader(name)
+            try:
+                part = reader.Range(start, end)
+                parts.append(part.copy() if numpy is not None else part)   # views on the map would not survive closing it
+                del part
+            finally:
+                reader.Close()
+        if numpy is not None:
+            return numpy.concatenate(parts) if parts else numpy.empty(0, dtype=DTYPE)
+        return [record for part in parts for record in part]
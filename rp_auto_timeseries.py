@@ -0,0 +1,139 @@
+import threading
+import time
+import bisect
+import math
+
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None    # fall back to the standard library array module
+
+class TimeSeriesStore:
+    """Columnar in-memory history of device readings.
+
+    Timestamps and one float column per channel are kept in preallocated rings, so appending
+    is O(1) and the memory footprint is fixed by the capacity. Columns are NumPy arrays if
+    NumPy is available and array('d') otherwise. Timestamps are seconds since the epoch and
+    have to be appended in ascending order, which allows range queries by binary search.
+    """
+
+    def __init__( self, channels, capacity ):
+        self.channels = list(channels)
+        self.capacity = int(capacity)
+        self._times = self._alloc()
+        self._columns = dict((name, self._alloc()) for name in self.channels)
+        self._count = 0     # total number of rows ever appended
+        self._lock = threading.Lock()
+
+    def _alloc( self ):
+        if numpy is not None:
+            return numpy.full(self.capacity, float("nan"))
+        return array('d', [float("nan")]) * self.capacity
+
+    def _concat( self, parts ):
+        if numpy is not None:
+            return numpy.concatenate(parts)
+        retval = array('d')
+        for part in parts: retval.extend(part)
+        return retval
+
+    def Append( self, timestamp = None, **values ):
+        """Adds one row. Channels missing from values are stored as NaN."""
+        with self._lock:
+            idx = self._count % self.capacity
+            self._times[idx] = time.time() if timestamp is None else timestamp
+            for name in self.channels:
+                self._columns[name][idx] = values.get(name, float("nan"))
+            self._count += 1
+
+    def _segments( self ):
+        # physical index ranges of the ring in chronological order
+        if self._count <= self.capacity:
+            return [(0, self._count)]
+        first = self._count % self.capacity
+        return [(first, self.capacity), (0, first)]
+
+    def _select( self, start, end, exclusive = False, limit = None ):
+        # physical (lo, hi) index ranges of the first limit rows with start <= timestamp < end, or start < timestamp if exclusive
+        retval = []
+        for lo, hi in self._segments():
+            lo, hi = (bisect.bisect_right if exclusive else bisect.bisect_left)(self._times, start, lo, hi), bisect.bisect_left(self._times, end, lo, hi)
+            if limit is not None:
+                hi = min(hi, lo + limit - sum(b - a for a, b in retval))
+            if hi > lo: retval.append((lo, hi))
+        return retval
+
+    def Range( self, start = float("-inf"), end = float("inf"), channels = None, limit = None, exclusive = False ):
+        """Returns all rows with start <= timestamp < end.
+
+        Args:
+            start: First timestamp to include, in seconds since the epoch.
+            end: Timestamp up to which rows are included (exclusive).
+            channels: Names of the channels to return, defaults to all of them.
+            limit: If given, at most this many rows, starting with the oldest one, are returned.
+            exclusive: If True, rows with timestamp == start are left out as well.
+
+        Returns:
+            A dictionary mapping "time" and the channel names to columns of equal length, oldest row first.
+        """
+        channels = self.channels if channels is None else channels
+        with self._lock:
+            ranges = self._select(start, end, exclusive, limit)
+            retval = {"time": self._concat([self._times[lo:hi] for lo, hi in ranges])}
+            for name in channels:
+                retval[name] = self._concat([self._columns[name][lo:hi] for lo, hi in ranges])
+        return retval
+
+    def Chunks( self, start, end, channels = None, size = 1000 ):
+        """Yields the rows with start <= timestamp < end in chunks of at most size rows, see Range().
+
+        Every chunk is copied separately, so the store is only locked briefly and large ranges are
+        never copied as a whole.
+        """
+        exclusive = False
+        while True:
+            chunk = self.Range(start, end, channels, size, exclusive)
+            if len(chunk["time"]): yield chunk
+            if len(chunk["time"]) < size: return
+            start, exclusive = chunk["time"][-1], True   # continue after the last row of this chunk
+
+    def Decimate( self, start, end, buckets, channels = None ):
+        """Reduces the rows with start <= timestamp < end to at most buckets rows of min, max and mean.
+
+        The range is split into buckets of equal duration, empty buckets are left out and NaN values are ignored.
+
+        Yields:
+            Tuples (bucket start time, [(min, max, mean) for every channel]).
+        """
+        channels = self.channels if channels is None else channels
+        width = (end - start) / float(buckets)
+        current, stats = None, None
+        for chunk in self.Chunks(start, end, channels):
+            times = chunk["time"]
+            for row in range(len(times)):
+                bucket = start + math.floor((times[row] - start) / width) * width
+                if bucket != current:
+                    if current is not None: yield current, [self._summarize(x) for x in stats]
+                    current, stats = bucket, [[float("inf"), float("-inf"), 0.0, 0] for name in channels]
+                for stat, name in zip(stats, channels):
+                    value = chunk[name][row]
+                    if value != value: continue     # NaN
+                    stat[0], stat[1], stat[2], stat[3] = min(stat[0], value), max(stat[1], value), stat[2] + value, stat[3] + 1
+        if current is not None: yield current, [self._summarize(x) for x in stats]
+
+    def _summarize( self, stat ):
+        if not stat[3]: return float("nan"), float("nan"), float("nan")
+        return stat[0], stat[1], stat[2]/stat[3]
+
+    def Latest( self ):
+        """Returns the newest row as a dictionary, or None if the store is empty."""
+        with self._lock:
+            if not self._count: return None
+            idx = (self._count - 1) % self.capacity
+            retval = dict((name, self._columns[name][idx]) for name in self.channels)
+            retval["time"] = self._times[idx]
+            return retval
+
+    def __len__( self ):
+        return min(self._count, self.capacity)
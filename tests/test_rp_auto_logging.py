@@ -0,0 +1,48 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from rp_auto_logging import BufferedRotatingFileHandler, _compress
+
+class CompressTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'rp_auto_log.txt')
+
+    def tearDown( self ):
+        shutil.rmtree(self.directory)
+
+    def test_compress( self ):
+        rotated = self.path + '.2026-05-31'
+        with open(rotated, 'w') as f:
+            for n in range(1000): f.write('line {}\n'.format(n))
+        _compress(rotated)
+        self.assertEqual(os.listdir(self.directory), ['rp_auto_log.txt.2026-05-31.gz'])
+        with gzip.open(rotated + '.gz', 'rt') as f:
+            self.assertEqual(f.read(), ''.join('line {}\n'.format(n) for n in range(1000)))
+
+    def test_temporary_file_is_not_a_backup( self ):
+        # a rollover while the day before is still being compressed must not count the half-written file as a backup, nor delete it
+        handler = BufferedRotatingFileHandler(self.path, backupCount = 1)
+        self.addCleanup(handler.close)
+        rotated, newer = self.path + '.2026-05-31', self.path + '.2026-06-01'
+        for name in (rotated, newer):
+            with open(name, 'w') as f: f.write('line\n')
+        pruned = []
+        compress = gzip.compress
+        def _compress_block( data ):
+            pruned.append(handler.getFilesToDelete())
+            return compress(data)
+        gzip.compress = _compress_block
+        try:
+            _compress(rotated)
+        finally:
+            gzip.compress = compress
+        self.assertEqual(pruned, [[rotated]])
+        self.assertTrue(os.path.isfile(rotated + '.gz'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from rp_auto_logging import MEMBER_SIZE, _compress
+from rp_auto_logparse import LogFiles, ParseLine, SplitValue, Records, Collect
+from rp_auto_logindex import LogIndex, Query
+
+START = time.mktime((2026, 6, 1, 12, 0, 0, 0, 0, -1))
+LEVELS = ['DEBUG', 'INFO', 'WARNING']
+
+def _line( timestamp, level, module, message ):
+    # the layout of rp_auto_logging.FORMAT
+    return '{} {:<5.5}: [{:<18.18}] {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), level, module, message)
+
+class LogParseTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'rp_auto_log.txt')
+
+    def tearDown( self ):
+        shutil.rmtree(self.directory)
+
+    def test_parse_line( self ):
+        line = _line(START, 'WARNING', 'rp_auto_mod_scale', 'Converted value to -3.14')
+        self.assertEqual(ParseLine(line), (START, 'WARNI', 'rp_auto_mod_scale', 'Converted value to -3.14'))
+        self.assertEqual(SplitValue('Converted value to -3.14'), ('Converted value to', -3.14))
+        self.assertEqual(SplitValue('Device check complete'), ('Device check complete', None))
+        self.assertIsNone(ParseLine('Traceback (most recent call last):'))
+
+    def test_collect( self ):
+        with open(self.path, 'w') as f:
+            for n in range(30):
+                f.write(_line(START + n, LEVELS[n % 3], 'rp_auto_mod_pump', 'Converted value to ' + str(n)))
+            f.write('continuation of a message without a time\n')
+        series = Collect(LogFiles(self.path))
+        self.assertEqual(list(series[('rp_auto_mod_pump', 'Converted value to')]["value"]), list(map(float, range(30))))
+        series = Collect(LogFiles(self.path), levels = ['WARNING'])
+        self.assertEqual(list(series[('rp_auto_mod_pump', 'Converted value to')]["value"]), list(map(float, range(2, 30, 3))))
+        self.assertEqual(len(list(Records(LogFiles(self.path), levels = ['INFO'], modules = ['rp_auto_mod_scale']))), 0)
+
+class LogIndexTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'rp_auto_log.txt')
+
+    def tearDown( self ):
+        shutil.rmtree(self.directory)
+
+    def _write( self, path, start, count, step = 10.0, text = 'Converted value to' ):
+        with open(path, 'a') as f:
+            for n in range(count):
+                f.write(_line(start + n*step, LEVELS[n % 3], 'rp_auto_mod_scale', text + ' ' + str(n)))
+
+    def _expected( self, start, end, levels = None ):
+        return [record for record in Records(LogFiles(self.path), levels) if start <= record[0] < end]
+
+    def test_query( self ):
+        self._write(self.path, START, 600)
+        result = list(Query(self.path, START + 1800, START + 2400))
+        self.assertEqual(len(result), 60)
+        self.assertEqual(result, self._expected(START + 1800, START + 2400))
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, '.rp_auto_log.txt.idx')))
+        self._write(self.path, START + 6000, 60)     # picked up incrementally
+        self.assertEqual(list(Query(self.path, START + 5400, START + 6600)), self._expected(START + 5400, START + 6600))
+        self.assertEqual(len(list(Query(self.path, START + 5400, START + 6600))), 120)
+
+    def test_levels( self ):
+        self._write(self.path, START, 600)
+        warnings = list(Query(self.path, START, START + 6000, levels = ['WARNING']))
+        self.assertEqual(len(warnings), 200)
+        self.assertEqual(warnings, list(Query(self.path, START, START + 6000, levels = ['WARNI'])))
+        self.assertEqual(warnings, self._expected(START, START + 6000, ['WARNING']))
+        self.assertEqual(len(list(Query(self.path, START, START + 6000, levels = ['INFO', 'DEBUG']))), 400)
+
+    def test_compressed_members( self ):
+        rotated = self.path + '.2026-05-31'
+        self._write(rotated, START - 86400, 8000, step = 1.0, text = 'Some longer message to fill the members quickly, value')
+        self.assertGreater(os.path.getsize(rotated), 2*MEMBER_SIZE)
+        _compress(rotated)
+        self.assertFalse(os.path.exists(rotated))
+        self._write(self.path, START, 60)
+        index = LogIndex(rotated + '.gz')
+        index.Update()
+        self.assertGreater(len(index.members), 2)
+        for start, end in ((START - 86400 + 5000, START - 86400 + 5300), (START - 86400 + 7990, START + 100), (START - 90000, START - 86390)):
+            self.assertEqual(list(Query(self.path, start, end)), self._expected(start, end))
+
+    def test_replaced_log( self ):
+        # the midnight rollover renames the log and starts a new one under the same name, the old index must not be used for it
+        self._write(self.path, START, 360)
+        self.assertEqual(len(list(Query(self.path, START, START + 3600))), 360)
+        os.rename(self.path, self.path + '.2026-06-01')
+        self._write(self.path, START + 86400, 60, step = 60.0)
+        self.assertEqual(len(list(Query(self.path, START + 86400, START + 2*86400))), 60)
+        self.assertEqual(len(list(Query(self.path, START + 86400, START + 86400 + 3600))), 60)
+        self.assertEqual(len(list(Query(self.path, START, START + 3600))), 360)
+        os.remove(self.path + '.2026-06-01')
+        list(Query(self.path, START, START + 1))
+        self.assertEqual(sorted(name for name in os.listdir(self.directory) if name.endswith('.idx')), ['.rp_auto_log.txt.idx'])
+
+if __name__ == '__main__':
+    unittest.main()
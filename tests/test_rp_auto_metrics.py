@@ -0,0 +1,65 @@
+import atexit
+import unittest
+
+from rp_auto_metrics import Registry, Instrument
+from rp_auto_mod_pump import ModulePump, PumpStatus
+from rp_auto_acquisition import PUMP_FIELDS
+from rp_auto_sim import FillModel, SimPump
+
+class _Driver:
+
+    def __init__( self, value ):
+        self.value = value
+
+    def GetValue( self ):
+        if isinstance(self.value, Exception): raise self.value
+        return self.value
+
+class InstrumentTest(unittest.TestCase):
+
+    def _count( self, registry, name, **labels ):
+        return registry.Counter(name, **labels).value
+
+    def test_counts_calls_errors_and_nans( self ):
+        registry = Registry()
+        driver = _Driver(1.0)
+        Instrument(driver, ['GetValue'], registry, device = 'scale')
+        driver.GetValue()
+        driver.value = float('nan')
+        driver.GetValue()
+        driver.value = Exception('no reply')
+        self.assertRaises(Exception, driver.GetValue)
+        self.assertEqual(self._count(registry, 'rp_auto_driver_nan_total', device = 'scale', call = 'GetValue'), 1)
+        self.assertEqual(self._count(registry, 'rp_auto_driver_errors_total', device = 'scale', call = 'GetValue'), 1)
+        self.assertIn('rp_auto_driver_seconds_count{call="GetValue",device="scale"} 3', registry.Render())
+
+    def test_fields_not_asked_for_are_no_nans( self ):
+        registry = Registry()
+        driver = _Driver(PumpStatus(True, 30.0, None, None))
+        Instrument(driver, ['GetValue'], registry, device = 'pump')
+        driver.GetValue()
+        self.assertEqual(self._count(registry, 'rp_auto_driver_nan_total', device = 'pump', call = 'GetValue'), 0)
+        driver.value = PumpStatus(True, float('nan'), None, None)
+        driver.GetValue()
+        self.assertEqual(self._count(registry, 'rp_auto_driver_nan_total', device = 'pump', call = 'GetValue'), 1)
+
+    def test_pump_status_of_acquisition( self ):
+        # the acquisition pass reads state and level only, which must not show up as failed readings
+        sim = SimPump(FillModel())
+        try:
+            pump = ModulePump(sim.Port, timeout = 1.0)
+            try:
+                registry = Registry()
+                Instrument(pump, ['GetPumpStatus'], registry, device = 'pump')
+                for n in range(3):
+                    status = pump.GetPumpStatus(PUMP_FIELDS)
+                self.assertIsNone(status.pumptemp)
+                self.assertEqual(self._count(registry, 'rp_auto_driver_nan_total', device = 'pump', call = 'GetPumpStatus'), 0)
+            finally:
+                pump._on_exit()
+                atexit.unregister(pump._on_exit)
+        finally:
+            sim.Close()
+
+if __name__ == '__main__':
+    unittest.main()
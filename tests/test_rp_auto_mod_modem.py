@@ -0,0 +1,124 @@
+import atexit
+import unittest
+
+from rp_auto_mod_modem import ModuleModem, SplitText, SMS_LENGTH, _Message
+from rp_auto_metrics import Registry
+from rp_auto_sim import SimModem
+
+LONG = ' '.join('word{:03d}'.format(n) for n in range(50))    # 399 characters, three short mails
+
+def _message( text, key = None, retries = 2 ):
+    return _Message('0123', text, key, float('inf'), retries, None)
+
+class SplitTextTest(unittest.TestCase):
+
+    def test_short( self ):
+        self.assertEqual(SplitText('hello'), ['hello'])
+        self.assertEqual(SplitText('x'*SMS_LENGTH), ['x'*SMS_LENGTH])
+
+    def test_long( self ):
+        parts = SplitText(LONG)
+        self.assertEqual(len(parts), 3)
+        self.assertTrue(all(len(part) <= SMS_LENGTH for part in parts))
+        self.assertEqual([part[:6] for part in parts], ['(1/3) ', '(2/3) ', '(3/3) '])
+        self.assertEqual(' '.join(part[6:] for part in parts), LONG)   # cut at spaces, nothing lost
+
+    def test_line_breaks( self ):
+        lines = [str(n)*70 for n in range(5)]
+        parts = SplitText('\n'.join(lines))
+        self.assertEqual([part[6:] for part in parts], ['\n'.join(lines[0:2]), '\n'.join(lines[2:4]), lines[4]])
+
+    def test_no_break( self ):
+        parts = SplitText('x'*400)
+        self.assertTrue(all(len(part) <= SMS_LENGTH for part in parts))
+        self.assertEqual(''.join(part[6:] for part in parts), 'x'*400)
+
+class MessageTest(unittest.TestCase):
+
+    def test_parts( self ):
+        message = _message('a')
+        for text, key in (('b', None), ('a', None), ('old', 'warning'), ('new', 'warning')):
+            message.Merge(_message(text, key))
+        self.assertEqual(message.Parts(), ['a\nb\nnew'])   # duplicates dropped, a newer entry with the same key supersedes
+        self.assertEqual(message.covered, 5)
+        self.assertEqual(message.Parts(), [])   # nothing new since
+
+    def test_merge_keeps_composed_entries( self ):
+        # a message that failed halfway is merged with a newer one; the parts it still has to send stay in front, and what it sent is not sent again
+        retried = _message(LONG)
+        parts = retried.Parts()
+        retried.unsent = parts[1:]
+        newer = _message('later', retries = 5)
+        newer.deadline = 100.0
+        retried.Merge(newer)
+        self.assertEqual(retried.covered, 1)
+        self.assertEqual([entry[0] for entry in retried.entries], [LONG, 'later'])
+        self.assertEqual((retried.deadline, retried.retries), (100.0, 5))
+        self.assertEqual(retried.Parts(), parts[1:] + ['later'])
+
+    def test_merge_two_retried( self ):
+        first, second = _message('first ' + LONG), _message('second ' + LONG)
+        first.unsent = first.Parts()[2:]
+        second.unsent = second.Parts()[1:]
+        first.Merge(second)
+        self.assertEqual(first.covered, 2)
+        self.assertEqual(first.Parts(), first.unsent)
+        self.assertEqual(len(first.unsent), 3)
+
+class ModemTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.sim = SimModem()
+        self.modem = ModuleModem(self.sim.Port, '0000', retries = 2, retrydelay = 60.0, digestwindow = 0.05, sendtimeout = 2.0, cmdtimeout = 1.0, metrics = Registry())
+        self.attempts = []
+        self.failures = set()   # numbers of the attempts that fail
+        send = self.modem._send_sms
+        def _send_sms( address, text ):
+            self.attempts.append(text)
+            if len(self.attempts) in self.failures: return False
+            return send(address, text)
+        self.modem._send_sms = _send_sms
+
+    def tearDown( self ):
+        self.modem._on_exit()
+        atexit.unregister(self.modem._on_exit)
+        self.sim.Close()
+
+    def _sent( self ):
+        return [text for address, text in self.sim.Sent]
+
+    def test_digest( self ):
+        self.modem.SendSMS('0123', 'first')
+        self.modem.SendSMS('0123,0456', 'second')
+        self.assertTrue(self.modem.Flush(5.0))
+        self.assertEqual(sorted(self.sim.Sent), [('0123', 'first\nsecond'), ('0456', 'second')])
+
+    def test_partial_send_is_retried_by_flush( self ):
+        # the second part fails; the retry, due only after retrydelay, is sent by Flush() right away, without the part that went through
+        self.failures = {2}
+        results = []
+        self.modem.SendSMS('0123', LONG, callback = lambda address, text, success: results.append(success))
+        self.assertTrue(self.modem.Flush(5.0))
+        self.assertEqual(self._sent(), SplitText(LONG))
+        self.assertEqual(len(self.attempts), 4)
+        self.assertEqual(results, [True])
+
+    def test_flush_reports_dropped_message( self ):
+        self.failures = {1, 2, 3}
+        results = []
+        self.modem.SendSMS('0123', 'lost', callback = lambda address, text, success: results.append(success))
+        self.assertFalse(self.modem.Flush(5.0))
+        self.assertEqual(len(self.attempts), 3)     # the first attempt and two retries
+        self.assertEqual(results, [False])
+        self.assertTrue(self.modem.Flush(5.0))      # nothing queued any more
+
+    def test_flush_timeout( self ):
+        self.failures = {1}
+        self.modem.retrydelay = 0.5
+        self.modem.SendSMS('0123', 'late')
+        self.assertFalse(self.modem.Flush(0.0))
+        self.assertTrue(self.modem.Flush(5.0))
+        self.assertEqual(self._sent(), ['late'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import atexit
+import unittest
+from unittest import mock
+
+import rp_auto_mod_pump
+from rp_auto_mod_pump import ModulePump, MEMORY, EEPROM, GETTING
+from rp_auto_logparse import SplitValue
+from rp_auto_sim import FillModel, SimPump
+
+class PlanReadsTest(unittest.TestCase):
+
+    def _plan( self, fields, maxreadspan ):
+        pump = ModulePump.__new__(ModulePump)   # planning needs no port
+        pump.maxreadspan = maxreadspan
+        return pump._plan_reads(fields)
+
+    def test_memory( self ):
+        self.assertEqual(self._plan(MEMORY, 8), [[0x084, 4, ['auxtemp', 'pumptemp']], [0x0ce, 1, ['level']], [0x114, 1, ['state']]])
+
+    def test_span( self ):
+        self.assertEqual(self._plan(EEPROM, 8), [[0x014, 4, ['auxsensoroffset', 'pumpsensoroffset']], [0x01c, 2, ['levelsensoroffset']]])
+        self.assertEqual(self._plan(EEPROM, 10), [[0x014, 10, ['auxsensoroffset', 'pumpsensoroffset', 'levelsensoroffset']]])
+        self.assertEqual(self._plan(EEPROM, 2), [[0x014, 2, ['auxsensoroffset']], [0x016, 2, ['pumpsensoroffset']], [0x01c, 2, ['levelsensoroffset']]])
+
+    def test_subset( self ):
+        self.assertEqual(self._plan(dict((name, MEMORY[name]) for name in ('state', 'level')), 8), [[0x0ce, 1, ['level']], [0x114, 1, ['state']]])
+        self.assertEqual(self._plan({}, 8), [])
+
+class PumpTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.model = FillModel(storage = 40.0)
+        self.sim = SimPump(self.model, identity = 'LN2-PUMP SIM 0815')
+        self.pumps = []
+
+    def tearDown( self ):
+        for pump in self.pumps:
+            pump._on_exit()
+            atexit.unregister(pump._on_exit)
+        self.sim.Close()
+
+    def _pump( self, **kwargs ):
+        pump = ModulePump(self.sim.Port, timeout = 1.0, **kwargs)
+        self.pumps.append(pump)
+        return pump
+
+    def _exercise( self, pump ):
+        self.assertEqual(pump.Identity, 'LN2-PUMP SIM 0815')
+        self.assertEqual((pump.pumpsensoroffset, pump.auxsensoroffset, pump.levelsensoroffset), (145, 145, 38))
+        self.assertFalse(pump.GetPumpState())
+        pump.StartPump()
+        status = pump.GetPumpStatus()
+        self.assertTrue(status.running)
+        self.assertAlmostEqual(status.level, self.model.Level(), delta = 1.0)
+        self.assertEqual((status.pumptemp, status.auxtemp), (-20, 20))
+        pump.StopPump()
+        self.assertFalse(pump.GetPumpState())
+
+    def test_pyserial( self ):
+        pump = self._pump()
+        self.assertIsInstance(pump._prt, rp_auto_mod_pump.serial.Serial)
+        self._exercise(pump)
+
+    def test_termios( self ):
+        pump = self._pump()
+        pump._prt.close()
+        pump._prt = pump._open_port('/dev/' + self.sim.Port, 'T')
+        self.assertIsInstance(pump._prt, int)
+        self._exercise(pump)
+
+    def test_termios_without_pyserial( self ):
+        with mock.patch.object(rp_auto_mod_pump, 'serial', None):
+            pump = self._pump()
+            self.assertIsInstance(pump._prt, int)
+            self._exercise(pump)
+
+    def test_log_lines( self ):
+        # every converted reading is logged on a line of its own after the line naming it, as parsed by parseRpAutoLog.m
+        pump = self._pump()
+        with self.assertLogs('rp_auto_ctrl', 'DEBUG') as logs:
+            status = pump.GetPumpStatus()
+        messages = [record.getMessage() for record in logs.records]
+        for name, value in (("level", status.level), ("pumptemp", status.pumptemp), ("auxtemp", status.auxtemp)):
+            n = messages.index(GETTING[name])
+            self.assertEqual(SplitValue(messages[n + 1]), ('Converted value to', value))
+        with self.assertLogs('rp_auto_ctrl', 'DEBUG') as logs:
+            level = pump.GetPumpLevel()
+        self.assertEqual([record.getMessage() for record in logs.records][-1], 'Converted value to ' + str(level))
+
+    def test_termios_port_is_locked( self ):
+        with mock.patch.object(rp_auto_mod_pump, 'serial', None):
+            self._pump()
+            self.assertRaises(OSError, self._pump)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import time
+import errno
+import atexit
+import socket
+import unittest
+
+from rp_auto_mod_server import ModuleServer
+from rp_auto_timeseries import TimeSeriesStore
+
+class _FailingListener:
+    # stands in for the listening socket, and fails to accept the first connections like a process out of descriptors
+
+    def __init__( self, sock, failures ):
+        self._sock = sock
+        self.failures = failures
+
+    def accept( self ):
+        if self.failures:
+            self.failures -= 1
+            raise OSError(errno.EMFILE, 'Too many open files')
+        return self._sock.accept()
+
+    def __getattr__( self, name ):
+        return getattr(self._sock, name)
+
+class ServerTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.server = ModuleServer(0, idletimeout = 10.0)
+        self.port = self.server._sock.getsockname()[1]
+        history = TimeSeriesStore(['scale'], 10000)
+        for n in range(5000): history.Append(1000.0 + n, scale = 0.5)
+        self.server.Histories[''] = history
+
+    def tearDown( self ):
+        self.server._on_exit()
+        atexit.unregister(self.server._on_exit)
+        self.server._thread.join(5.0)
+
+    def _connect( self ):
+        client = socket.create_connection(('127.0.0.1', self.port), timeout = 5.0)
+        self.addCleanup(client.close)
+        return client
+
+    def _receive( self, client ):
+        # everything up to the server closing the connection
+        data = b''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk: return data
+            data += chunk
+
+    def _exchange( self, client, line ):
+        client.sendall(line)
+        data = b''
+        while not data.endswith(b'\r\n'): data += client.recv(65536)
+        return data
+
+    def test_legacy_request_and_half_close( self ):
+        client = self._connect()
+        client.sendall(b'SVR:HELLO')
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(self._receive(client), b'CNT:HELLO=RP_AUTO_SERVER_V1.0\r\n')
+
+    def test_pipelined_requests_and_half_close( self ):
+        client = self._connect()
+        client.sendall(b'SVR:HELLO\r\nSVR:HISTORY 1000 6000\r\nSVR:HELLO\r\n')
+        client.shutdown(socket.SHUT_WR)
+        lines = self._receive(client).split(b'\r\n')
+        self.assertEqual(lines[0], b'CNT:HELLO=RP_AUTO_SERVER_V1.1')
+        self.assertEqual(lines[-3:], [b'CNT:END', b'CNT:HELLO=RP_AUTO_SERVER_V1.1', b''])
+        self.assertEqual(len([line for line in lines if line and not line.startswith(b'CNT:')]), 5000)
+
+    def test_error_closes_only_that_connection( self ):
+        broken, healthy = self._connect(), self._connect()
+        self.assertEqual(self._exchange(healthy, b'SVR:HELLO\r\n'), b'CNT:HELLO=RP_AUTO_SERVER_V1.1\r\n')
+        process = self.server._process
+        def _process( conn ):
+            if conn.addr[1] == broken.getsockname()[1]: raise RuntimeError('broken client')
+            process(conn)
+        self.server._process = _process
+        broken.sendall(b'SVR:HELLO\r\n')
+        self.assertEqual(self._receive(broken), b'')
+        self.assertEqual(self._exchange(healthy, b'SVR:HELLO\r\n'), b'CNT:HELLO=RP_AUTO_SERVER_V1.1\r\n')
+        self.assertEqual(self._exchange(self._connect(), b'SVR:HELLO\r\n'), b'CNT:HELLO=RP_AUTO_SERVER_V1.1\r\n')
+
+    def test_accept_out_of_descriptors( self ):
+        self.server.ACCEPT_PAUSE = 0.2
+        self.server._sock = _FailingListener(self.server._sock, 1)
+        start = time.time()
+        self.assertEqual(self._exchange(self._connect(), b'SVR:HELLO\r\n'), b'CNT:HELLO=RP_AUTO_SERVER_V1.1\r\n')
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(self.server._sock.failures, 0)
+
+if __name__ == '__main__':
+    unittest.main()
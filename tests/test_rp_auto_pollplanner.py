@@ -0,0 +1,74 @@
+import unittest
+
+from rp_auto_pollplanner import PollPlanner
+
+class PollPlannerTest(unittest.TestCase):
+
+    def _planner( self, **kwargs ):
+        # thresholds at 10 and 20 kg, fixed intervals of 30 s idle and 5 s while pumping
+        options = dict(mininterval = 1.0, maxinterval = 60.0, window = 300.0, safety = 0.5)
+        options.update(kwargs)
+        return PollPlanner(10.0, 20.0, 30.0, 5.0, **options)
+
+    def _observe( self, planner, rate, pumping, start = 15.0, count = 10, step = 1.0 ):
+        for n in range(count): planner.Observe(n*step, start + rate*n*step, pumping)
+        return start + rate*(count - 1)*step
+
+    def test_fallback_without_estimate( self ):
+        planner = self._planner()
+        self.assertEqual(planner.Next(15.0, False), 30.0)
+        self.assertEqual(planner.Next(15.0, True), 5.0)
+        planner.Observe(0.0, 15.0, False)
+        planner.Observe(1.0, 15.0, False)
+        self.assertIsNone(planner.Rates[False])
+        self.assertEqual(planner.Next(float('nan'), False), 30.0)
+
+    def test_rate( self ):
+        planner = self._planner()
+        self._observe(planner, -0.01, False)
+        self.assertAlmostEqual(planner.Rates[False], -0.01)
+        self.assertIsNone(planner.Rates[True])
+        self._observe(planner, 0.2, True)
+        self.assertAlmostEqual(planner.Rates[True], 0.2)
+        self.assertAlmostEqual(planner.Rates[False], -0.01)     # kept for the next boil-off period
+
+    def test_window( self ):
+        planner = self._planner(window = 5.0)
+        self._observe(planner, -1.0, False, count = 10)
+        self._observe(planner, -0.01, False, count = 10)    # same state, the old samples fall out of the window
+        planner.Observe(100.0, 14.0, False)
+        planner.Observe(101.0, 13.99, False)
+        planner.Observe(102.0, 13.98, False)
+        self.assertAlmostEqual(planner.Rates[False], -0.01)
+
+    def test_idle_interval( self ):
+        planner = self._planner()
+        weight = self._observe(planner, -0.001, False)      # 5 kg to go at 1 g/s
+        self.assertEqual(planner.Next(weight, False), 30.0)
+        self.assertAlmostEqual(planner.Next(10.02, False), 10.0)
+        self.assertEqual(planner.Next(10.001, False), 1.0)
+        self.assertEqual(planner.Next(9.9, False), 1.0)    # across, poll right away
+        self.assertEqual(planner.Next(15.0, True), 5.0)    # no fill rate yet
+
+    def test_fill_interval( self ):
+        # while the pump runs, the planner never waits longer than pollintwhilepumping
+        planner = self._planner()
+        weight = self._observe(planner, 0.001, True)    # a slow fill, 5 kg to go at 1 g/s
+        self.assertEqual(planner.Next(weight, True), 5.0)
+        self.assertAlmostEqual(planner.Next(19.996, True), 2.0)
+        self.assertEqual(planner.Next(20.0, True), 1.0)
+
+    def test_not_moving( self ):
+        planner = self._planner()
+        weight = self._observe(planner, 0.001, False)   # gaining weight with the pump off
+        self.assertEqual(planner.Next(weight, False), 30.0)
+        weight = self._observe(planner, -0.001, True)   # losing weight while pumping, e.g. an empty storage dewar
+        self.assertEqual(planner.Next(weight, True), 5.0)
+
+    def test_max_interval( self ):
+        planner = self._planner(maxinterval = 20.0)
+        weight = self._observe(planner, -0.001, False)
+        self.assertEqual(planner.Next(weight, False), 20.0)
+
+if __name__ == '__main__':
+    unittest.main()
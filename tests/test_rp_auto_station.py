@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rp_auto_ctrl import _config
+from rp_auto_mod_pump import PumpStatus
+from rp_auto_metrics import Registry
+from rp_auto_station import Station
+
+class _Pump:
+
+    def __init__( self, running = False, failing = False ):
+        self.running = running
+        self.failing = failing  # every read raises, like a pump that was unplugged
+
+    def GetPumpStatus( self, fields = () ):
+        if self.failing: raise Exception('Unable to contact LN2 pump!')
+        return PumpStatus(self.running, 30.0, None, None)
+
+    def GetPumpState( self ):
+        return self.running
+
+    def GetPumpLevel( self ):
+        return 30.0
+
+    def StartPump( self ):
+        self.running = True
+
+    def StopPump( self ):
+        self.running = False
+
+class _Reader:
+
+    OutUnit = 'A'
+
+    def __init__( self, value ):
+        self.value = value
+
+    def GetValue( self ):
+        return self.value
+
+    def GetStatistics( self, since ):
+        return {"count": 0, "min": float('nan'), "max": float('nan')}
+
+class _Modem:
+
+    def __init__( self ):
+        self.sent = []
+
+    def SendSMS( self, recipients, text ):
+        self.sent.append(text)
+
+class _Server:
+
+    def __init__( self ):
+        self.Snapshots = {}
+        self.Histories = {}
+
+    def Publish( self, snapshot, station = '' ):
+        self.Snapshots[station] = snapshot
+
+class StationTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.directory = tempfile.mkdtemp()
+        self.config = _config(os.path.join(self.directory, 'none'))
+        self.config._setting.set('logging', 'telemetryfile', os.path.join(self.directory, 'telemetry.bin'))
+        self.config._setting.set('runparams', 'provokefile', os.path.join(self.directory, 'provoke'))
+        self.config._setting.set('runparams', 'maxpollfails', '3')
+        self.modem = _Modem()
+
+    def tearDown( self ):
+        shutil.rmtree(self.directory)
+
+    def _station( self, pump, scale = 0.5 ):
+        return Station('det1', self.config, self.modem, _Server(), metrics = Registry(), devices = (_Reader(scale), pump, _Reader(0.0)))
+
+    def test_poll( self ):
+        station = self._station(_Pump())
+        station.Poll()
+        self.assertEqual(station.loopfails, 0)
+        self.assertEqual(len(station.history), 1)
+        self.assertFalse(station.Done)
+
+    def test_gives_up_and_stops_pump( self ):
+        pump = _Pump(running = True)
+        station = self._station(pump)
+        pump.failing = True
+        for n in range(2):
+            station.Poll()
+            self.assertFalse(station.Done)
+        self.assertTrue(pump.running)
+        station.Poll()
+        self.assertTrue(station.Done)
+        self.assertFalse(pump.running)
+        self.assertIn('[det1] System polling failed 3 times', self.modem.sent[-1])
+
+    def test_gives_up_when_pump_cannot_be_stopped( self ):
+        pump = _Pump(running = True, failing = True)
+        def StopPump( ):
+            raise Exception('Unable to stop LN2 pump!')
+        pump.StopPump = StopPump
+        station = self._station(pump)
+        for n in range(3): station.Poll()
+        self.assertTrue(station.Done)
+        self.assertIn('Could not stop pump: Unable to stop LN2 pump!', self.modem.sent[-1])
+
+if __name__ == '__main__':
+    unittest.main()
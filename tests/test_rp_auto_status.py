@@ -0,0 +1,56 @@
+import os
+import time
+import calendar
+import datetime
+import unittest
+
+from rp_auto_status import BINARY, MakeSnapshot
+from rp_auto_acquisition import Acquisition
+from rp_auto_mod_pump import PumpStatus
+
+class _Devices:
+
+    def GetPumpStatus( self, fields = () ):
+        return PumpStatus(False, 30.0, None, None)
+
+    def GetValue( self ):
+        return 0.5
+
+class DaylightSavingTest(unittest.TestCase):
+    # 2026-10-25 in Berlin runs through 02:00-03:00 twice, first in summer time and then in winter time
+
+    def setUp( self ):
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/Berlin'
+        time.tzset()
+
+    def tearDown( self ):
+        if self.tz is None: del os.environ['TZ']
+        else: os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def test_repeated_hour( self ):
+        first = calendar.timegm((2026, 10, 25, 0, 30, 0, 0, 0, 0))     # 02:30 summer time
+        second = first + 3600   # 02:30 winter time
+        for epoch in (first, second):
+            timestamp = datetime.datetime.fromtimestamp(epoch)
+            self.assertEqual(timestamp.strftime('%H:%M'), '02:30')
+            snapshot = MakeSnapshot(1, timestamp, 0.5, False, 30.0, 0.0, timestamp)
+            fields = BINARY.unpack(snapshot.binary)
+            self.assertEqual(fields[1], epoch)
+            self.assertEqual(fields[6], epoch)
+
+    def test_epoch_is_passed_through( self ):
+        epoch = calendar.timegm((2026, 10, 25, 1, 30, 0, 0, 0, 0)) + 0.25
+        timestamp = datetime.datetime(2026, 10, 25, 2, 30)    # fold not set, so ambiguous on its own
+        snapshot = MakeSnapshot(1, timestamp, 0.5, False, 30.0, 0.0, timestamp, epoch)
+        self.assertEqual(BINARY.unpack(snapshot.binary)[1], epoch)
+
+    def test_acquisition_time( self ):
+        devices = _Devices()
+        snapshot = Acquisition(devices, devices, devices).Acquire()
+        self.assertAlmostEqual(snapshot.time, time.time(), delta = 5.0)
+        self.assertEqual(snapshot.timestamp, datetime.datetime.fromtimestamp(snapshot.time))
+
+if __name__ == '__main__':
+    unittest.main()
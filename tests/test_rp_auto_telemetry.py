@@ -0,0 +1,66 @@
+import os
+import glob
+import shutil
+import atexit
+import datetime
+import tempfile
+import unittest
+
+from rp_auto_telemetry import TelemetryWriter, TelemetryArchive
+
+DAY = 86400.0
+
+class TelemetryTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'telemetry.bin')
+        self.noon = datetime.datetime.combine(datetime.date.today(), datetime.time(12)).timestamp()
+
+    def tearDown( self ):
+        shutil.rmtree(self.directory)
+
+    def _writer( self, keep ):
+        writer = TelemetryWriter(self.path, keep)
+        self.addCleanup(atexit.unregister, writer._on_exit)
+        self.addCleanup(writer._on_exit)
+        return writer
+
+    def _write( self, writer, timestamp ):
+        writer.Write(timestamp, 0.5, 0.0, 30.0, 0.01, 0.1)
+
+    def _times( self, start, end ):
+        return [record[0] for record in TelemetryArchive(self.path).Range(start, end)]
+
+    def test_range( self ):
+        writer = self._writer(7)
+        times = [self.noon - 2*DAY, self.noon - DAY, self.noon - DAY + 60, self.noon]
+        for timestamp in times: self._write(writer, timestamp)
+        self.assertEqual(len(glob.glob(self.path + '.*')), 3)  # today's first file, and the two days before it
+        self.assertEqual(self._times(self.noon - 3*DAY, self.noon + 1), times)
+        self.assertEqual(self._times(self.noon - DAY, self.noon), times[1:3])
+
+    def test_keep( self ):
+        writer = self._writer(2)
+        for n in range(5, 0, -1): self._write(writer, self.noon - n*DAY)
+        self._write(writer, self.noon)
+        self.assertEqual(len(glob.glob(self.path + '.*')), 2)  # the day before, and today's first file, which sorts last
+        self.assertEqual(self._times(0, self.noon + 1), [self.noon - DAY, self.noon])
+
+    def test_keep_all( self ):
+        writer = self._writer(0)
+        for n in range(5, 0, -1): self._write(writer, self.noon - n*DAY)
+        self._write(writer, self.noon)
+        self.assertEqual(len(glob.glob(self.path + '.*')), 6)
+        self.assertEqual(len(self._times(0, self.noon + 1)), 6)
+
+    def test_clock_set_back( self ):
+        writer = self._writer(7)
+        self._write(writer, self.noon - 2*DAY)
+        self._write(writer, self.noon - DAY)
+        self._write(writer, self.noon - 2*DAY + 60)    # back into a day that has been rotated already
+        self._write(writer, self.noon)
+        self.assertEqual(self._times(self.noon - 3*DAY, self.noon - 1.5*DAY), [self.noon - 2*DAY, self.noon - 2*DAY + 60])
+
+if __name__ == '__main__':
+    unittest.main()
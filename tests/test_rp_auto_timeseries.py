@@ -0,0 +1,65 @@
+import math
+import unittest
+
+from rp_auto_timeseries import TimeSeriesStore
+
+class TimeSeriesStoreTest(unittest.TestCase):
+
+    def _store( self, count, capacity = 100 ):
+        # one row per second from t = 1000, level n and pumptemp 2n
+        store = TimeSeriesStore(['level', 'pumptemp'], capacity)
+        for n in range(count): store.Append(1000.0 + n, level = float(n), pumptemp = 2.0*n)
+        return store
+
+    def test_empty( self ):
+        store = self._store(0)
+        self.assertEqual(len(store), 0)
+        self.assertIsNone(store.Latest())
+        self.assertEqual(list(store.Range()["time"]), [])
+        self.assertEqual(list(store.Chunks(0.0, 2000.0)), [])
+
+    def test_range( self ):
+        store = self._store(50)
+        self.assertEqual(len(store), 50)
+        rows = store.Range(1010.0, 1020.0)
+        self.assertEqual(list(rows["time"]), [1000.0 + n for n in range(10, 20)])
+        self.assertEqual(list(rows["pumptemp"]), [2.0*n for n in range(10, 20)])
+        rows = store.Range(1010.0, 1020.0, channels = ['level'], limit = 3, exclusive = True)
+        self.assertEqual(sorted(rows), ['level', 'time'])
+        self.assertEqual(list(rows["level"]), [11.0, 12.0, 13.0])
+
+    def test_wrapped( self ):
+        store = self._store(250)
+        self.assertEqual(len(store), 100)
+        self.assertEqual(list(store.Range()["level"]), [float(n) for n in range(150, 250)])
+        self.assertEqual(list(store.Range(1190.0, 1210.0, limit = 15)["level"]), [float(n) for n in range(190, 205)])   # across the end of the ring
+        self.assertEqual(store.Latest(), {"time": 1249.0, "level": 249.0, "pumptemp": 498.0})
+
+    def test_missing_channel( self ):
+        store = TimeSeriesStore(['level', 'pumptemp'], 10)
+        store.Append(1000.0, level = 1.0)
+        latest = store.Latest()
+        self.assertEqual(latest["level"], 1.0)
+        self.assertTrue(math.isnan(latest["pumptemp"]))
+
+    def test_chunks( self ):
+        store = self._store(250)
+        chunks = list(store.Chunks(1160.0, 1245.0, size = 20))
+        self.assertEqual([len(chunk["time"]) for chunk in chunks], [20, 20, 20, 20, 5])
+        self.assertEqual([value for chunk in chunks for value in chunk["level"]], [float(n) for n in range(160, 245)])
+        self.assertEqual(len(list(store.Chunks(1160.0, 1240.0, size = 20))), 4)
+
+    def test_decimate( self ):
+        store = self._store(100)
+        store.Append(1100.0, level = float("nan"), pumptemp = 0.0)
+        buckets = list(store.Decimate(1000.0, 1120.0, 4))
+        self.assertEqual([bucket for bucket, stats in buckets], [1000.0, 1030.0, 1060.0, 1090.0])   # 1090 to 1120 is only partly filled
+        self.assertEqual(buckets[1][1], [(30.0, 59.0, 44.5), (60.0, 118.0, 89.0)])
+        self.assertEqual(buckets[3][1][0], (90.0, 99.0, 94.5))     # the NaN is ignored
+        self.assertEqual(buckets[3][1][1], (0.0, 198.0, 1890.0/11))
+        store = self._store(10)
+        buckets = list(store.Decimate(1000.0, 1100.0, 10))
+        self.assertEqual(len(buckets), 1)    # empty buckets are left out
+
+if __name__ == '__main__':
+    unittest.main()